@@ -8,25 +8,67 @@ from .. import errors
 from ..spec.jsonschema import to_jsonschema
 
 
-class StandardOptionsMixin(object):
+def option_accessor(name):
+	"""Make a method that gets an option, or sets it and returns the object to chain more calls on."""
+	def accessor(self, *args):
+		if len(args) == 0:
+			return self._options.get(name)
+		owner = self._own()
+		owner._options[name] = args[0]
+		return owner
+	accessor.__name__ = name
+	return accessor
 	
-	def __init__(self, *accessors):
-		self._options = {}
-		for a in accessors:
-			self._add_accessor(a)
+	
+def after_id(filter, id):
+	"""Narrow a filter to the items with an id after `id`."""
+	if '_id' in filter:
+		return {'$and':[filter, {'_id':{'$gt':id}}]}
+	new_filter = dict(filter)
+	new_filter['_id'] = {'$gt':id}
+	return new_filter
+	
+	
+	
+class OptionsBase(object):
+	
+	__slots__ = ('_options',)
+	
+	def _own(self):
+		"""Get the object options should be set on. Shared objects return a new one."""
+		return self
 		
 		
 	def identity(self, *args):
 		if len(args) == 0:
 			return self._options.get('context', {}).get('identity')
-		elif args[0] is None:
-			if 'context' in self._options:
-				self._options['context'].pop('identity', None)
+		owner = self._own()
+		if args[0] is None:
+			if 'context' in owner._options:
+				owner._options['context'].pop('identity', None)
 		else:
-			if 'context' not in self._options:
-				self._options['context'] = {}
-			self._options['context']['identity'] = args[0]
-		return self
+			if 'context' not in owner._options:
+				owner._options['context'] = {}
+			owner._options['context']['identity'] = args[0]
+		return owner
+		
+		
+	def _merge_options(self, *options):
+		new_options = {}
+		for o in options:
+			if o:
+				new_options.update(o)
+		new_options.update(self._options)
+		return new_options
+		
+		
+		
+class StandardOptionsMixin(OptionsBase):
+	
+	def __init__(self, *accessors):
+		self._options = {}
+		for a in accessors:
+			self._add_accessor(a)
 		
 		
 	def _add_accessor(self, name):
@@ -39,22 +81,19 @@ class StandardOptionsMixin(object):
 		else:
 			self._options[name] = args[0]
 			return self
-			
-			
-	def _merge_options(self, *options):
-		new_options = {}
-		for o in options:
-			if o:
-				new_options.update(o)
-		new_options.update(self._options)
-		return new_options
 	
 	
 class API(StandardOptionsMixin):
+	"""
+	Pass a `ChangeFeed` as `change_feed` to clear the caches of the interfaces 
+	when items are written by other processes.
+	"""
 	
-	def __init__(self, model):
+	def __init__(self, model, change_feed=None):
+		self._proxies = {}
 		StandardOptionsMixin.__init__(self, 'bypass_authorization')
 		self.model = model
+		self.change_feed = change_feed
 		self.Interface = type('Interface', (Interface,), {'api':self})
 		self.interfaces = {}
 		self.interfaces_by_entity = {}
@@ -69,6 +108,10 @@ class API(StandardOptionsMixin):
 			
 		interface_inst = interface()
 		self.interfaces[interface.plural_name] = interface_inst
+		if self.change_feed and interface.cache_distinct:
+			# The cache belongs to the class, so later instances don't need registering
+			self.change_feed.register(interface_inst)
+		self._proxies.pop(interface.plural_name, None)
 		if interface.entity.__name__ not in self.interfaces_by_entity:
 			self.interfaces_by_entity[interface.entity.__name__] = []
 		self.interfaces_by_entity[interface.entity.__name__].append(interface_inst)
@@ -77,10 +120,17 @@ class API(StandardOptionsMixin):
 	def refresh(self):
 		for k, v in self.interfaces.items():
 			self.interfaces[k] = v.__class__()
+		self._proxies.clear()
 		
 		
 	def __getattr__(self, name):
-		return InterfaceProxy(self.interfaces[name], self._options)
+		if name.startswith('_'):
+			raise AttributeError(name)
+		# Proxies are shared, setting an option on one returns a new proxy
+		proxy = self._proxies.get(name)
+		if proxy is None:
+			proxy = self._proxies[name] = InterfaceProxy(self.interfaces[name], self._options, shared=True)
+		return proxy
 		
 		
 	def __getitem__(self, key):
@@ -95,26 +145,36 @@ class API(StandardOptionsMixin):
 		return self.interfaces_by_entity[entity.__name__][0]
 		
 		
-class InterfaceProxy(StandardOptionsMixin):
+class InterfaceProxy(OptionsBase):
+	
+	__slots__ = ('_interface', '_api_options', '_shared')
+	
+	fields = option_accessor('fields')
+	embed = option_accessor('embed')
+	allow_embedding = option_accessor('allow_embedding')
+	bypass_authorization = option_accessor('bypass_authorization')
+	show_hidden = option_accessor('show_hidden')
 	
-	def __init__(self, interface, options=None):
-		StandardOptionsMixin.__init__(self,
-			'fields',
-			'embed',
-			'allow_embedding',
-			'bypass_authorization',
-			'show_hidden'
-		)
+	def __init__(self, interface, options=None, shared=False):
+		self._options = {}
 		self._interface = interface
 		self._api_options = options
+		self._shared = shared
+		
 		
-		for when, events in self._interface.hooks.listeners.items():
-			for event in events.keys():
-				method_name = '%s_%s' % (when, event)
-				setattr(self, method_name, getattr(self._interface.hooks, method_name))
+	def _own(self):
+		if not self._shared:
+			return self
+		return InterfaceProxy(self._interface, self._api_options)
 		
 		
 	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		if name.startswith('before_') or name.startswith('after_'):
+			hook = getattr(self._interface.hooks, name, None)
+			if hook is not None:
+				return hook
 		return partial(self.link, name)
 		
 		
@@ -165,6 +225,10 @@ class InterfaceProxy(StandardOptionsMixin):
 			return self._interface.get(id_or_filter, **self._get_options(kwargs))
 		
 		
+	def get_many(self, ids, **kwargs):
+		return self._interface.get_many(ids, **self._get_options(kwargs))
+		
+		
 	def find(self, filter=None, **kwargs):
 		return FilterProxy(self._interface, self._get_options(kwargs), filter)
 		
@@ -174,23 +238,25 @@ class InterfaceProxy(StandardOptionsMixin):
 		
 		
 		
-class FilterProxy(StandardOptionsMixin):
+class FilterProxy(OptionsBase):
+	
+	fields = option_accessor('fields')
+	embed = option_accessor('embed')
+	allow_embedding = option_accessor('allow_embedding')
+	sort = option_accessor('sort')
+	offset = option_accessor('offset')
+	limit = option_accessor('limit')
+	bypass_authorization = option_accessor('bypass_authorization')
+	show_hidden = option_accessor('show_hidden')
+	filter = option_accessor('filter')
+	page_size = option_accessor('page_size')
+	
+	default_page_size = 100
 	
 	def __init__(self, interface, options, filter):
-		StandardOptionsMixin.__init__(self,
-			'fields',
-			'embed',
-			'allow_embedding',
-			'sort',
-			'offset',
-			'limit',
-			'bypass_authorization',
-			'show_hidden',
-			'filter'
-		)
+		self._options = {'filter':filter}
 		self._interface = interface
 		self._base_options = options
-		self._options['filter'] = filter
 		
 		
 	def list(self):
@@ -198,7 +264,43 @@ class FilterProxy(StandardOptionsMixin):
 		
 		
 	def __iter__(self):
-		return iter(self._list(self._merge_options(self._base_options)))
+		options = self._merge_options(self._base_options)
+		page_size = options.pop('page_size', None) or self.default_page_size
+		for page in self._pages(options, page_size):
+			for item in page:
+				yield item
+		
+		
+	def _pages(self, options, page_size):
+		"""
+		Yield the results `page_size` items at a time. Without a sort, or a default 
+		sort on the interface, the pages follow on from the last id seen. Otherwise 
+		they're fetched by offset.
+		"""
+		limit = options.pop('limit', 0)
+		offset = options.pop('offset', 0)
+		keyset = not options.get('sort') and not self._default_sort()
+		if keyset:
+			options['sort'] = ('+_id',)
+		filter = options.get('filter') or {}
+		seen = 0
+		last_id = None
+		while True:
+			page_options = dict(options)
+			page_options['limit'] = min(page_size, limit - seen) if limit else page_size
+			if keyset and last_id is not None:
+				page_options['filter'] = after_id(filter, last_id)
+			elif offset + seen:
+				page_options['offset'] = offset + seen
+			page = self._list(page_options)
+			if not page:
+				return
+			yield page
+			seen += len(page)
+			if limit and seen >= limit:
+				return
+			if keyset:
+				last_id = page[-1]['_id']
 		
 		
 	def __len__(self):
@@ -206,9 +308,9 @@ class FilterProxy(StandardOptionsMixin):
 		
 		
 	def count(self, **kwargs):
-		return self._list(
-			self._merge_options(self._base_options, kwargs, {'count': True})
-		)
+		options = self._merge_options(self._base_options, kwargs, {'count': True})
+		options.pop('page_size', None)
+		return self._list(options)
 		
 		
 	def __contains__(self, item_or_id):
@@ -216,15 +318,19 @@ class FilterProxy(StandardOptionsMixin):
 		new_filter = {'_id': id}
 		new_filter.update(self._options['filter'])
 		options = self._merge_options(self._base_options)
+		options.pop('page_size', None)
 		options['filter'] = new_filter
-		options['limit'] = 1
-		results = self._list(options)
-		return len(results) != 0
+		options['count'] = True
+		return self._list(options) != 0
 		
 	def _list(self, options):
 		return self._interface.list(**options)
 		
 		
+	def _default_sort(self):
+		return self._interface.default_sort
+		
+		
 class LinkProxy(FilterProxy):
 	
 	def __init__(self, interface, options, name, id):
@@ -234,4 +340,9 @@ class LinkProxy(FilterProxy):
 		
 	def _list(self, options):
 		return self._interface.link(self._id, self._name, **options)
+		
+		
+	def _default_sort(self):
+		target_interface = self._interface.get_linked_interface(self._name)
+		return target_interface.default_sort if target_interface else ()
 		
\ No newline at end of file
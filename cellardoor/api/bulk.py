@@ -0,0 +1,174 @@
+"""
+Stream the contents of an interface to and from a file for moving data
+between environments or reindexing.
+"""
+
+import os
+import json
+import msgpack
+from ..serializers.json_serializer import CellarDoorJSONEncoder
+from ..serializers.msgpack_serializer import default_handler
+from ..model import DateTime
+from .. import errors
+
+
+__all__ = [
+	'export_items',
+	'import_items'
+]
+
+
+FORMATS = ('json', 'msgpack')
+
+
+def export_items(interface, stream, format='json', versions=False, filter=None, batch_size=1000):
+	"""
+	Write every item of an interface's entity to `stream`, one record at a time.
+	The `json` format writes newline-delimited JSON; `msgpack` writes a sequence
+	of packed objects. Items are read from a storage cursor so memory use
+	doesn't grow with the size of the collection. With `versions=True` the
+	entity's version history is written after the current items, with each
+	record marked by `_history`.
+	
+	Returns the number of records written.
+	"""
+	write = get_writer(stream, format)
+	storage = interface.storage
+	entity = interface.entity
+	count = 0
+	
+	for item in storage.iterate(entity, filter=filter, batch_size=batch_size):
+		write(item)
+		count += 1
+		
+	if versions and entity.versioned:
+		for item in storage.iterate(entity, filter=filter, batch_size=batch_size, versions=True):
+			item['_history'] = True
+			write(item)
+			count += 1
+			
+	return count
+	
+	
+def import_items(interface, stream, format='json', batch_size=500, checkpoint=None):
+	"""
+	Read records written by `export_items` from `stream`, validate them and
+	write them with bulk inserts of `batch_size` items. Item IDs are kept.
+	
+	If `checkpoint` is a file path, the number of records written so far is
+	saved there after each batch and records already written are skipped when
+	an interrupted import is run again. When only part of a batch is written 
+	the checkpoint is moved up to the first record that failed, and a resumed
+	import counts records whose id is already taken as written. The file is 
+	removed once the import finishes.
+	
+	Returns the number of records written.
+	"""
+	storage = interface.storage
+	resuming = bool(checkpoint) and os.path.exists(checkpoint)
+	done = read_checkpoint(checkpoint)
+	count = 0
+	batches = {}
+	pending = 0
+	
+	for record in get_reader(stream, format):
+		count += 1
+		if count <= done:
+			continue
+		history = record.pop('_history', False)
+		entity = get_entity_for_type(interface.entity, record.get('_type'))
+		try:
+			item = validate_record(entity, record, history)
+		except errors.CompoundValidationError, e:
+			raise errors.CompoundValidationError({'record %d' % count: e.errors})
+		batches.setdefault((entity, history), []).append((count, item))
+		pending += 1
+		if pending >= batch_size:
+			write_batches(storage, batches, checkpoint, resuming)
+			write_checkpoint(checkpoint, count)
+			batches = {}
+			pending = 0
+			
+	write_batches(storage, batches, checkpoint, resuming)
+	if checkpoint and os.path.exists(checkpoint):
+		os.remove(checkpoint)
+	return count - done
+	
+	
+def validate_record(entity, record, history):
+	item = entity.validator.validate(record, enforce_required=not history)
+	# Counters and copies of linked items aren't fields, so validation drops them
+	for k in ['_id', '_version', '_deleted_by', '_snapshots'] + sorted(entity.counter_fields):
+		if k in record:
+			item[k] = record[k]
+	if '_deleted_on' in record:
+		item['_deleted_on'] = DateTime().validate(record['_deleted_on'])
+	return item
+	
+	
+def write_batches(storage, batches, checkpoint, skip_existing):
+	"""
+	Write batches of `(record number, item)` pairs. If some items can't be written 
+	the checkpoint is set to just before the first of them and the error is raised.
+	"""
+	first_failed = None
+	error = None
+	for (entity, history), numbered in batches.items():
+		try:
+			storage.create_many(entity, [item for _, item in numbered], versions=history)
+		except errors.BulkCreateError, e:
+			if e.failures and not e.indexes:
+				failed = range(len(numbered))
+			else:
+				failed = [i for i in e.indexes if not (skip_existing and i in e.existing)]
+			if failed:
+				first = min([numbered[i][0] for i in failed])
+				if first_failed is None or first < first_failed:
+					first_failed, error = first, e
+	if error:
+		write_checkpoint(checkpoint, first_failed - 1)
+		raise error
+		
+		
+def get_entity_for_type(entity, type_name):
+	if not type_name:
+		return entity
+	type_name = type_name.split('.')[-1]
+	for e in [entity] + entity.children:
+		if e.__name__ == type_name:
+			return e
+	raise errors.CompoundValidationError({'_type':"Unknown type '%s'" % type_name})
+	
+	
+def get_writer(stream, format):
+	if format == 'json':
+		encoder = CellarDoorJSONEncoder()
+		return lambda item: stream.write(encoder.encode(item) + '\n')
+	elif format == 'msgpack':
+		packer = msgpack.Packer(default=default_handler)
+		return lambda item: stream.write(packer.pack(item))
+	raise ValueError, "Unknown format '%s'" % format
+	
+	
+def get_reader(stream, format):
+	if format == 'json':
+		return (json.loads(line) for line in stream if line.strip())
+	elif format == 'msgpack':
+		return msgpack.Unpacker(stream)
+	raise ValueError, "Unknown format '%s'" % format
+	
+	
+def read_checkpoint(path):
+	if path and os.path.exists(path):
+		with open(path) as f:
+			return int(f.read().strip() or 0)
+	return 0
+	
+	
+def write_checkpoint(path, count):
+	if not path:
+		return
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as f:
+		f.write(str(count))
+	os.rename(tmp_path, path)
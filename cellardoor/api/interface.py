@@ -1,7 +1,14 @@
 from copy import deepcopy
+from functools import wraps
+from hashlib import md5
 import inspect
-from ..model import ListOf, InverseLink
+import json
+import re
+from ..model import ListOf, InverseLink, make_snapshot
+from ..serializers.json_serializer import CellarDoorJSONEncoder
 from ..events import EventManager
+from ..authorization import FilterCompilationError, and_filters
+from ..storage import freeze
 from .. import errors
 from .methods import *
 
@@ -11,6 +18,71 @@ __all__ = [
 ]
 
 
+def distinct_values(items, field):
+	"""Get the distinct values of a field in a list of items the way MongoDB does, flattening lists."""
+	values = []
+	for item in items:
+		value = item.get(field)
+		if value is None:
+			continue
+		for v in (value if isinstance(value, list) else [value]):
+			if v not in values:
+				values.append(v)
+	return values
+	
+	
+
+def content_etag(data):
+	"""Make an ETag from a hash of the content of an item."""
+	return '"%s"' % md5(json.dumps(data, sort_keys=True, cls=CellarDoorJSONEncoder)).hexdigest()
+	
+	
+def etag_matches(etag, etags):
+	"""Whether `etag` is one of the ETags from an If-None-Match or If-Match header."""
+	if not etags:
+		return False
+	if '*' in etags:
+		return True
+	strip = lambda x: x[2:] if x.startswith('W/') else x
+	return strip(etag) in [strip(x) for x in etags]
+	
+	
+	
+find_version_etag_pattern = re.compile(r'^(?:W/)?"(\d+)-([0-9a-f]{8})-[0-9a-f]{8}"$')
+
+
+def etag_version(etags, options_hash):
+	"""
+	Get the version from the version ETag in an If-Match header, or None if there 
+	isn't one. It has to have been made with the same options.
+	"""
+	for etag in etags:
+		found = find_version_etag_pattern.match(etag)
+		if found:
+			if found.group(2) != options_hash:
+				raise errors.PreconditionFailedError()
+			return int(found.group(1))
+	
+	
+	
+def routed(fn):
+	"""Send the storage calls made by an interface method to the partition for its context."""
+	@wraps(fn)
+	def wrapper(self, *args, **kwargs):
+		if 'context' not in kwargs:
+			return fn(self, *args, **kwargs)
+		with self.storage.routed(kwargs['context']):
+			return fn(self, *args, **kwargs)
+	return wrapper
+	
+	
+def get_link_ids(item, link_field):
+	if not item or item.get(link_field) is None:
+		return set()
+	value = item[link_field]
+	return set(value) if isinstance(value, list) else set([value])
+	
+	
 class RuleSet(object):
 	
 	def __init__(self, method_authorization):
@@ -18,6 +90,14 @@ class RuleSet(object):
 		self.item_rules = {}
 		self.non_item_rules = {}
 		
+		# The rules compiled to (function, uses identity) pairs
+		self.compiled_item_rules = {}
+		self.compiled_non_item_rules = {}
+		
+		# The links followed by the item rules, which are loaded for a 
+		# whole list at once
+		self.item_rule_links = {}
+		
 		if method_authorization:
 			for k,v in method_authorization.items():
 				if not isinstance(k, tuple):
@@ -27,54 +107,93 @@ class RuleSet(object):
 					if v is None:
 						continue
 					if v.uses('item'):
-						rules = self.item_rules
+						rules, compiled = self.item_rules, self.compiled_item_rules
 					else:
-						rules = self.non_item_rules
+						rules, compiled = self.non_item_rules, self.compiled_non_item_rules
 					if method not in rules:
 						rules[method] = []
+						compiled[method] = []
 					rules[method].append(v)
+					compiled[method].append((v.compile(), v.uses('identity')))
+					if rules is self.item_rules:
+						for link in v.link_proxies():
+							self.item_rule_links.setdefault(method, {})[link.prefetch_key] = link
 				
 				
 	def enforce_item_rules(self, method, item, context):
-		rules = self.item_rules.get(method)
+		rules = self.compiled_item_rules.get(method)
 		if rules:
 			if isinstance(item, list):
+				if not item:
+					return
+				# Rules see the item through a copy of the context, which may be shared
+				context = dict(context) if context else {}
+				self.check_identity(rules, context)
+				links = self.item_rule_links.get(method)
+				if links:
+					context['_prefetched'] = dict([(k, link.prefetch(item, context)) for k, link in links.items()])
 				for i in item:
-					self.enforce_rules(rules, i, context)
+					context['item'] = i
+					for rule, _ in rules:
+						if not rule(context):
+							raise errors.NotAuthorizedError()
 			else:
 				self.enforce_rules(rules, item, context)
 		
 		
+	def get_item_filter(self, method, context):
+		"""
+		Turn the item rules for `method` into a storage filter, or True if there are 
+		none. Raises FilterCompilationError if a rule can't be turned into a filter.
+		"""
+		context = context if context else {}
+		no_identity = 'identity' not in context
+		item_filter = True
+		for rule in self.item_rules.get(method, ()):
+			if no_identity and rule.uses('identity'):
+				raise errors.NotAuthenticatedError()
+			item_filter = and_filters(item_filter, rule.to_filter(context))
+		return item_filter
+		
+		
 	def enforce_non_item_rules(self, method, context):
-		rules = self.non_item_rules.get(method)
+		rules = self.compiled_non_item_rules.get(method)
 		if rules:
 			self.enforce_rules(rules, None, context)
 		
 		
 	def enforce_rules(self, rules, item, context):
-		context = context if context else {}
+		context = dict(context) if context else {}
 		context['item'] = item
-		no_identity = 'identity' not in context
-		for rule in rules:
-			if no_identity and rule.uses('identity'):
-				raise errors.NotAuthenticatedError()
+		self.check_identity(rules, context)
+		for rule, _ in rules:
 			if not rule(context):
 				raise errors.NotAuthorizedError()
 				
 				
+	def check_identity(self, rules, context):
+		if 'identity' not in context:
+			for _, uses_identity in rules:
+				if uses_identity:
+					raise errors.NotAuthenticatedError()
+				
+				
 				
 class OptionsFactory(object):
 	
 	
 	def __init__(self, storage=None,
+					   entity=None,
 					   hidden_fields=(), 
 					   hidden_field_authorization=None,
 					   enabled_filters=(), 
 					   enabled_sort=(), 
 					   default_sort=(), 
 					   default_limit=0, 
-					   max_limit=0):
+					   max_limit=0,
+					   max_embed_depth=1):
 		self.storage = storage
+		self.entity = entity
 		self.hidden_fields = set(hidden_fields)
 		self.hidden_field_authorization = hidden_field_authorization
 		self.enabled_filters = set(enabled_filters)
@@ -84,60 +203,111 @@ class OptionsFactory(object):
 		self.default_sort = default_sort
 		self.default_limit = default_limit
 		self.max_limit = max_limit
+		self.max_embed_depth = max_embed_depth
 		
 		self.enabled_filters.update(('_id', '_type'))
 		self.enabled_filters_no_hidden.update(('_id', '_type'))
 		
+		# Derived options, cached per embed list and per identity
+		self.embed_cache = {}
+		self.hidden_cache = {}
+		
 		
 	def create(self, options_dict, list=False):
-		copied_options_dict = deepcopy(options_dict)
 		if list:
-			return ListOptions( self.process_list(copied_options_dict) )
+			return self.process_list(options_dict, ListOptions(self))
 		else:
-			return BaseOptions( self.process(copied_options_dict) )
+			return self.process(options_dict, BaseOptions(self))
 			
 	
-	def process(self, options):
-		new_options = {}
-		new_options['embed'] = options.get('embed', None)
-		if new_options['embed']:
-			new_options['embed'] = set(new_options['embed'])
-		new_options['allow_embedding'] = options.get('allow_embedding', True)
-		new_options['fields'] = options.get('fields', None)
-		if new_options['fields']:
-			new_options['fields'] = set(new_options['fields'])
-		new_options['show_hidden'] = options.get('show_hidden', False)
-		new_options['context'] = options.get('context', {})
-		new_options['bypass_authorization'] = options.get('bypass_authorization', False)
-		
-		if new_options['bypass_authorization']:
-			new_options['can_show_hidden'] = True
+	def process(self, options, new_options):
+		embed = options.get('embed')
+		if embed:
+			new_options.embed, new_options.nested_embed = self.split_embed(embed)
 		else:
-			new_options['can_show_hidden'] = self.can_show_hidden(new_options['context'])
-		
+			new_options.embed, new_options.nested_embed = None, {}
+		new_options.allow_embedding = options.get('allow_embedding', True)
+		fields = options.get('fields')
+		new_options.fields = frozenset(fields) if fields is not None else None
+		new_options.show_hidden = options.get('show_hidden', False)
+		# Only the context dict is copied, so the items set on it don't leak 
+		# back to the caller. Nothing in it is changed.
+		new_options.context = dict(options['context']) if options.get('context') else {}
+		new_options.bypass_authorization = options.get('bypass_authorization', False)
 		return new_options
 			
 			
+	def split_embed(self, embed):
+		"""
+		Split embed paths like `author.avatar` into the links to embed at
+		this level and the paths to pass on to each of them. The result is 
+		shared by every request with the same embeds, so it mustn't be changed.
+		"""
+		key = frozenset(embed)
+		result = self.embed_cache.get(key)
+		if result is not None:
+			return result
+		links = set()
+		nested = {}
+		for path in key:
+			parts = path.split('.')
+			if len(parts) > self.max_embed_depth:
+				raise errors.DisabledFieldError('The "%s" embed is deeper than %d levels.' % (path, self.max_embed_depth))
+			links.add(parts[0])
+			if len(parts) > 1:
+				nested.setdefault(parts[0], []).append('.'.join(parts[1:]))
+		if len(self.embed_cache) > 1000:
+			# The keys come from requests, so don't let it grow forever
+			self.embed_cache.clear()
+		result = (frozenset(links), nested)
+		self.embed_cache[key] = result
+		return result
+		
+		
 	def can_show_hidden(self, context):
-		if self.hidden_field_authorization:
-			if self.hidden_field_authorization.uses('identity') and 'identity' not in context:
-				return False
-			elif not self.hidden_field_authorization(context):
-				return False
-		return True
+		rule = self.hidden_field_authorization
+		if not rule:
+			return True
+		if rule.uses('identity') and 'identity' not in context:
+			return False
+		key = self.hidden_cache_key(context)
+		if key is None:
+			return bool(rule(context))
+		result = self.hidden_cache.get(key)
+		if result is None:
+			result = bool(rule(context))
+			if len(self.hidden_cache) > 1000:
+				self.hidden_cache.clear()
+			self.hidden_cache[key] = result
+		return result
 		
 		
-	def process_list(self, options):
-		new_options = self.process(options)
-		new_options['filter'] = options.get('filter', None)
-		new_options['sort'] = options.get('sort', None)
-		new_options['sort'] = options['sort'] if options.get('sort') else self.default_sort
-		new_options['offset'] = options.get('offset', 0)
-		new_options['limit'] = options.get('limit', 0)
-		new_options['limit'] = new_options['limit'] if new_options['limit'] else self.default_limit
-		if not new_options['bypass_authorization']:
-			new_options['limit'] = min(new_options['limit'], self.max_limit)
-		new_options['count'] = options.get('count', False)
+	def hidden_cache_key(self, context):
+		"""
+		Get the key the hidden field authorization is cached under for a context, 
+		or None if it can't be cached because the rule uses more than the identity.
+		"""
+		rule = self.hidden_field_authorization
+		for k in context:
+			if k != 'identity' and rule.uses(k):
+				return None
+		try:
+			return freeze(context.get('identity'))
+		except TypeError:
+			return None
+		
+		
+	def process_list(self, options, new_options):
+		self.process(options, new_options)
+		# Storage and filter checks change the filter in place
+		filter = options.get('filter')
+		new_options.filter = deepcopy(filter) if filter else filter
+		new_options.sort = options['sort'] if options.get('sort') else self.default_sort
+		new_options.offset = options.get('offset', 0)
+		new_options.limit = options.get('limit', 0) or self.default_limit
+		if not new_options.bypass_authorization:
+			new_options.limit = min(new_options.limit, self.max_limit)
+		new_options.count = options.get('count', False)
 		
 		self.check_filter(new_options)
 		self.check_sort(new_options)
@@ -157,9 +327,35 @@ class OptionsFactory(object):
 		self.storage.check_filter(options['filter'], allowed_fields, options['context'])
 		
 		
+	def check_query(self, options):
+		"""
+		Let the storage reject or limit a filter and sort it can't run efficiently. 
+		This is called with the filter the query is run with, including the 
+		filters added for links and rules.
+		"""
+		if options['bypass_authorization']:
+			return
+		limit = self.storage.check_query(self.entity, 
+			filter=options['filter'], sort=options['sort'], limit=options['limit'])
+		if not options['count']:
+			options['limit'] = limit
+		
+		
+	def check_distinct(self, field, options):
+		if options['can_show_hidden']:
+			allowed_fields = self.enabled_filters
+		else:
+			allowed_fields = self.enabled_filters_no_hidden
+		if field not in allowed_fields:
+			raise errors.DisabledFieldError('The "%s" field cannot be used for distinct values.' % field)
+		
+		
 	def check_sort(self, options):
 		if not options['sort'] or options['bypass_authorization']:
 			return
+		# Items can always be sorted by id, it's how lists are paged through
+		if all([k[1:] == '_id' for k in options['sort']]):
+			return
 		if not self.enabled_sort:
 			raise errors.CompoundValidationError({'sort':'Sorting is disabled.'})
 		if options['can_show_hidden']:
@@ -175,61 +371,58 @@ class OptionsFactory(object):
 
 class BaseOptions(object):
 	
-	def __init__(self, options):
-		self._options = options
-		self._embed_by_class = {}
+	__slots__ = ('factory', 'embed', 'nested_embed', 'allow_embedding', 'fields', 'show_hidden', 
+				 'context', 'bypass_authorization', '_can_show_hidden', '_types')
+	
+	def __init__(self, factory):
+		self.factory = factory
+		self._can_show_hidden = None
+		self._types = {}
 		
 		
 	def __getitem__(self, key):
-		return self._options[key]
+		return getattr(self, key)
 		
 		
-	def __getattr__(self, key):
-		return self.__getitem__(key)
+	def __setitem__(self, key, value):
+		setattr(self, key, value)
 		
 		
-	def __deepcopy__(self, memo):
-		options = BaseOptions(deepcopy(self._options, memo))
-		options._embed_by_class = deepcopy(self._embed_by_class, memo)
+	@property
+	def can_show_hidden(self):
+		if self._can_show_hidden is None:
+			self._can_show_hidden = self.bypass_authorization or self.factory.can_show_hidden(self.context)
+		return self._can_show_hidden
 		
 		
-	def get_embed_for_type(self, base_entity, type):
-		type = type.split('.')[-1]
-		
-		if type in self._embed_by_class:
-			return self._embed_by_class[type]
-		
-		entity = None
-		
-		if type == base_entity.__name__:
-			entity = base_entity
-		else:
-			for c in base_entity.children:
-				if c.__name__ == type:
-					entity = c
-					break
+	def get_type(self, base_entity, type):
+		"""Get the entity, the links to embed and the shaper for an item's `_type`"""
+		if type in self._types:
+			return self._types[type]
 		
+		entity = base_entity.types_by_name.get(type.split('.')[-1])
 		if entity is None:
 			raise Exception, "Can't find the entity for '%s'" % type
 		
-		if self._options['embed']:
-			embed = self._options['embed'].intersection(entity.embeddable)
-		else:
-			embed = entity.embed_by_default
-		
-		if self._options['fields']:
-			embed.update( entity.embeddable.intersection( self._options['fields'] ) )
+		hide_hidden = not self.show_hidden or not self.can_show_hidden
+		result = (
+			entity,
+			entity.get_embed(self.embed, self.fields, hide_hidden=hide_hidden),
+			entity.get_shaper(self.fields, hide_hidden=hide_hidden)
+		)
+		self._types[type] = result
+		return result
 		
-		if not self._options['show_hidden'] or not self._options['can_show_hidden']:
-			embed.difference_update(entity.hidden_fields)
 		
-		self._embed_by_class[type] = (entity, embed)
+	def get_embed_for_type(self, base_entity, type):
+		entity, embed, _ = self.get_type(base_entity, type)
 		return entity, embed
 		
 		
 		
 class ListOptions(BaseOptions):
-	pass
+	
+	__slots__ = ('filter', 'sort', 'offset', 'limit', 'count')
 
 
 
@@ -270,8 +463,18 @@ class InterfaceType(type):
 		cls.singular_name = singular_name
 		cls.plural_name = plural_name
 		cls.hooks = EventManager('create', 'update', 'delete')
+		cls.hooks.storage = storage
 		cls.rules = RuleSet(members.get('method_authorization'))
 		cls.storage = storage
+		cls.distinct_cache = {}
+		cls.entity_names = frozenset([e.__name__ for e in [entity] + entity.children])
+		
+		if members.get('cache_distinct'):
+			clear_cache = lambda *args, **kwargs: cls.distinct_cache.clear()
+			for e in [entity] + entity.children:
+				e.hooks.after_create(clear_cache)
+				e.hooks.after_update(clear_cache)
+				e.hooks.after_delete(clear_cache)
 		
 		hidden_fields = set(entity.hidden_fields.copy())
 		for c in entity.children:
@@ -279,13 +482,15 @@ class InterfaceType(type):
 		
 		cls.options_factory = OptionsFactory(
 			storage=storage,
+			entity=entity,
 		    hidden_fields=hidden_fields, 
 		    hidden_field_authorization=members.get('hidden_field_authorization'),
 		    enabled_filters=members.get('enabled_filters', ()),
 		    enabled_sort=members.get('enabled_sort', ()),
 		    default_sort=members.get('default_sort', ()),
 		    default_limit=members.get('default_limit', 0),
-		    max_limit=members.get('max_limit', 100)
+		    max_limit=members.get('max_limit', 100),
+		    max_embed_depth=members.get('max_embed_depth', 3)
 		)
 		
 		cls.api.add_interface(cls)
@@ -320,24 +525,43 @@ class Interface(object):
 	default_limit = 0
 	max_limit = 100
 	
+	# The number of levels of links that can be embedded with dotted paths 
+	# like `author.avatar` in the `embed` option.
+	max_embed_depth = 3
+	
+	# Set to True to cache the results of `distinct` until an item of this
+	# interface's entity is created, updated or deleted. Writes from other 
+	# processes clear it too if the API has a change feed.
+	cache_distinct = False
+	
 	
 	def __init__(self):
+		self.linked_interfaces = {}
 		for method in ALL:
 			if method not in self.rules.enabled_methods:
 				setattr(self, method, self.disabled_method_error)
+		if GET not in self.rules.enabled_methods:
+			self.get_many = self.disabled_method_error
+		if LIST not in self.rules.enabled_methods:
+			self.distinct = self.disabled_method_error
 			
 			
 	def set_storage(self, storage):
 		self.storage = storage
 		self.options_factory.storage = storage
+		self.hooks.storage = storage
 			
 			
+	@routed
 	def list(self, **kwargs):
 		options = self.options_factory.create(kwargs, list=True)
 		
 		if not options['bypass_authorization']:
 			self.rules.enforce_non_item_rules(LIST, options['context'])
 		
+		filtered = self.add_item_filter(LIST, options)
+		self.options_factory.check_query(options)
+		
 		result = self.storage.get(self.entity, 
 							filter=options.filter, sort=options.sort, 
 							offset=options.offset, limit=options.limit,
@@ -346,12 +570,58 @@ class Interface(object):
 		if options.count:
 			return result
 		
-		if not options.bypass_authorization:
+		if not filtered:
 			self.rules.enforce_item_rules(LIST, result, options.context)
 				
 		return self.post(LIST, options, result)
 		
 		
+	@routed
+	def distinct(self, field, **kwargs):
+		"""Get the distinct values of a field among the items that match `filter`."""
+		options = self.options_factory.create(kwargs, list=True)
+		
+		if not options.bypass_authorization:
+			self.rules.enforce_non_item_rules(LIST, options.context)
+			self.options_factory.check_distinct(field, options)
+		
+		if not self.add_item_filter(LIST, options):
+			# The items have to be checked one by one so we can't let storage do the work
+			items = self.storage.get(self.entity, filter=options.filter)
+			self.rules.enforce_item_rules(LIST, items, options.context)
+			return distinct_values(items, field)
+		
+		if not self.cache_distinct:
+			return self.storage.distinct(self.entity, field, filter=options.filter)
+		
+		# Each route has its own data, so values are cached per route
+		key = (self.storage.get_route(), field, json.dumps(options.filter, sort_keys=True, default=str))
+		values = self.distinct_cache.get(key)
+		if values is None:
+			values = self.storage.distinct(self.entity, field, filter=options.filter)
+			if len(self.distinct_cache) > 1000:
+				# The keys include filters from requests, so don't let it grow forever
+				self.distinct_cache.clear()
+			self.distinct_cache[key] = values
+		return list(values)
+		
+		
+	def invalidate(self, entity_name, id, route):
+		"""
+		Forget the cached distinct values for a write to `entity_name` passed on by 
+		a `ChangeFeed`. A route of None means any route.
+		"""
+		if entity_name not in self.entity_names:
+			return
+		if route is None:
+			self.distinct_cache.clear()
+			return
+		for key in self.distinct_cache.keys():
+			if key[0] == route:
+				self.distinct_cache.pop(key, None)
+		
+		
+	@routed
 	def create(self, fields, **kwargs):
 		options = self.options_factory.create(kwargs)
 		
@@ -362,7 +632,9 @@ class Interface(object):
 		self.hooks.fire_before_create(fields, options.context)
 		
 		item = self.entity.validator.validate(fields)
+		self.add_snapshots(item)
 		item['_id'] = self.storage.create(self.entity, item)
+		self.update_counters(None, item)
 		
 		if not options.bypass_authorization:
 			self.rules.enforce_item_rules(CREATE, item, options.context)
@@ -375,23 +647,125 @@ class Interface(object):
 		return item
 		
 		
+	@routed
 	def get(self, id, **kwargs):
+		item, _ = self._get(id, kwargs)
+		return item
+		
+		
+	@routed
+	def get_with_etag(self, id, if_none_match=None, **kwargs):
+		"""
+		Get an item and its ETag. Raises `NotModifiedError` if the ETag is one of
+		`if_none_match`. For versioned entities this is checked before the item
+		is prepared, unless it has links to embed.
+		"""
+		return self._get(id, kwargs, with_etag=True, if_none_match=if_none_match)
+		
+		
+	def _get(self, id, kwargs, with_etag=False, if_none_match=None):
 		options = self.options_factory.create(kwargs)
 		
 		if not options.bypass_authorization:
 			self.rules.enforce_non_item_rules(GET, options.context)
 		
-		item = self.storage.get_by_id(self.entity, id)
+		item = self.load_item(id, options.context)
 		if item is None:
 			raise errors.NotFoundError("No %s with id '%s' was found" % (self.singular_name, id))
 		
 		if not options.bypass_authorization:
 			self.rules.enforce_item_rules(GET, item, options.context)
 		
-		return self.post(GET, options, item)
+		etag = None
+		if with_etag:
+			etag = self.version_etag(item, options)
+			if etag and etag_matches(etag, if_none_match):
+				raise errors.NotModifiedError(etag)
+		
+		result = self.post(GET, options, item)
+		
+		if with_etag and etag is None:
+			etag = content_etag(result)
+			if etag_matches(etag, if_none_match):
+				raise errors.NotModifiedError(etag)
+		return result, etag
+		
+		
+	def get_match(self, id, if_match, options, current_item=None):
+		"""
+		Turn the ETags of an If-Match header into the field values storage has 
+		to find for a conditional write. For a version ETag of a versioned entity 
+		that's just the version, which storage checks as it writes, so nothing is 
+		read. The part of the ETag that depends on the id and options is checked 
+		here. Otherwise the stored item is read and its ETag checked, and the write only 
+		goes ahead if the item still has exactly the values read. Returns the 
+		match and the stored item, if it had to be read.
+		"""
+		if self.entity.versioned and '*' not in if_match:
+			version = etag_version(if_match, self.options_hash(id, options))
+			if version is not None:
+				return {'_version':version}, current_item
+		if current_item is None:
+			current_item = self.get_current_item(id)
+		if '*' in if_match:
+			return None, current_item
+		if not etag_matches(self.item_etag(current_item, options), if_match):
+			raise errors.PreconditionFailedError()
+		return current_item, current_item
+		
+		
+	def item_etag(self, item, options):
+		"""The ETag a GET with the same options would send for a stored item"""
+		return self.version_etag(item, options) or content_etag(self.post(GET, options, deepcopy(item)))
+		
+		
+	def version_etag(self, item, options):
+		"""
+		Make an ETag from an item's version, a hash of the options that change how 
+		it's shown and a hash of the counters and copies of linked items, which 
+		change without a new version. Returns None if the item isn't versioned 
+		or has links to embed.
+		"""
+		entity, embed, _ = options.get_type(self.entity, item.get('_type', self.entity.__name__))
+		if not entity.versioned or '_version' not in item or (embed and options.allow_embedding):
+			return None
+		counters = [item.get(x) for x in sorted(entity.counter_fields)]
+		key = json.dumps([counters, item.get('_snapshots')], sort_keys=True, cls=CellarDoorJSONEncoder)
+		return '"%s-%s-%s"' % (item['_version'], self.options_hash(item['_id'], options), md5(key).hexdigest()[:8])
+		
+		
+	def options_hash(self, id, options):
+		"""Hash the options that change how an item is shown, for its version ETag"""
+		fields = sorted(options.fields) if options.fields is not None else None
+		hide_hidden = not options.show_hidden or not options.can_show_hidden
+		return md5(json.dumps([id, fields, hide_hidden], cls=CellarDoorJSONEncoder)).hexdigest()[:8]
 		
 		
-	def update(self, id, fields, _replace=False, _method=UPDATE, **kwargs):
+	@routed
+	def get_many(self, ids, **kwargs):
+		"""
+		Get several items by ID with one storage query. The results are in the same
+		order as `ids` with None in place of any item that wasn't found.
+		"""
+		options = self.options_factory.create(kwargs)
+		
+		if not options.bypass_authorization:
+			self.rules.enforce_non_item_rules(GET, options.context)
+			max_limit = self.options_factory.max_limit
+			if max_limit and len(ids) > max_limit:
+				raise errors.CompoundValidationError({'ids':'No more than %d items can be fetched at once.' % max_limit})
+		
+		items = self.storage.get_by_ids(self.entity, ids)
+		
+		if not options.bypass_authorization:
+			self.rules.enforce_item_rules(GET, items, options.context)
+		
+		items_by_id = dict([(item['_id'], item) for item in self.post(LIST, options, items)])
+		return [items_by_id.get(id) for id in ids]
+		
+		
+	@routed
+	def update(self, id, fields, _replace=False, _method=UPDATE, if_match=None, **kwargs):
 		options = self.options_factory.create(kwargs)
 		
 		if not options.bypass_authorization:
@@ -400,20 +774,39 @@ class Interface(object):
 		self.entity.hooks.fire_before_update(id, fields, options.context)
 		self.hooks.fire_before_update(id, fields, options.context)
 		
+		current_item = None
+		
 		if not options.bypass_authorization and UPDATE in self.rules.item_rules:
-			item = self.storage.get_by_id(self.entity, id)
-			if item is None:
-				raise errors.NotFoundError("No %s with id '%s' was found" % (self.singular_name, id))
-			self.rules.enforce_item_rules(_method, item, options.context)
+			current_item = self.get_current_item(id)
+			self.rules.enforce_item_rules(_method, current_item, options.context)
+		
+		match = None
+		if if_match:
+			match, current_item = self.get_match(id, if_match, options, current_item)
 		
 		version = fields.pop('_version', None)
 		fields = self.entity.validator.validate(fields, enforce_required=_replace)
 		if version:
 			fields['_version'] = version
-		item = self.storage.update(self.entity, id, fields, replace=_replace)
+		self.add_snapshots(fields, nested=_replace)
+			
+		if current_item is None and self.needs_current_item(fields, _replace):
+			current_item = self.get_current_item(id)
+		if _replace:
+			for k in self.entity.counter_fields:
+				if k in current_item:
+					fields[k] = current_item[k]
+			
+		if match:
+			item = self.storage.update(self.entity, id, fields, replace=_replace, match=match)
+		else:
+			item = self.storage.update(self.entity, id, fields, replace=_replace)
+		self.forget_item(id, options.context)
 		if item is None:
 			raise errors.NotFoundError("No %s with id '%s' was found" % (self.singular_name, id))
 		
+		if current_item is not None:
+			self.update_counters(current_item, item)
 		item = self.post(_method, options, item)
 		
 		self.entity.hooks.fire_after_update(item, options.context)
@@ -422,11 +815,13 @@ class Interface(object):
 		return item
 		
 		
+	@routed
 	def replace(self, id, fields, **kwargs):
 		return self.update(id, fields, _replace=True, _method=REPLACE, **kwargs)
 		
 		
-	def delete(self, id, **kwargs):
+	@routed
+	def delete(self, id, if_match=None, **kwargs):
 		options = self.options_factory.create(kwargs)
 		
 		if not options.bypass_authorization:
@@ -439,10 +834,19 @@ class Interface(object):
 		if not options.bypass_authorization:
 			self.rules.enforce_item_rules(DELETE, item, options.context)
 		
+		match = None
+		if if_match:
+			match, _ = self.get_match(id, if_match, options, item)
+		
 		self.entity.hooks.fire_before_delete(id, options.context)
 		self.hooks.fire_before_delete(id, options.context)
 		
-		self.storage.delete(self.entity, id)
+		if match:
+			self.storage.delete(self.entity, id, match=match)
+		else:
+			self.storage.delete(self.entity, id)
+		self.forget_item(id, options.context)
+		self.update_counters(item, None)
 		self.post(DELETE, options)
 		
 		options.context['item'] = item
@@ -450,13 +854,104 @@ class Interface(object):
 		self.hooks.fire_after_delete(id, options.context)
 		
 		
+	def add_item_filter(self, method, options):
+		"""
+		Add the item rules for `method` to the filter in `options` so storage only
+		returns the items they allow. Returns False if the rules have to be checked
+		item by item instead.
+		"""
+		if options.bypass_authorization:
+			return True
+		try:
+			item_filter = self.rules.get_item_filter(method, options.context)
+		except FilterCompilationError:
+			return False
+		if item_filter is True:
+			return True
+		if item_filter is False:
+			# Nothing is allowed
+			item_filter = {'_id':{'$in':[]}}
+		options.filter = and_filters(options.filter, item_filter) if options.filter else item_filter
+		return True
+		
+		
+	def load_item(self, id, context):
+		"""
+		Get an item from storage. When the context has an `identity_map`, shared
+		by the operations of a batch request, each item is only fetched once.
+		"""
+		identity_map = context.get('identity_map')
+		if identity_map is None:
+			return self.storage.get_by_id(self.entity, id)
+		key = (self.entity.__name__, id)
+		if key not in identity_map:
+			identity_map[key] = self.storage.get_by_id(self.entity, id)
+		item = identity_map[key]
+		# Items are changed as they're prepared for output
+		return dict(item) if item is not None else None
+		
+		
+	def forget_item(self, id, context):
+		identity_map = context.get('identity_map')
+		if identity_map is not None:
+			identity_map.pop((self.entity.__name__, id), None)
+		
+		
+	def get_current_item(self, id):
+		item = self.storage.get_by_id(self.entity, id)
+		if item is None:
+			raise errors.NotFoundError("No %s with id '%s' was found" % (self.singular_name, id))
+		return item
+		
+		
+	def needs_current_item(self, fields, replace):
+		"""Whether an update needs the stored item to keep counters correct."""
+		if replace:
+			return bool(self.entity.counters or self.entity.counter_fields)
+		for link_field, _, _ in self.entity.counters:
+			if link_field in fields:
+				return True
+		return False
+		
+		
+	def update_counters(self, old_item, new_item):
+		"""Adjust the counters of inverse links pointing at the links that changed."""
+		for link_field, entity, counter_field in self.entity.counters:
+			old_ids = get_link_ids(old_item, link_field)
+			new_ids = get_link_ids(new_item, link_field)
+			for id in new_ids.difference(old_ids):
+				self.storage.increment(entity, id, counter_field, 1)
+			for id in old_ids.difference(new_ids):
+				self.storage.increment(entity, id, counter_field, -1)
+		
+		
+	def add_snapshots(self, fields, nested=True):
+		"""
+		Store copies of the items that denormalized links in `fields` point to.
+		When `nested` is False the copies are set with dotted keys so a partial
+		update leaves the other links' copies alone.
+		"""
+		for link_name in self.entity.denormalized:
+			if link_name not in fields:
+				continue
+			link = self.entity.links[link_name]
+			ids = list(get_link_ids(fields, link_name))
+			targets = link.storage.get_by_ids(link.entity, ids) if ids else []
+			snapshots = dict([(t['_id'], make_snapshot(link, t)) for t in targets])
+			if nested:
+				fields.setdefault('_snapshots', {})[link_name] = snapshots
+			else:
+				fields['_snapshots.%s' % link_name] = snapshots
+		
+		
+	@routed
 	def link(self, id, link_name, **kwargs):
 		options = self.options_factory.create(kwargs)
 		
 		if not options.bypass_authorization:
 			self.rules.enforce_non_item_rules(GET, options.context)
 		
-		item = self.storage.get_by_id(self.entity, id)
+		item = self.load_item(id, options.context)
 		if item is None:
 			raise errors.NotFoundError("No %s with id '%s' was found" % (self.singular_name, id))
 		
@@ -481,6 +976,54 @@ class Interface(object):
 			return self._resolve_link(source_item, link_name, link_field, options)
 		
 		
+	def resolve_snapshot(self, source_item, link_name, link_field, snapshots, options):
+		"""
+		Get the item(s) pointed to by a denormalized link from the copies stored 
+		on the source item, falling back to a lookup when a copy can't be used.
+		"""
+		if not self.can_use_snapshots(source_item, link_name, link_field, snapshots):
+			return self.resolve_link(source_item, link_name, link_field, options)
+		method = LIST if isinstance(link_field, ListOf) else GET
+		if not get_link_ids(source_item, link_name):
+			return None
+		
+		options = self.options_factory.create(options, list=True)
+		if not options.bypass_authorization:
+			self.rules.enforce_non_item_rules(method, options.context)
+		
+		if method == LIST:
+			return self.post(LIST, options, [dict(snapshots[id]) for id in source_item[link_name]])
+		else:
+			return self.post(GET, options, dict(snapshots[source_item[link_name]]))
+		
+		
+	def can_use_snapshots(self, source_item, link_name, link_field, snapshots):
+		"""Whether the copies stored on an item can stand in for its linked items"""
+		method = LIST if isinstance(link_field, ListOf) else GET
+		if method in self.rules.item_rules:
+			return False
+		# Copies of deleted items are cleared to None
+		return all([snapshots.get(id) is not None for id in get_link_ids(source_item, link_name)])
+		
+		
+	def resolve_links(self, source_items, link_name, link_field, options):
+		"""
+		Get the item(s) pointed to by a link for each of `source_items`, 
+		loading the linked items of all of them with a single query.
+		"""
+		if len(source_items) > 1 and not options.get('count'):
+			list_options = self.options_factory.create(options, list=True)
+			if isinstance(link_field, InverseLink):
+				results = self._resolve_inverse_links(source_items, link_field, list_options)
+			else:
+				results = self._resolve_links(source_items, link_name, link_field, list_options)
+			if results is not None:
+				return results
+		
+		# Counts, and lists that may be longer than the limit, are done per source
+		return [self.resolve_link(item, link_name, link_field, options) for item in source_items]
+		
+		
 	def _resolve_inverse_link(self, source_item, link_field, options):
 		"""
 		Get the items for a single or multiple link
@@ -490,13 +1033,16 @@ class Interface(object):
 		
 		if link_field.multiple:
 			self.rules.enforce_non_item_rules(LIST, options.context)
+			filtered = self.add_item_filter(LIST, options)
+			self.options_factory.check_query(options)
 			result = self.storage.get(self.entity, 
 							filter=options.filter, sort=options.sort, 
 							offset=options.offset, limit=options.limit,
 							count=options.count)
 			if options.count:
 				return result
-			self.rules.enforce_item_rules(LIST, result, options.context)
+			if not filtered:
+				self.rules.enforce_item_rules(LIST, result, options.context)
 			return self.post(LIST, options, result)
 		else:
 			try:
@@ -519,103 +1065,219 @@ class Interface(object):
 		if isinstance(link_field, ListOf):
 			if not options.bypass_authorization:
 				self.rules.enforce_non_item_rules(LIST, options.context)
+			filtered = self.add_item_filter(LIST, options)
 			result = self.storage.get_by_ids(self.entity, link_value,
 								filter=options.filter, sort=options.sort, 
 								offset=options.offset, limit=options.limit,
 								count=options.count)
 			if options.count:
 				return result
-			if not options.bypass_authorization:
+			if not filtered:
 				self.rules.enforce_item_rules(LIST, result, options.context)
 			return self.post(LIST, options, result)
 		else:
 			self.rules.enforce_non_item_rules(GET, options.context)
-			item = self.storage.get_by_id(self.entity, link_value)
+			item = self.load_item(link_value, options.context)
 			self.rules.enforce_item_rules(GET, item, options.context)
 			return self.post(GET, options, item)
 			
 			
+	def _resolve_inverse_links(self, source_items, link_field, options):
+		"""
+		Get the items for a single or multiple inverse link of several items, 
+		or None if a page of them can't be loaded with a single query.
+		"""
+		source_ids = [item['_id'] for item in source_items]
+		options.filter = options.filter if options.filter else {}
+		options.filter[link_field.field] = {'$in':source_ids}
+		method = LIST if link_field.multiple else GET
+		
+		if not options.bypass_authorization:
+			self.rules.enforce_non_item_rules(method, options.context)
+		filtered = link_field.multiple and self.add_item_filter(LIST, options)
+		if link_field.multiple:
+			self.options_factory.check_query(options)
+		if link_field.multiple and options.limit:
+			# If the query returns as many items as all the pages together, 
+			# some source may have more and they're paged one by one
+			limit = (options.offset + options.limit) * len(source_items)
+			result = list(self.storage.get(self.entity, filter=options.filter, sort=options.sort, limit=limit))
+			if len(result) >= limit:
+				return None
+		else:
+			result = list(self.storage.get(self.entity, filter=options.filter, sort=options.sort))
+		
+		# Match the linked items to their source before post removes the link field
+		source_ids_by_index = [get_link_ids(item, link_field.field) for item in result]
+		
+		if not link_field.multiple:
+			first = {}
+			for i, ids in enumerate(source_ids_by_index):
+				for id in ids:
+					first.setdefault(id, i)
+			result = [result[i] for i in sorted(set(first.values()))]
+			source_ids_by_index = [get_link_ids(item, link_field.field) for item in result]
+			if not options.bypass_authorization:
+				for item in result:
+					self.rules.enforce_item_rules(GET, item, options.context)
+		elif not filtered:
+			self.rules.enforce_item_rules(LIST, result, options.context)
+		
+		result = self.post(LIST, options, result)
+		
+		by_source = {}
+		for item, ids in zip(result, source_ids_by_index):
+			for id in ids:
+				by_source.setdefault(id, []).append(item)
+		
+		if link_field.multiple:
+			return [self.page(by_source.get(id, []), options) for id in source_ids]
+		return [by_source[id][0] if id in by_source else None for id in source_ids]
+		
+		
+	def _resolve_links(self, source_items, link_name, link_field, options):
+		"""
+		Get the items for a single or multiple link of several items, or None 
+		if a page of them can't be loaded with a single query.
+		"""
+		ids = set()
+		for item in source_items:
+			item_ids = get_link_ids(item, link_name)
+			if isinstance(link_field, ListOf) and options.limit and len(item_ids) > options.offset + options.limit:
+				return None
+			ids.update(item_ids)
+		if not ids:
+			return [None] * len(source_items)
+		
+		if isinstance(link_field, ListOf):
+			if not options.bypass_authorization:
+				self.rules.enforce_non_item_rules(LIST, options.context)
+			filtered = self.add_item_filter(LIST, options)
+			result = list(self.storage.get_by_ids(self.entity, list(ids),
+								filter=options.filter, sort=options.sort))
+			if not filtered:
+				self.rules.enforce_item_rules(LIST, result, options.context)
+		else:
+			if not options.bypass_authorization:
+				self.rules.enforce_non_item_rules(GET, options.context)
+			result = list(self.storage.get_by_ids(self.entity, list(ids)))
+			if not options.bypass_authorization:
+				for item in result:
+					self.rules.enforce_item_rules(GET, item, options.context)
+		
+		# Keep the order storage returned the items in
+		positions = dict([(item['_id'], i) for i, item in enumerate(result)])
+		result = self.post(LIST, options, result)
+		
+		results = []
+		for item in source_items:
+			value = item.get(link_name)
+			if value is None:
+				results.append(None)
+			elif isinstance(link_field, ListOf):
+				found = sorted([positions[id] for id in set(value) if id in positions])
+				results.append(self.page([result[i] for i in found], options))
+			else:
+				results.append(result[positions[value]] if value in positions else None)
+		return results
+		
+		
+	def page(self, items, options):
+		"""Apply the offset and limit of `options` to items fetched for several sources at once"""
+		if options.limit:
+			return items[options.offset:options.offset + options.limit]
+		return items[options.offset:]
+		
+		
 	def get_linked_interface(self, link_name):
-		link = None
-		entities = [self.entity] + self.entity.children
-		for entity in entities:
-			link = entity.get_link(link_name)
-			if link:
-				break
+		if link_name in self.linked_interfaces:
+			return self.linked_interfaces[link_name]
+		
+		link = self.entity.all_links.get(link_name)
 		if not link:
 			raise Exception, "Entity '%s' nor its children have a link called '%s'" % (self.entity.__name__, link_name)
-			
-		if isinstance(link, ListOf):
-			linked_entity = link.field.entity
-		else:
-			linked_entity = link.entity
-		return self.api.get_interface_for_entity(linked_entity)
+		
+		interface = self.api.get_interface_for_entity(link.entity)
+		self.linked_interfaces[link_name] = interface
+		return interface
 		
 		
 	def prepare_item(self, item, options):
-		self.remove_hidden_fields(item, options)
-		self.add_embedded_links(item, options)
-		return item
+		entity, embed, shape = options.get_type(self.entity, item.get('_type', self.entity.__name__))
+		return shape(item)
 		
 		
-	def remove_hidden_fields(self, item, options):
-		if not options.show_hidden or not options.can_show_hidden:
-			for k in self.entity.hidden_fields:
-				item.pop(k, None)
-		if options.fields is not None:
-			for k in item.keys():
-				if k not in options.fields and not k.startswith('_'):
-					item.pop(k, None)
-			
-		
-	def add_embedded_links(self, item, options):
-		"""Add embedded links and links to an item"""
+	def add_embedded_links(self, items, options, snapshots):
+		"""
+		Add embedded links to a batch of items. Each link is loaded once for 
+		the whole batch and the linked interface embeds the next level of 
+		links the same way, so deeper levels are also loaded in batches.
+		"""
 		if not options.allow_embedding:
 			return
 		
-		entity, embed = options.get_embed_for_type(self.entity, item.get('_type', self.entity.__name__))
+		batches = {}
+		for item, item_snapshots in zip(items, snapshots):
+			entity, embed = options.get_embed_for_type(self.entity, item.get('_type', self.entity.__name__))
+			for link_name in embed:
+				key = (link_name, getattr(entity, link_name))
+				batches.setdefault(key, []).append((item, item_snapshots))
 		
-		for link_name in embed:
+		for (link_name, link_field), batch in batches.items():
 			linked_interface = self.get_linked_interface(link_name)
 			if not linked_interface:
 				raise Exception, "No link defined in '%s' interface for embedded link '%s'" % (self.plural_name, link_name)
 			
-			link_field = getattr(entity, link_name)
-			
+			nested_embed = options.nested_embed.get(link_name)
 			link_options = {
 				'context': options.context,
-				'allow_embedding': False,
+				'allow_embedding': bool(nested_embed),
 				'show_hidden': options.show_hidden
 			}
 			
 			embedded_fields = link_field.field.embedded_fields if isinstance(link_field, ListOf) else link_field.embedded_fields
 			if embedded_fields:
 				link_options['fields'] = embedded_fields
+			if nested_embed:
+				link_options['embed'] = nested_embed
+				if embedded_fields:
+					link_options['fields'] = set(embedded_fields).union([x.split('.')[0] for x in nested_embed])
 			
-			result = linked_interface.resolve_link(item, link_name, link_field, link_options)
+			results = [None] * len(batch)
+			pending = []
+			for i, (item, item_snapshots) in enumerate(batch):
+				link_snapshots = item_snapshots.get(link_name) if item_snapshots and not nested_embed else None
+				if link_snapshots is not None and linked_interface.can_use_snapshots(item, link_name, link_field, link_snapshots):
+					results[i] = linked_interface.resolve_snapshot(item, link_name, link_field, link_snapshots, link_options)
+				else:
+					pending.append(i)
 			
-			if result:
-				item[link_name] = result
-				
-		return item
+			if pending:
+				resolved = linked_interface.resolve_links([batch[i][0] for i in pending], link_name, link_field, link_options)
+				for i, result in zip(pending, resolved):
+					results[i] = result
+			
+			for (item, _), result in zip(batch, results):
+				if result:
+					item[link_name] = result
 		
 		
 	def post(self, method, options, result=None):
 		"""Perform post-method hooks including authentication that requires fetched items."""
 		if result is None:
 			return
-			
+		
+		items = list(result) if method == LIST else [result]
+		snapshots = [item.pop('_snapshots', None) for item in items]
+		items = [self.prepare_item(item, options) for item in items]
+		self.add_embedded_links(items, options, snapshots)
+		
 		if method == LIST:
-			new_results = []
-			for item in result:
-				new_results.append(
-					self.prepare_item(item, options)
-				)
-			options.context['item'] = result
-			return new_results
+			options.context['item'] = items
+			return items
 		else:
-			options.context['item'] = result
-			return self.prepare_item(result, options)
+			options.context['item'] = items[0]
+			return items[0]
 		
 		
 	def disabled_method_error(self, *args, **kwargs):
@@ -1,6 +1,40 @@
 from functools import partial
 
 
+class FilterCompilationError(Exception):
+	"""Raised when an expression can't be turned into a storage filter."""
+	pass
+	
+	
+def is_item_value(value):
+	"""Whether `value` is a field of the item being authorized, e.g. `item.owner`"""
+	return isinstance(value, ObjectProxyValue) \
+		and isinstance(value._proxy, ObjectProxy) \
+		and not isinstance(value._proxy, LinkProxy) \
+		and value._proxy._name == 'item'
+	
+	
+def and_filters(a, b):
+	if a is False or b is False:
+		return False
+	if a is True:
+		return b
+	if b is True:
+		return a
+	return {'$and':[a, b]}
+	
+	
+def or_filters(a, b):
+	if a is True or b is True:
+		return True
+	if a is False:
+		return b
+	if b is False:
+		return a
+	return {'$or':[a, b]}
+	
+	
+
 class AuthenticationExpression(object):
 	
 	def __call__(self, context):
@@ -32,6 +66,26 @@ class AuthenticationExpression(object):
 			
 	def uses(self, key):
 		raise NotImplementedError
+		
+		
+	def compile(self):
+		"""Get a function of the context that gives the same result as calling this expression."""
+		return self
+		
+		
+	def link_proxies(self):
+		"""Get the links of the item that this expression follows."""
+		return []
+		
+		
+	def to_filter(self, context):
+		"""
+		Get a storage filter that matches the items this expression allows. 
+		Returns True or False when the answer doesn't depend on the item.
+		"""
+		if not self.uses('item'):
+			return bool(self(context))
+		raise FilterCompilationError, "%s can't be turned into a filter" % repr(self)
 			
 			
 			
@@ -45,6 +99,10 @@ class BinaryExpression(AuthenticationExpression):
 		return self.a.uses(key) or self.b.uses(key)
 		
 		
+	def link_proxies(self):
+		return self.a.link_proxies() + self.b.link_proxies()
+		
+		
 	def __eq__(self, other):
 		return isinstance(other, self.__class__) and other.a == self.a and other.b == self.b
 		
@@ -57,6 +115,15 @@ class AndExpression(BinaryExpression):
 		return self.a(context) and self.b(context)
 		
 		
+	def compile(self):
+		a, b = self.a.compile(), self.b.compile()
+		return lambda context: a(context) and b(context)
+		
+		
+	def to_filter(self, context):
+		return and_filters(self.a.to_filter(context), self.b.to_filter(context))
+		
+		
 	def __repr__(self):
 		return 'AndExpression(%s, %s)' % (repr(self.a), repr(self.b))
 		
@@ -67,6 +134,15 @@ class OrExpression(BinaryExpression):
 	def __call__(self, context):
 		return self.a(context) or self.b(context)
 		
+		
+	def compile(self):
+		a, b = self.a.compile(), self.b.compile()
+		return lambda context: a(context) or b(context)
+		
+		
+	def to_filter(self, context):
+		return or_filters(self.a.to_filter(context), self.b.to_filter(context))
+		
 
 
 class ObjectProxy(AuthenticationExpression):
@@ -107,10 +183,27 @@ class ObjectProxy(AuthenticationExpression):
 		return self._name == key
 		
 		
+	def to_filter(self, context):
+		if self._name == 'item':
+			return True
+		return super(ObjectProxy, self).to_filter(context)
+		
+		
 	def get(self, context):
 		return context.get(self._name, {})
 		
 		
+	def compile(self):
+		name = self._name
+		return lambda context: name in context
+		
+		
+	def compile_get(self):
+		"""Get a function of the context that does the same as `get`."""
+		name = self._name
+		return lambda context: context.get(name, {})
+		
+		
 		
 class ObjectProxyMatch(AuthenticationExpression):
 	
@@ -132,10 +225,19 @@ class ObjectProxyMatch(AuthenticationExpression):
 		return self.fn(obj)
 		
 		
+	def compile(self):
+		get, fn = self._proxy.compile_get(), self.fn
+		return lambda context: fn(get(context))
+		
+		
 	def uses(self, key):
 		return self._proxy.uses(key)
 		
 		
+	def link_proxies(self):
+		return self._proxy.link_proxies()
+		
+		
 		
 class ObjectProxyValue(AuthenticationExpression):
 	
@@ -158,6 +260,12 @@ class ObjectProxyValue(AuthenticationExpression):
 		return val
 		
 		
+	def compile_get_value(self):
+		"""Get a function of the context that does the same as `get_value`."""
+		get, key = self._proxy.compile_get(), self._key
+		return lambda context: get(context).get(key)
+		
+		
 	def exists(self):
 		return self
 		
@@ -166,10 +274,25 @@ class ObjectProxyValue(AuthenticationExpression):
 		return self._proxy.uses(key)
 		
 		
+	def link_proxies(self):
+		return self._proxy.link_proxies()
+		
+		
 	def __call__(self, context):
 		return self._proxy(context) and self._key in self._proxy.get(context)
 		
 		
+	def compile(self):
+		exists, get, key = self._proxy.compile(), self._proxy.compile_get(), self._key
+		return lambda context: exists(context) and key in get(context)
+		
+		
+	def to_filter(self, context):
+		if is_item_value(self):
+			return {self._key:{'$exists':True}}
+		return super(ObjectProxyValue, self).to_filter(context)
+		
+		
 	def __eq__(self, other):
 		return EqualsComparison(self, other)
 		
@@ -202,6 +325,10 @@ class ObjectProxyValueComparison(AuthenticationExpression):
 	
 	opstr = ''
 	
+	# The filter operator for `item.field <op> value` and for `value <op> item.field`
+	operator = None
+	reversed_operator = None
+	
 	def __init__(self, proxy, other):
 		self._proxy = proxy
 		self.other = other
@@ -230,16 +357,58 @@ class ObjectProxyValueComparison(AuthenticationExpression):
 		raise NotImplementedError
 		
 		
+	def compile(self):
+		get_a, compare = self._proxy.compile_get_value(), self.compare
+		if isinstance(self.other, ObjectProxyValue):
+			get_b = self.other.compile_get_value()
+			return lambda context: compare(get_a(context), get_b(context))
+		b = self.other
+		return lambda context: compare(get_a(context), b)
+		
+		
+	def to_filter(self, context):
+		if not self.uses('item'):
+			return bool(self(context))
+		
+		if is_item_value(self._proxy) and not (isinstance(self.other, AuthenticationExpression) and self.other.uses('item')):
+			field, operator = self._proxy._key, self.operator
+			value = self.other.get_value(context) if isinstance(self.other, ObjectProxyValue) else self.other
+		elif is_item_value(self.other) and not self._proxy.uses('item'):
+			field, operator = self.other._key, self.reversed_operator
+			value = self._proxy.get_value(context)
+		else:
+			operator = None
+			
+		if operator == '$in' and not isinstance(value, (list, tuple, set)):
+			operator = None
+		if operator is None:
+			raise FilterCompilationError, "%s can't be turned into a filter" % repr(self)
+		if operator == '$in':
+			value = list(value)
+		if operator == '$eq':
+			return {field:value}
+		return {field:{operator:value}}
+		
+		
 	def uses(self, key):
 		if isinstance(self.other, AuthenticationExpression):
 			return self._proxy.uses(key) or self.other.uses(key)
 		else:
 			return self._proxy.uses(key)
+			
+			
+	def link_proxies(self):
+		if isinstance(self.other, AuthenticationExpression):
+			return self._proxy.link_proxies() + self.other.link_proxies()
+		else:
+			return self._proxy.link_proxies()
 		
 		
 		
 class EqualsComparison(ObjectProxyValueComparison):
 	opstr = '=='
+	operator = '$eq'
+	reversed_operator = '$eq'
 	
 	def compare(self, a, b):
 		return a == b
@@ -247,6 +416,8 @@ class EqualsComparison(ObjectProxyValueComparison):
 		
 class NotEqualsComparison(ObjectProxyValueComparison):
 	opstr = '!='
+	operator = '$ne'
+	reversed_operator = '$ne'
 	
 	def compare(self, a, b):
 		return a != b
@@ -254,6 +425,8 @@ class NotEqualsComparison(ObjectProxyValueComparison):
 		
 class LessThanComparison(ObjectProxyValueComparison):
 	opstr = '<'
+	operator = '$lt'
+	reversed_operator = '$gt'
 	
 	def compare(self, a, b):
 		return a < b
@@ -261,6 +434,8 @@ class LessThanComparison(ObjectProxyValueComparison):
 		
 class GreaterThanComparison(ObjectProxyValueComparison):
 	opstr = '>'
+	operator = '$gt'
+	reversed_operator = '$lt'
 	
 	def compare(self, a, b):
 		return a > b
@@ -268,6 +443,8 @@ class GreaterThanComparison(ObjectProxyValueComparison):
 		
 class LessThanEqualComparison(ObjectProxyValueComparison):
 	opstr = '<='
+	operator = '$lte'
+	reversed_operator = '$gte'
 	
 	def compare(self, a, b):
 		return a <= b
@@ -275,6 +452,8 @@ class LessThanEqualComparison(ObjectProxyValueComparison):
 		
 class GreaterThanEqualComparison(ObjectProxyValueComparison):
 	opstr = '>='
+	operator = '$gte'
+	reversed_operator = '$lte'
 	
 	def compare(self, a, b):
 		return a >= b
@@ -282,6 +461,8 @@ class GreaterThanEqualComparison(ObjectProxyValueComparison):
 		
 class ContainsComparison(ObjectProxyValueComparison):
 	opstr = ' in '
+	operator = '$in'
+	reversed_operator = '$eq'
 	
 	def compare(self, a, b):
 		return a in b
@@ -317,11 +498,42 @@ class LinkProxy(ObjectProxyValue, ItemProxy):
 		
 	def get(self, context):
 		item = self._proxy.get(context)
+		prefetched = context['_prefetched'].get(self.prefetch_key) if '_prefetched' in context else None
+		if prefetched is not None and item.get('_id') in prefetched:
+			return prefetched[item['_id']]
 		interface = context['api'].get_interface_for_entity(self._proxy._entity)
 		return interface.link(item['_id'], self._name, 
 							bypass_authorization=True, show_hidden=True)
 		
 		
+	@property
+	def prefetch_key(self):
+		return (self._proxy._entity.__name__, self._name)
+		
+		
+	def link_proxies(self):
+		if isinstance(self._proxy, LinkProxy):
+			# Items linked from linked items are looked up one by one
+			return self._proxy.link_proxies()
+		return [self]
+		
+		
+	def prefetch(self, items, context):
+		"""
+		Get what `get` would return for each of a list of items, keyed by item ID. 
+		The links of all the items are resolved at once by the linked interface.
+		"""
+		interface = context['api'].get_interface_for_entity(self._proxy._entity)
+		results = interface.get_linked_interface(self._name).resolve_links(
+			items, self._name, getattr(interface.entity, self._name), 
+			{'bypass_authorization':True, 'show_hidden':True})
+		return dict([(item['_id'], result) for item, result in zip(items, results)])
+		
+		
+	def compile_get(self):
+		return self.get
+		
+		
 	def __repr__(self):
 		return 'LinkProxy(%s, %s)' % (self._proxy._entity.__name__, self._name)
 		
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+The `cellardoor` command.
+
+    cellardoor export myapp.api:api posts > posts.ndjson
+    cellardoor import myapp.api:api posts --checkpoint posts.checkpoint < posts.ndjson
+    cellardoor repair-counters myapp.api:api
+
+Pass `--route` to run a command on one storage route, such as a tenant's 
+database. Its parts are separated by colons, and empty parts are None, so 
+`--route tenant_db:` is the route `('tenant_db', None)`.
+"""
+
+import sys
+import argparse
+import importlib
+from .api.bulk import export_items, import_items, FORMATS
+
+
+def load_api(path):
+	"""Load an API from a `module:attribute` path."""
+	module_name, _, attr = path.partition(':')
+	module = importlib.import_module(module_name)
+	return getattr(module, attr or 'api')
+	
+	
+def get_interface(args):
+	api = load_api(args.api)
+	try:
+		return api.interfaces[args.interface]
+	except KeyError:
+		raise SystemExit("No interface named '%s'" % args.interface)
+		
+		
+def parse_route(value):
+	"""Parse a route like `db_name:prefix`, with empty parts as None."""
+	return tuple([x or None for x in value.split(':')])
+	
+	
+def export_command(args):
+	interface = get_interface(args)
+	stream = open(args.output, 'wb') if args.output else sys.stdout
+	try:
+		with interface.storage.route(args.route):
+			count = export_items(interface, stream, format=args.format, 
+								versions=args.versions, batch_size=args.batch_size)
+	finally:
+		if args.output:
+			stream.close()
+	sys.stderr.write('Exported %d records\n' % count)
+	
+	
+def import_command(args):
+	interface = get_interface(args)
+	stream = open(args.input, 'rb') if args.input else sys.stdin
+	try:
+		with interface.storage.route(args.route):
+			count = import_items(interface, stream, format=args.format, 
+								batch_size=args.batch_size, checkpoint=args.checkpoint)
+	finally:
+		if args.input:
+			stream.close()
+	sys.stderr.write('Imported %d records\n' % count)
+	
+	
+def repair_counters_command(args):
+	api = load_api(args.api)
+	with api.model.storage.route(args.route):
+		api.model.repair_counters()
+	sys.stderr.write('Repaired counters\n')
+	
+	
+def get_parser():
+	parser = argparse.ArgumentParser(prog='cellardoor')
+	subparsers = parser.add_subparsers()
+	
+	export_parser = subparsers.add_parser('export', help="Write an interface's items to a file")
+	export_parser.add_argument('api', help='The API to load, as module:attribute')
+	export_parser.add_argument('interface', help='The plural name of the interface')
+	export_parser.add_argument('-o', '--output', help='Write to this file instead of stdout')
+	export_parser.add_argument('-f', '--format', choices=FORMATS, default='json')
+	export_parser.add_argument('--versions', action='store_true', help='Include version history')
+	export_parser.add_argument('--batch-size', type=int, default=1000)
+	export_parser.add_argument('--route', type=parse_route, help='The storage route to read from')
+	export_parser.set_defaults(command=export_command)
+	
+	import_parser = subparsers.add_parser('import', help='Read items written by export')
+	import_parser.add_argument('api', help='The API to load, as module:attribute')
+	import_parser.add_argument('interface', help='The plural name of the interface')
+	import_parser.add_argument('-i', '--input', help='Read from this file instead of stdin')
+	import_parser.add_argument('-f', '--format', choices=FORMATS, default='json')
+	import_parser.add_argument('--batch-size', type=int, default=500)
+	import_parser.add_argument('--checkpoint', help='Save progress to this file so an interrupted import can resume')
+	import_parser.add_argument('--route', type=parse_route, help='The storage route to write to')
+	import_parser.set_defaults(command=import_command)
+	
+	repair_parser = subparsers.add_parser('repair-counters', help='Recompute inverse link counters')
+	repair_parser.add_argument('api', help='The API to load, as module:attribute')
+	repair_parser.add_argument('--route', type=parse_route, help='The storage route to repair')
+	repair_parser.set_defaults(command=repair_counters_command)
+	
+	return parser
+	
+	
+def main(argv=None):
+	args = get_parser().parse_args(argv)
+	args.command(args)
+	
+	
+if __name__ == '__main__':
+	main()
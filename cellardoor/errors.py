@@ -23,6 +23,17 @@ class VersionConflictError(Exception):
 		
 class NotVersionedError(Exception):
 	pass
+	
+	
+class PreconditionFailedError(Exception):
+	pass
+	
+	
+class NotModifiedError(Exception):
+	
+	def __init__(self, etag):
+		self.etag = etag
+		super(NotModifiedError, self).__init__()
 		
 		
 class DisabledFieldError(Exception):
@@ -37,4 +48,23 @@ class DuplicateError(Exception):
 	pass
 	
 	
+class UnindexedQueryError(Exception):
+	pass
+	
+	
+class StorageClosedError(Exception):
+	pass
+	
+	
+class BulkCreateError(Exception):
+	
+	def __init__(self, failures, indexes=None, existing=None):
+		self.failures = failures
+		# Where the failed items were in the list given to create_many, if known
+		self.indexes = indexes if indexes is not None else []
+		# The indexes of the items that failed because their id is already taken
+		self.existing = existing if existing is not None else set()
+		super(BulkCreateError, self).__init__()
+	
+	
 from model import ValidationError, CompoundValidationError
\ No newline at end of file
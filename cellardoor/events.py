@@ -1,8 +1,145 @@
+import atexit
+import logging
+import threading
 from functools import partial
+from Queue import Queue, Full
+
+
+class WorkerPool(object):
+	"""
+	Runs calls on a few background threads. At most `max_queued` calls wait
+	for a worker, after that `submit` blocks until there's room, so a burst
+	of work slows callers down instead of piling up in memory.
+	
+	The workers start on the first call and are stopped with `shutdown`,
+	which finishes everything already submitted. It's also run at exit.
+	"""
+	
+	def __init__(self, workers=4, max_queued=1000):
+		self.workers = workers
+		self.queue = Queue(max_queued)
+		self.threads = []
+		self.lock = threading.Lock()
+		self.logger = logging.getLogger(__name__)
+		self.registered = False
+		
+		
+	def submit(self, fn, *args, **kwargs):
+		self.start()
+		if threading.current_thread() in self.threads:
+			# A worker waiting on a full queue could wait forever, so run it here
+			try:
+				self.queue.put_nowait((fn, args, kwargs))
+			except Full:
+				self.run(fn, args, kwargs)
+		else:
+			self.queue.put((fn, args, kwargs))
+		
+		
+	def start(self):
+		if self.threads:
+			return
+		with self.lock:
+			if self.threads:
+				return
+			for i in range(self.workers):
+				thread = threading.Thread(target=self._work)
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+			if not self.registered:
+				atexit.register(self.shutdown)
+				self.registered = True
+		
+		
+	def drain(self):
+		"""Wait until every submitted call has finished."""
+		self.queue.join()
+		
+		
+	def shutdown(self):
+		"""Finish the submitted calls and stop the workers."""
+		with self.lock:
+			threads, self.threads = self.threads, []
+		for thread in threads:
+			self.queue.put(None)
+		for thread in threads:
+			if thread is not threading.current_thread():
+				thread.join()
+		
+		
+	def run(self, fn, args, kwargs):
+		try:
+			fn(*args, **kwargs)
+		except Exception:
+			self.logger.exception('Background call to %s failed.' % getattr(fn, '__name__', fn))
+		
+		
+	def _work(self):
+		while True:
+			task = self.queue.get()
+			try:
+				if task is None:
+					return
+				self.run(*task)
+			finally:
+				self.queue.task_done()
+
+
+
+default_pool = WorkerPool()
+
+
+
+def copy_data(value):
+	"""Copy the dicts, lists and sets in a value. Other objects, like an API in a context, are shared."""
+	if isinstance(value, dict):
+		return dict([(k, copy_data(v)) for k, v in value.items()])
+	if isinstance(value, list):
+		return [copy_data(x) for x in value]
+	if isinstance(value, tuple):
+		return tuple([copy_data(x) for x in value])
+	if isinstance(value, set):
+		return set([copy_data(x) for x in value])
+	return value
+	
+	
+
+class Background(object):
+	"""A listener that's run on the event manager's worker pool."""
+	
+	def __init__(self, fn):
+		self.fn = fn
+		
+		
+	def __call__(self, *args, **kwargs):
+		return self.fn(*args, **kwargs)
+		
+		
+		
+class RoutedCall(object):
+	"""Calls `fn` with the storage route that was in use when the call was made."""
+	
+	def __init__(self, fn, storage):
+		self.fn = fn
+		self.storage = storage
+		self.route = storage.get_route()
+		self.__name__ = getattr(fn, '__name__', repr(fn))
+		
+		
+	def __call__(self, *args, **kwargs):
+		with self.storage.route(self.route):
+			return self.fn(*args, **kwargs)
+
 
 
 class EventManager(object):
 	
+	pool = default_pool
+	
+	# Background listeners use the route of this storage that the event was fired with
+	storage = None
+	
 	def __init__(self, *event_names):
 		self.listeners = {
 			'before': dict([(k, []) for k in event_names]), 
@@ -15,18 +152,39 @@ class EventManager(object):
 				setattr(self, 'fire_%s_%s' % (when, event), partial(self.fire, when, event))
 		
 		
-	def register(self, when, event_name, fn):
+	def register(self, when, event_name, fn, background=False):
+		"""
+		Add a listener. With `background` it's run on a worker thread and
+		`fire` doesn't wait for it. Only after listeners can be run that way.
+		"""
+		if background:
+			if when != 'after':
+				raise ValueError, "Only after listeners can run in the background."
+			fn = Background(fn)
 		self.listeners[when][event_name].append(fn)
 		
 		
 	def fire(self, when, event_name, *args, **kwargs):
 		fns = self.listeners[when][event_name]
 		for fn in fns:
-			fn(*args, **kwargs)
-			
-			
+			if isinstance(fn, Background):
+				self.submit(fn.fn, args, kwargs)
+			else:
+				fn(*args, **kwargs)
+		
+		
+	def submit(self, fn, args, kwargs):
+		"""
+		Run a background listener on the pool. It gets its own copy of the 
+		arguments, as the caller goes on using them.
+		"""
+		if self.storage is not None:
+			fn = RoutedCall(fn, self.storage)
+		self.pool.submit(fn, *copy_data(args), **copy_data(kwargs))
+		
+		
 	def update_from(self, other):
 		for when, events in other.listeners.items():
 			for event, listeners in events.items():
 				for fn in listeners:
-					self.register(when, event, fn)
\ No newline at end of file
+					self.register(when, event, fn)
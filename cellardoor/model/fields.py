@@ -578,15 +578,19 @@ class Compound(Field):
     def __init__(self, required=False, default=None, **kwargs):
         super(Compound, self).__init__(required, default)
         self.fields = kwargs
-        self.enforce_required = True
         
         
     def validate(self, value, enforce_required=True):
-        self.enforce_required = enforce_required
-        return super(Compound, self).validate(value)
+        # enforce_required is passed along rather than stored, so one 
+        # validator can be used by several threads at once
+        if value is None:
+            if self.required:
+                raise ValidationError, "This field is required."
+            return self.default
+        return self._validate(value, enforce_required)
         
         
-    def _validate(self, value):
+    def _validate(self, value, enforce_required=True):
         if not isinstance(value, dict):
             raise ValidationError(self.NOT_A_DICT)
         
@@ -596,10 +600,10 @@ class Compound(Field):
         for k,v in self.fields.items():
             unvalidated_value = value.get(k)
             if unvalidated_value is None or unvalidated_value == '' or unvalidated_value == []:
-                if v.required and self.enforce_required:
+                if v.required and enforce_required:
                     errors[k] = 'This field is required.'
                     continue
-                elif self.enforce_required:
+                elif enforce_required:
                     unvalidated_value = v.default
             if unvalidated_value is not None and unvalidated_value != []:
                 try:
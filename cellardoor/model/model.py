@@ -1,13 +1,14 @@
 import inspect
 from  ..events import EventManager
-from .fields import Field, ListOf, Compound, Text, ValidationError
+from .fields import Field, ListOf, Compound, Text, DateTime, ValidationError
 
 __all__ = [
     'Entity',
     'Link',
     'InverseLink',
     'Model',
-    'InvalidModelException'
+    'InvalidModelException',
+    'make_snapshot'
 ]
 
 
@@ -25,12 +26,15 @@ class Link(Text):
     
     def __init__(self, entity, 
             embeddable=False, embed_by_default=True, embedded_fields=None, ondelete=NULL,
-            *args, **kwargs):
+            denormalize=False, *args, **kwargs):
         self.entity = entity
         self.embeddable = embeddable
         self.embed_by_default = embed_by_default
         self.embedded_fields = embedded_fields
         self.ondelete = ondelete
+        # Set to True to store a copy of the embedded fields of the linked
+        # item(s) on this item and serve embeds from that copy.
+        self.denormalize = denormalize
         self.storage = None
         
         super(Link, self).__init__(*args, **kwargs)
@@ -52,7 +56,7 @@ class InverseLink(object):
     
     def __init__(self, entity, field, 
             embeddable=False, embed_by_default=True, embedded_fields=None, 
-            multiple=True, hidden=False, help=None):
+            multiple=True, hidden=False, help=None, counter=None):
         self.entity = entity
         self.field = field
         self.embeddable = embeddable
@@ -62,9 +66,37 @@ class InverseLink(object):
         self.hidden = hidden
         self.storage = None
         self.help = help
+        # Set to True or a field name to keep a count of the linked items
+        # on each item. True uses the name `<link name>_count`.
+        self.counter = counter
+        self.counter_field = None
     
 
 
+def make_snapshot(link, item):
+    """Copy the fields of a linked item that a denormalized link stores."""
+    snapshot = dict([(k, item[k]) for k in link.embedded_fields if k in item])
+    for k in ('_id', '_type'):
+        if k in item:
+            snapshot[k] = item[k]
+    return snapshot
+    
+    
+def make_shaper(entity, fields, hide_hidden):
+    """
+    Make a function that copies the response fields of an item of `entity`
+    in one pass. Fields starting with '_' are always kept.
+    """
+    hidden = entity.hidden_fields if hide_hidden else frozenset()
+    if fields is None:
+        if not hidden:
+            return lambda item: item
+        return lambda item: dict([(k, v) for k, v in item.iteritems() if k not in hidden])
+    allowed = fields.difference(hidden)
+    return lambda item: dict([(k, v) for k, v in item.iteritems() if k in allowed or k.startswith('_')])
+    
+    
+
 class EntityType(type):
     
     def __new__(cls, name, bases, attrs):
@@ -130,8 +162,17 @@ class EntityType(type):
         
         embeddable = set()
         embed_by_default = set()
+        counter_fields = set()
+        denormalized = set()
         
         for k,v in links.items():
+            if isinstance(v, Link) and v.denormalize:
+                if not v.embedded_fields:
+                    raise InvalidModelException, "The denormalized link '%s' of %s must have embedded_fields" % (k, name)
+                denormalized.add(k)
+            if isinstance(v, InverseLink) and v.counter:
+                v.counter_field = v.counter if isinstance(v.counter, basestring) else '%s_count' % k
+                counter_fields.add(v.counter_field)
             if v.embeddable:
                 embeddable.add(k)
                 if v.embed_by_default:
@@ -144,9 +185,17 @@ class EntityType(type):
             hidden_fields.update(entity_cls.hidden_fields)
             embeddable.update(entity_cls.embeddable)
             embed_by_default.update(entity_cls.embed_by_default)
+            counter_fields.update(entity_cls.counter_fields)
+            denormalized.update(entity_cls.denormalized)
         
         visible_fields = set(fields.keys()).difference(hidden_fields)
         
+        expires_after = attrs.get('expires_after', getattr(parent, 'expires_after', None))
+        if expires_after:
+            expiry_field, _ = expires_after
+            if not isinstance(fields.get(expiry_field), DateTime):
+                raise InvalidModelException, "The expiry field '%s' of %s must be a DateTime" % (expiry_field, name)
+        
         # Create the new class
         attrs.update(dict(
             hooks = hooks,
@@ -157,6 +206,14 @@ class EntityType(type):
             links = links,
             embeddable = embeddable,
             embed_by_default = embed_by_default,
+            counter_fields = counter_fields,
+            counters = [],
+            denormalized = denormalized,
+            snapshot_links = [],
+            types_by_name = {},
+            all_links = {},
+            embed_cache = {},
+            shaper_cache = {},
             children = [],
             validator = Compound(**fields)
         ))
@@ -175,6 +232,8 @@ class EntityType(type):
         for base in hierarchy:
             base.children.append(new_cls)
         
+        hooks.storage = new_cls.model.storage
+        
         # Register the class with its model
         new_cls.model.add_entity(new_cls)
         
@@ -197,6 +256,39 @@ class EntityType(type):
         return link
         
         
+    def get_embed(cls, embed=None, fields=None, hide_hidden=True):
+        """Get the links to embed for a combination of options."""
+        key = (frozenset(embed) if embed else None, frozenset(fields) if fields else None, hide_hidden)
+        result = cls.embed_cache.get(key)
+        if result is None:
+            if embed:
+                result = cls.embeddable.intersection(embed)
+            else:
+                result = set(cls.embed_by_default)
+            if fields:
+                result.update(cls.embeddable.intersection(fields))
+            if hide_hidden:
+                result.difference_update(cls.hidden_fields)
+            result = frozenset(result)
+            if len(cls.embed_cache) > 1000:
+                # The keys include fields from requests, so don't let it grow forever
+                cls.embed_cache.clear()
+            cls.embed_cache[key] = result
+        return result
+        
+        
+    def get_shaper(cls, fields=None, hide_hidden=True):
+        """Get a function that builds the visible part of an item of this type."""
+        key = (frozenset(fields) if fields is not None else None, hide_hidden)
+        shaper = cls.shaper_cache.get(key)
+        if shaper is None:
+            shaper = make_shaper(cls, *key)
+            if len(cls.shaper_cache) > 1000:
+                cls.shaper_cache.clear()
+            cls.shaper_cache[key] = shaper
+        return shaper
+        
+        
     def get_links(cls):
         link_names = cls.links.keys()
         return dict(zip(link_names, map(cls.get_link, link_names)))
@@ -214,6 +306,16 @@ class Entity(object):
     mixins = []
     versioned = False
     
+    # Set to True to let a `BufferedStorage` queue creates for this entity
+    # and write them in bulk. Created items are not readable until the
+    # buffer is flushed and can be lost if the process dies before then.
+    write_behind = False
+    
+    # A tuple of (field name, seconds) to expire items that many seconds after
+    # the time in a DateTime field, e.g. `('created', 3600)`. Expired items are
+    # hidden from reads and removed by the storage when it supports it.
+    expires_after = None
+    
     
 
 class Model(object):
@@ -255,4 +357,80 @@ class Model(object):
             self.storage.setup(self)
             for entity in self.entities.values():
                 for link_name in entity.links:
-                    entity.get_link(link_name)
\ No newline at end of file
+                    entity.get_link(link_name)
+            for entity in self.entities.values():
+                # Lookup tables covering an entity and all of its children
+                family = [entity] + entity.children
+                entity.types_by_name.update([(e.__name__, e) for e in family])
+                for e in reversed(family):
+                    entity.all_links.update(e.links)
+            for entity, link in self.get_counted_links():
+                for target in [link.entity] + link.entity.children:
+                    target.counters.append((link.field, entity, link.counter_field))
+            for entity, link_name, link in self.get_denormalized_links():
+                for target in [link.entity] + link.entity.children:
+                    if not target.snapshot_links:
+                        target.hooks.after_update(self._on_snapshot_update(target))
+                        target.hooks.after_delete(self._on_snapshot_delete(target))
+                    target.snapshot_links.append((entity, link_name, link))
+                    
+                    
+    def _on_snapshot_update(self, entity):
+        def on_update(item, context):
+            self.defer(self.propagate_snapshots, entity, item['_id'], self.storage.get_route())
+        return on_update
+        
+        
+    def _on_snapshot_delete(self, entity):
+        def on_delete(id, context):
+            self.defer(self.propagate_snapshots, entity, id, self.storage.get_route())
+        return on_delete
+        
+        
+    def get_denormalized_links(self):
+        """Get (entity, link name, link) for each link that stores snapshots of its target."""
+        denormalized = []
+        for entity in self.entities.values():
+            for link_name in entity.denormalized:
+                owners = [e for e in entity.hierarchy if link_name in e.denormalized]
+                if not owners:
+                    denormalized.append((entity, link_name, entity.links[link_name]))
+        return denormalized
+        
+        
+    def propagate_snapshots(self, entity, id, route=None):
+        """
+        Copy the embedded fields of an updated item into the items that link to it.
+        If the item is gone its copies are cleared, so they aren't used any more.
+        """
+        with self.storage.route(route):
+            item = self.storage.get_by_id(entity, id)
+            for owner, link_name, link in entity.snapshot_links:
+                snapshot = make_snapshot(link, item) if item is not None else None
+                self.storage.update_many(owner, {link_name:id}, 
+                    {'_snapshots.%s.%s' % (link_name, id): snapshot})
+            
+            
+    def defer(self, fn, *args):
+        """Run `fn` on the hooks' worker pool."""
+        EventManager.pool.submit(fn, *args)
+        
+        
+
+    def get_counted_links(self):
+        """Get (entity, link) pairs for each inverse link that keeps a counter."""
+        seen = set()
+        counted = []
+        for entity in self.entities.values():
+            for link in entity.links.values():
+                if isinstance(link, InverseLink) and link.counter_field and link not in seen:
+                    seen.add(link)
+                    owner = [e for e in entity.hierarchy + [entity] if link in e.links.values()][0]
+                    counted.append((owner, link))
+        return counted
+        
+        
+    def repair_counters(self):
+        """Recompute every inverse link counter from the linked items."""
+        for entity, link in self.get_counted_links():
+            self.storage.repair_counter(entity, link.counter_field, link.entity, link.field)
\ No newline at end of file
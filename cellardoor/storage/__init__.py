@@ -1,3 +1,22 @@
+from contextlib import contextmanager
+
+
+def freeze(value):
+	"""
+	Get a hashable copy of a document, filter or list of arguments, to use it 
+	as a cache key. Raises TypeError if something in it can't be hashed.
+	"""
+	if isinstance(value, dict):
+		return frozenset([(k, freeze(v)) for k, v in value.items()])
+	if isinstance(value, (list, tuple)):
+		return tuple([freeze(x) for x in value])
+	if isinstance(value, set):
+		return frozenset(value)
+	hash(value)
+	return value
+	
+	
+	
 class Storage(object):
 	
 	# These are the methods you need to implement
@@ -20,17 +39,171 @@ class Storage(object):
 		raise NotImplementedError
 		
 		
+	def iterate(self, entity, filter=None, batch_size=1000, versions=False):
+		raise NotImplementedError
+		
+		
+	def distinct(self, entity, field, filter=None):
+		raise NotImplementedError
+		
+		
 	def create(self, entity, fields, version_creator=None):
 		raise NotImplementedError
 		
 		
-	def update(self, entity, id, fields, replace=False, version_creator=None):
+	def create_many(self, entity, items, versions=False):
+		raise NotImplementedError
+		
+		
+	def new_id(self):
+		raise NotImplementedError
+		
+		
+	def update(self, entity, id, fields, replace=False, match=None):
+		"""
+		Update an item. If `match` is given the item is only changed if it still 
+		has those field values, otherwise `PreconditionFailedError` is raised. 
+		If `match` is a whole stored item, with an `_id`, the fields it doesn't 
+		have must also still be missing.
+		"""
+		raise NotImplementedError
+		
+		
+	def update_many(self, entity, filter, fields):
+		raise NotImplementedError
+		
+		
+	def delete(self, entity, id, deleted_by=None, match=None):
 		raise NotImplementedError
 		
 		
-	def delete(self, entity, id, version_creator=None):
+	def increment(self, entity, id, field, amount=1):
+		raise NotImplementedError
+		
+		
+	def repair_counter(self, entity, counter_field, linked_entity, link_field):
 		raise NotImplementedError
 		
 		
 	def check_filter(self, filter, allowed_fields):
-		raise NotImplementedError
\ No newline at end of file
+		raise NotImplementedError
+		
+		
+	def tail_changes(self, stopped):
+		raise NotImplementedError
+		
+		
+	def check_query(self, entity, filter=None, sort=None, limit=0):
+		"""Return the limit to run a query with, or raise UnindexedQueryError."""
+		return limit
+		
+		
+	# Storages that can split data into partitions, e.g. one per tenant,
+	# override these. A route is a hashable value naming a partition.
+	
+	
+	def get_route(self):
+		"""Get the route that calls from this thread are currently using."""
+		return None
+		
+		
+	@contextmanager
+	def route(self, route):
+		"""Use `route` for the calls made inside this block."""
+		yield
+		
+		
+	def routed(self, context):
+		"""Use the route chosen for a request `context` inside this block."""
+		return self.route(None)
+		
+		
+		
+class WrappedStorage(Storage):
+	"""
+	Passes every call through to another storage. Subclass this to add
+	behavior in front of an existing storage.
+	"""
+	
+	def __init__(self, storage):
+		self.storage = storage
+		
+		
+	def setup(self, model):
+		return self.storage.setup(model)
+		
+		
+	def get(self, entity, *args, **kwargs):
+		return self.storage.get(entity, *args, **kwargs)
+		
+		
+	def get_by_ids(self, entity, ids, *args, **kwargs):
+		return self.storage.get_by_ids(entity, ids, *args, **kwargs)
+		
+		
+	def get_by_id(self, entity, id, *args, **kwargs):
+		return self.storage.get_by_id(entity, id, *args, **kwargs)
+		
+		
+	def iterate(self, entity, *args, **kwargs):
+		return self.storage.iterate(entity, *args, **kwargs)
+		
+		
+	def distinct(self, entity, field, *args, **kwargs):
+		return self.storage.distinct(entity, field, *args, **kwargs)
+		
+		
+	def create(self, entity, fields, *args, **kwargs):
+		return self.storage.create(entity, fields, *args, **kwargs)
+		
+		
+	def create_many(self, entity, items, *args, **kwargs):
+		return self.storage.create_many(entity, items, *args, **kwargs)
+		
+		
+	def new_id(self):
+		return self.storage.new_id()
+		
+		
+	def update(self, entity, id, fields, *args, **kwargs):
+		return self.storage.update(entity, id, fields, *args, **kwargs)
+		
+		
+	def update_many(self, entity, filter, fields):
+		return self.storage.update_many(entity, filter, fields)
+		
+		
+	def delete(self, entity, id, *args, **kwargs):
+		return self.storage.delete(entity, id, *args, **kwargs)
+		
+		
+	def increment(self, entity, id, field, amount=1):
+		return self.storage.increment(entity, id, field, amount)
+		
+		
+	def repair_counter(self, entity, counter_field, linked_entity, link_field):
+		return self.storage.repair_counter(entity, counter_field, linked_entity, link_field)
+		
+		
+	def check_filter(self, filter, *args, **kwargs):
+		return self.storage.check_filter(filter, *args, **kwargs)
+		
+		
+	def tail_changes(self, stopped):
+		return self.storage.tail_changes(stopped)
+		
+		
+	def check_query(self, entity, *args, **kwargs):
+		return self.storage.check_query(entity, *args, **kwargs)
+		
+		
+	def get_route(self):
+		return self.storage.get_route()
+		
+		
+	def route(self, route):
+		return self.storage.route(route)
+		
+		
+	def routed(self, context):
+		return self.storage.routed(context)
@@ -0,0 +1,117 @@
+import atexit
+import logging
+import threading
+import weakref
+from . import WrappedStorage
+from .. import errors
+
+
+def close_at_exit(storage_ref):
+	storage = storage_ref()
+	if storage is not None:
+		storage.close()
+
+
+class BufferedStorage(WrappedStorage):
+	"""
+	Queues creates for entities with `write_behind = True` and writes them with
+	bulk inserts once `max_size` items are waiting or `max_delay` seconds have
+	passed. IDs are generated immediately so callers get them back right away.
+	Items are buffered per storage route and written back to the same route.
+	
+	Creates that fail during a flush are passed to `on_error(entity, failures)`,
+	where failures is a list of `(document, message)` pairs, and written to the
+	`dead_letter` entity if one is given. Every other call goes straight to the
+	wrapped storage. Once closed, creates for write-behind entities raise
+	StorageClosedError.
+	"""
+	
+	def __init__(self, storage, max_size=500, max_delay=1.0, on_error=None, dead_letter=None):
+		super(BufferedStorage, self).__init__(storage)
+		self.max_size = max_size
+		self.max_delay = max_delay
+		self.on_error = on_error
+		self.dead_letter = dead_letter
+		self.logger = logging.getLogger(__name__)
+		self.buffers = {}
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.flusher = None
+		# Only a weak reference, so storages that are dropped can be collected
+		atexit.register(close_at_exit, weakref.ref(self))
+		
+		
+	def create(self, entity, fields, *args, **kwargs):
+		if not entity.write_behind:
+			return self.storage.create(entity, fields, *args, **kwargs)
+		
+		if '_id' not in fields:
+			fields['_id'] = self.storage.new_id()
+		
+		with self.lock:
+			# Checked under the lock so nothing is added after the last flush
+			if self.stopped.is_set():
+				raise errors.StorageClosedError, "The buffered storage has been closed."
+			buffer = self.buffers.setdefault((entity, self.storage.get_route()), [])
+			buffer.append(fields.copy())
+			is_full = len(buffer) >= self.max_size
+			if self.flusher is None:
+				self.flusher = threading.Thread(target=self._flush_periodically)
+				self.flusher.daemon = True
+				self.flusher.start()
+		
+		if is_full:
+			self.flush(entity)
+		
+		return fields['_id']
+		
+		
+	def flush(self, entity=None):
+		"""Write out everything that is buffered, or just the items for one entity."""
+		with self.lock:
+			if entity is None:
+				buffers = self.buffers
+				self.buffers = {}
+			else:
+				buffers = dict([(k, self.buffers.pop(k)) for k in self.buffers.keys() if k[0] is entity])
+		
+		for (entity, route), items in buffers.items():
+			if not items:
+				continue
+			with self.storage.route(route):
+				try:
+					self.storage.create_many(entity, items)
+				except errors.BulkCreateError, e:
+					self._handle_failures(entity, e.failures)
+				except Exception, e:
+					self.logger.exception('Failed to flush %d %s items.' % (len(items), entity.__name__))
+					self._handle_failures(entity, [(x, str(e)) for x in items])
+				
+				
+	def close(self):
+		"""Stop the background flusher and write out anything that is left."""
+		with self.lock:
+			self.stopped.set()
+		if self.flusher and self.flusher is not threading.current_thread():
+			self.flusher.join()
+		self.flush()
+		
+		
+	def _flush_periodically(self):
+		while not self.stopped.wait(self.max_delay):
+			self.flush()
+			
+			
+	def _handle_failures(self, entity, failures):
+		self.logger.error('%d %s items could not be written.' % (len(failures), entity.__name__))
+		if self.on_error:
+			try:
+				self.on_error(entity, failures)
+			except Exception:
+				self.logger.exception('The on_error callback failed.')
+		if self.dead_letter:
+			dead = [{'entity':entity.__name__, 'document':doc, 'error':message} for doc, message in failures]
+			try:
+				self.storage.create_many(self.dead_letter, dead)
+			except Exception:
+				self.logger.exception('Could not write to the dead letter entity.')
@@ -0,0 +1,63 @@
+import logging
+import threading
+from ..events import EventManager
+
+
+class ChangeFeed(object):
+	"""
+	Follows the writes recorded by a storage, from this or any other process,
+	and passes them on to local caches and listeners.
+	
+	Caches are registered with `register(cache)` and must have an
+	`invalidate(entity_name, id, route)` method. Listeners are added with
+	`feed.hooks.after_change(fn)` and called with `(entity_name, id, operation, route)`.
+	The route is the storage route the write was made on. An id of None means 
+	any item of the entity may have changed, and a route of None any route.
+	"""
+	
+	def __init__(self, storage):
+		self.storage = storage
+		self.caches = []
+		self.hooks = EventManager('change')
+		self.logger = logging.getLogger(__name__)
+		self.stopped = threading.Event()
+		self.thread = None
+	
+	
+	def register(self, cache):
+		self.caches.append(cache)
+	
+	
+	def start(self):
+		"""Start following changes in a background thread."""
+		if self.thread is None:
+			self.stopped.clear()
+			self.thread = threading.Thread(target=self._follow)
+			self.thread.daemon = True
+			self.thread.start()
+	
+	
+	def stop(self):
+		self.stopped.set()
+		if self.thread and self.thread is not threading.current_thread():
+			self.thread.join()
+		self.thread = None
+	
+	
+	def publish(self, entity_name, id, operation, route=None):
+		for cache in self.caches:
+			try:
+				cache.invalidate(entity_name, id, route)
+			except Exception:
+				self.logger.exception('Could not invalidate %s %s.' % (entity_name, id))
+		self.hooks.fire_after_change(entity_name, id, operation, route)
+	
+	
+	def _follow(self):
+		while not self.stopped.is_set():
+			try:
+				for entity_name, id, operation, route in self.storage.tail_changes(self.stopped):
+					self.publish(entity_name, id, operation, route)
+			except Exception:
+				self.logger.exception('Lost the change feed, reconnecting.')
+				self.stopped.wait(1.0)
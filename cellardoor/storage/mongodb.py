@@ -1,29 +1,136 @@
 import re
+import time
+import logging
+import itertools
+import threading
 import pymongo
-from datetime import datetime
+from copy import deepcopy
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from bson.objectid import ObjectId
 from . import Storage
+from ..model import ListOf
 from .. import errors
 
 find_dupe_index_pattern = re.compile(r'\$([a-zA-Z0-9_]+)\s+')
+find_dupe_id_pattern = re.compile(r'\b_id_\b')
+DUPLICATE_KEY_CODES = (11000, 11001)
+
+
+def is_operator(value):
+	return isinstance(value, dict) and any([k.startswith('$') for k in value])
+	
+	
+def set_path(doc, path, value):
+	"""Set a dotted path in a document the way $set does"""
+	parts = path.split('.')
+	for part in parts[:-1]:
+		doc = doc.setdefault(part, {})
+	doc[parts[-1]] = value
+	
+	
+def flatten(query, prefix, doc):
+	"""
+	Add equality conditions on every field of `doc` to `query`, using dotted paths for 
+	subdocuments. Lists of subdocuments are compared item by item, as the keys of a 
+	stored subdocument may not be in the same order as in `doc`.
+	"""
+	for k, v in doc.items():
+		if isinstance(v, dict) and v:
+			flatten(query, prefix + k + '.', v)
+		elif isinstance(v, list) and any([isinstance(x, dict) for x in v]):
+			query[prefix + k] = {'$size':len(v)}
+			flatten(query, prefix + k + '.', dict([(str(i), x) for i, x in enumerate(v)]))
+		else:
+			query[prefix + k] = v
+	
 
 class MongoDBStorage(Storage):
+	"""
+	Stores each entity hierarchy in a collection named after its base entity.
+	
+	Pass `router`, a function that takes a request context and returns a 
+	`(database name, collection prefix)` tuple, to keep partitions such as
+	tenants in their own databases or collections. Either part may be None
+	to use the default. Indexes are created for a partition the first time
+	it is used.
+	
+	Pass `change_feed`, the name of a capped collection, to record the entity
+	and id of every write there so a `ChangeFeed` in any process can follow them.
+	
+	Pass `query_guard` to check list queries against the collection's indexes,
+	which are re-read every `index_refresh` seconds. A filter or sort that can't
+	use an index is rejected with `UnindexedQueryError` when it is 'reject',
+	has its limit capped to `query_guard_limit` when it is 'cap' or is only
+	logged when it is 'warn'.
+	"""
 	
 	special_fields = { '$where', '$text' }
 	
 	def __init__(self, db=None, *args, **kwargs):
+		self.router = kwargs.pop('router', None)
+		self.change_feed = kwargs.pop('change_feed', None)
+		self.change_feed_size = kwargs.pop('change_feed_size', 10 * 1024 * 1024)
+		self.query_guard = kwargs.pop('query_guard', None)
+		self.query_guard_limit = kwargs.pop('query_guard_limit', 100)
+		self.index_refresh = kwargs.pop('index_refresh', 300)
+		self.indexes = {}
+		self.logger = logging.getLogger(__name__)
 		self.client = pymongo.MongoClient(*args, **kwargs)
 		self.db = self.client[db]
 		self.unique_fields_by_index = {}
+		self.model = None
+		self.local = threading.local()
+		self.partitions = set()
+		self.partition_lock = threading.Lock()
 		
 		
 	def setup(self, model):
-		for e in model.entities.values():
-			collection = self.get_collection(e)
+		self.model = model
+		self.setup_indexes(None)
+		if self.change_feed and self.change_feed not in self.db.collection_names():
+			try:
+				self.db.create_collection(self.change_feed, capped=True, size=self.change_feed_size)
+			except pymongo.errors.CollectionInvalid:
+				# Another process created it first
+				pass
+		
+		
+	def setup_indexes(self, route):
+		for e in self.model.entities.values():
+			collection = self.get_collection(e, route=route)
 			for k,v in e.fields.items():
 				if v.unique:
 					index_name = collection.ensure_index(k, unique=True, sparse=True)
 					self.unique_fields_by_index[index_name] = k
+			if e.expires_after:
+				field, seconds = e.expires_after
+				collection.ensure_index(field, expireAfterSeconds=seconds)
+				
+				
+	def get_route(self):
+		return getattr(self.local, 'route', None)
+		
+		
+	@contextmanager
+	def route(self, route):
+		if route and route != (None, None) and route not in self.partitions:
+			with self.partition_lock:
+				if route not in self.partitions:
+					self.setup_indexes(route)
+					self.partitions.add(route)
+		previous = self.get_route()
+		self.local.route = route
+		try:
+			yield
+		finally:
+			self.local.route = previous
+			
+			
+	def routed(self, context):
+		if self.router is None or context is None:
+			return self.route(self.get_route())
+		return self.route(tuple(self.router(context)))
 		
 	
 	def get(self, entity, filter=None, fields=None, sort=None, offset=0, limit=0, versions=False, count=False):
@@ -42,8 +149,8 @@ class MongoDBStorage(Storage):
 					del filter['_version']
 		else:
 			to_dict = self.document_to_dict
-			if filter and '_id' in filter and isinstance(filter['_id'], basestring):
-				filter['_id'] = self._objectid(filter['_id'])
+			if filter:
+				self._convert_ids(filter)
 		
 		sort_pairs = []
 		if filter and '$text' in filter:
@@ -63,6 +170,9 @@ class MongoDBStorage(Storage):
 			else:
 				filter.update(type_filter)
 		
+		if not versions:
+			filter = self._merge_filters(filter, self.get_expiry_filter(entity))
+		
 		results = collection.find(spec=filter, 
 								  fields=fields, 
 								  sort=sort_pairs, 
@@ -79,9 +189,14 @@ class MongoDBStorage(Storage):
 		if versions and not entity.versioned:
 			return []
 			
+		id_filter = {'$in':map(self._objectid, ids)}
 		if not filter:
-			filter = {}
-		filter['_id'] = {'$in':map(self._objectid, ids)}
+			filter = {'_id':id_filter}
+		elif '_id' in filter:
+			# Keep the caller's own condition on ids, authorization rules can add one
+			filter = {'$and':[filter, {'_id':id_filter}]}
+		else:
+			filter['_id'] = id_filter
 		return self.get(entity, filter=filter, fields=fields, sort=sort, offset=offset, limit=limit, versions=versions, count=count)
 		
 		
@@ -92,6 +207,7 @@ class MongoDBStorage(Storage):
 		type_filter = self.get_type_filter(entity)
 		if type_filter:
 			filter.update(type_filter)
+		filter = self._merge_filters(filter, self.get_expiry_filter(entity))
 		result = collection.find_one(filter, fields=fields)
 		
 		if result is None:
@@ -100,98 +216,200 @@ class MongoDBStorage(Storage):
 			return self.document_to_dict(result)
 		
 		
+	def iterate(self, entity, filter=None, batch_size=1000, versions=False):
+		if versions and not entity.versioned:
+			return iter([])
+		to_dict = self.versioned_document_to_dict if versions else self.document_to_dict
+		collection = self.get_collection(entity, shadow=versions)
+		filter = filter if filter else {}
+		type_filter = self.get_type_filter(entity)
+		if type_filter:
+			filter.update(type_filter)
+		cursor = collection.find(spec=filter, sort=[('_id', 1)]).batch_size(batch_size)
+		return itertools.imap(to_dict, cursor)
+		
+		
+	def distinct(self, entity, field, filter=None):
+		collection = self.get_collection(entity)
+		filter = filter if filter else {}
+		self._convert_ids(filter)
+		type_filter = self.get_type_filter(entity)
+		if type_filter:
+			filter.update(type_filter)
+		filter = self._merge_filters(filter, self.get_expiry_filter(entity))
+		values = collection.find(spec=filter).distinct(field)
+		if field == '_id':
+			values = map(self._from_objectid, values)
+		return values
+		
+		
 	def create(self, entity, fields):
-		if entity.versioned:
-			fields['_version'] = 1
 		collection = self.get_collection(entity)
+		self._prepare_insert(entity, fields)
+		try:
+			obj_id = collection.insert(fields.copy())
+		except pymongo.errors.DuplicateKeyError, e:
+			self._raise_dupe_error(e)
+		
+		id = self._from_objectid(obj_id)
+		self.publish_change(entity, id, 'create')
+		return id
+		
+		
+	def create_many(self, entity, items, versions=False):
+		if not items:
+			return []
+		collection = self.get_collection(entity, shadow=versions)
+		bulk = collection.initialize_unordered_bulk_op()
+		docs = []
+		for fields in items:
+			if versions:
+				fields['_id'] = {'_id':self._objectid(fields['_id']), '_version':fields['_version']}
+			else:
+				self._prepare_insert(entity, fields)
+				if '_id' not in fields:
+					fields['_id'] = ObjectId()
+			doc = fields.copy()
+			docs.append(doc)
+			bulk.insert(doc)
+		try:
+			bulk.execute()
+		except pymongo.errors.BulkWriteError, e:
+			write_errors = e.details.get('writeErrors', [])
+			raise errors.BulkCreateError(
+				[(docs[x['index']], x['errmsg']) for x in write_errors],
+				indexes=[x['index'] for x in write_errors],
+				existing=set([x['index'] for x in write_errors 
+					if x.get('code') in DUPLICATE_KEY_CODES and find_dupe_id_pattern.search(x['errmsg'])])
+			)
+		to_dict = self.versioned_document_to_dict if versions else self.document_to_dict
+		ids = [to_dict(doc)['_id'] for doc in docs]
+		if not versions:
+			for id in ids:
+				self.publish_change(entity, id, 'create')
+		return ids
+		
+		
+	def new_id(self):
+		return str(ObjectId())
+		
+		
+	def _prepare_insert(self, entity, fields):
+		if entity.versioned:
+			fields.setdefault('_version', 1)
 		type_name = self.get_type_name(entity)
 		if type_name:
 			fields['_type'] = type_name
 		if '_id' in fields:
 			fields['_id'] = self._objectid(fields['_id'])
-		try:
-			obj_id = collection.insert(fields.copy())
-		except pymongo.errors.DuplicateKeyError, e:
-			self._raise_dupe_error(e)
-			
-		return self._from_objectid(obj_id)
 		
 		
-	def update(self, entity, id, fields, replace=False):
+	def update(self, entity, id, fields, replace=False, match=None):
 		type_name = self.get_type_name(entity)
 		if type_name:
 			fields['_type'] = type_name
 		try:
 			if entity.versioned:
-				return self._versioned_update(entity, id, fields, replace=replace)
+				item = self._versioned_update(entity, id, fields, replace=replace, match=match)
 			else:
-				return self._unversioned_update(entity, id, fields, replace=replace)
+				item = self._unversioned_update(entity, id, fields, replace=replace, match=match)
 		except pymongo.errors.DuplicateKeyError, e:
 			self._raise_dupe_error(e)
+		if item is not None:
+			self.publish_change(entity, id, 'update')
+		return item
 			
 			
-	def _versioned_update(self, entity, id, fields, replace=None):
+	def _versioned_update(self, entity, id, fields, replace=None, match=None):
+		if match and '_version' in match:
+			fields['_version'] = match['_version']
 		if '_version' not in fields:
 			raise errors.CompoundValidationError({'_version': 'This field is required.'})
 		current_version = fields.pop('_version')
 		collection = self.get_collection(entity)
 		shadow_collection = self.get_collection(entity, shadow=True)
 		obj_id = self._objectid(id)
-		current_doc = collection.find_one(obj_id)
-		
-		if not current_doc:
-			return None
-				
-		if current_doc['_version'] != current_version:
-			raise errors.VersionConflictError(
-				self.document_to_dict(current_doc)
-			)
-		
-		current_doc['_id'] = {'_id':obj_id, '_version':current_version}
-		shadow_collection.insert(current_doc)
 		
 		fields['_version'] = current_version + 1
 		if replace:
 			doc = fields
 		else:
 			doc = { '$set': fields }
-			
-		try:
-			doc = collection.find_and_modify({'_id':obj_id, '_version':current_version}, doc, new=True)
-		except pymongo.errors.DuplicateKeyError, e:
-			shadow_collection.remove(current_doc['_id'])
-			self._raise_dupe_error(e)
-		if doc:
-			return self.document_to_dict(doc)
-		else:
+		
+		# Changing the document and getting the previous one in one step checks 
+		# the version without reading the document first. The previous version 
+		# is added to the history after the change, so if that insert fails the 
+		# history misses it, but the item itself is never out of date.
+		query = self.get_match_filter(entity, match)
+		query.update({'_id':obj_id, '_version':current_version})
+		current_doc = collection.find_and_modify(query, doc, new=False)
+		if not current_doc:
 			current_doc = collection.find_one(obj_id)
+			if not current_doc:
+				return None
+			if match:
+				raise errors.PreconditionFailedError()
 			raise errors.VersionConflictError(self.document_to_dict(current_doc))
+		
+		if replace:
+			new_doc = dict(fields, _id=obj_id)
+		else:
+			new_doc = deepcopy(current_doc)
+			for k, v in fields.items():
+				set_path(new_doc, k, v)
+		
+		current_doc['_id'] = {'_id':obj_id, '_version':current_version}
+		shadow_collection.insert(current_doc)
+		return self.document_to_dict(new_doc)
 			
 		
-	def _unversioned_update(self, entity, id, fields, replace=None):
+	def _unversioned_update(self, entity, id, fields, replace=None, match=None):
 		collection = self.get_collection(entity)
 		obj_id = self._objectid(id)
 		if replace:
 			doc = fields
 		else:
 			doc = { '$set': fields }
-		doc = collection.find_and_modify({ '_id': obj_id }, doc, new=True)
+		query = self.get_match_filter(entity, match)
+		query['_id'] = obj_id
+		doc = collection.find_and_modify(query, doc, new=True)
 		if doc:
 			return self.document_to_dict(doc)
-		
-		
-	def delete(self, entity, id, deleted_by=None):
+		if match and collection.find_one(obj_id, fields=['_id']):
+			raise errors.PreconditionFailedError()
+		
+		
+	def get_match_filter(self, entity, match):
+		"""
+		A filter for a document that still has the field values in `match`. If `match` 
+		is a whole stored item, the fields it doesn't have must also still be missing.
+		"""
+		query = {}
+		if match:
+			flatten(query, '', dict([(k, v) for k, v in match.items() if k != '_id']))
+			if '_id' in match:
+				for e in [entity] + entity.children:
+					for k in list(e.fields) + list(e.counter_fields):
+						if k not in match:
+							query[k] = {'$exists':False}
+		return query
+		
+		
+	def delete(self, entity, id, deleted_by=None, match=None):
 		if entity.versioned:
-			return self._versioned_delete(entity, id, deleted_by)
+			self._versioned_delete(entity, id, deleted_by, match)
 		else:
-			return self._unversioned_delete(entity, id)
+			self._unversioned_delete(entity, id, match)
+		self.publish_change(entity, id, 'delete')
 		
 		
-	def _versioned_delete(self, entity, id, deleted_by):
+	def _versioned_delete(self, entity, id, deleted_by, match=None):
 		collection = self.get_collection(entity)
 		shadow_collection = self.get_collection(entity, shadow=True)
 		obj_id = self._objectid(id)
 		current_doc = collection.find_one(obj_id)
+		if match and match.get('_version', current_doc['_version']) != current_doc['_version']:
+			raise errors.PreconditionFailedError()
 		current_doc['_id'] = {'_id':current_doc['_id'], '_version':current_doc['_version']}
 		shadow_collection.insert(current_doc)
 		new_version = current_doc['_version'] + 1
@@ -203,15 +421,112 @@ class MongoDBStorage(Storage):
 		if deleted_by:
 			delete_doc['_deleted_by'] = deleted_by
 		shadow_collection.insert(delete_doc)
-		collection.remove(obj_id)
+		if match:
+			result = collection.remove({'_id':obj_id, '_version':current_doc['_id']['_version']})
+			if not result['n']:
+				shadow_collection.remove({'_id':{'$in':[current_doc['_id'], delete_doc['_id']]}})
+				raise errors.PreconditionFailedError()
+		else:
+			collection.remove(obj_id)
 		
 		
-	def _unversioned_delete(self, entity, id):
+	def _unversioned_delete(self, entity, id, match=None):
 		collection = self.get_collection(entity)
 		obj_id = self._objectid(id)
-		collection.remove(obj_id)
+		if match:
+			query = self.get_match_filter(entity, match)
+			query['_id'] = obj_id
+			if not collection.remove(query)['n']:
+				raise errors.PreconditionFailedError()
+		else:
+			collection.remove(obj_id)
+		
+		
+	def update_many(self, entity, filter, fields):
+		collection = self.get_collection(entity)
+		filter = filter if filter else {}
+		type_filter = self.get_type_filter(entity)
+		if type_filter:
+			filter.update(type_filter)
+		collection.update(filter, {'$set':fields}, multi=True)
+		self.publish_change(entity, None, 'update')
+		
+		
+	def increment(self, entity, id, field, amount=1):
+		collection = self.get_collection(entity)
+		collection.update({'_id':self._objectid(id)}, {'$inc':{field:amount}})
+		self.publish_change(entity, id, 'update')
 		
 		
+	def repair_counter(self, entity, counter_field, linked_entity, link_field):
+		pipeline = [{'$match':self.get_type_filter(linked_entity) or {}}]
+		if isinstance(linked_entity.fields.get(link_field), ListOf):
+			pipeline.append({'$unwind':'$%s' % link_field})
+		pipeline.append({'$group':{'_id':'$%s' % link_field, 'count':{'$sum':1}}})
+		counts = self.get_collection(linked_entity).aggregate(pipeline, cursor={})
+		
+		collection = self.get_collection(entity)
+		collection.update(self.get_type_filter(entity) or {}, {'$set':{counter_field:0}}, multi=True)
+		for result in counts:
+			if result['_id'] is not None:
+				collection.update({'_id':self._objectid(result['_id'])}, {'$set':{counter_field:result['count']}})
+		self.publish_change(entity, None, 'update')
+		
+		
+	def publish_change(self, entity, id, operation):
+		"""Record a write in the change feed collection. An id of None means any item may have changed."""
+		if not self.change_feed:
+			return
+		self.db[self.change_feed].insert({
+			'entity': entity.__name__, 
+			'id': id, 
+			'operation': operation, 
+			'route': self.get_route()
+		}, w=0)
+		
+		
+	def tail_changes(self, stopped):
+		"""
+		Follow the writes recorded in the change feed collection after this is
+		called, until `stopped` is set. Returns an iterator of `(entity name, id, 
+		operation, route)`.
+		
+		If the feed overwrote changes before they were read, every entity is 
+		reported as changed with an id and route of None.
+		"""
+		collection = self.db[self.change_feed]
+		# Find where the feed ends now, not when iteration starts
+		last = list(collection.find().sort('$natural', -1).limit(1))
+		return self._follow_changes(collection, last[0]['_id'] if last else None, stopped)
+		
+		
+	def _follow_changes(self, collection, last_id, stopped):
+		while not stopped.is_set():
+			# The feed is capped, so it keeps the order the server wrote it in. Ids 
+			# come from the clients and can't be used to tell what came first, so 
+			# each cursor reads from the start and skips up to the last change seen.
+			cursor = collection.find(tailable=True, await_data=True)
+			found = last_id is None
+			while cursor.alive and not stopped.is_set():
+				try:
+					doc = cursor.next()
+				except StopIteration:
+					if not found:
+						# The last change seen has been overwritten
+						for entity in self.model.entities.values():
+							yield entity.__name__, None, 'update', None
+						found = True
+					continue
+				if not found:
+					found = doc['_id'] == last_id
+					continue
+				last_id = doc['_id']
+				route = doc.get('route')
+				yield doc['entity'], doc['id'], doc['operation'], tuple(route) if route else None
+			# The cursor dies when the collection is empty
+			stopped.wait(0.1)
+			
+			
 	def document_to_dict(self, doc):
 		doc['_id'] = self._from_objectid(doc['_id'])
 		return doc
@@ -222,19 +537,28 @@ class MongoDBStorage(Storage):
 		return doc
 		
 		
-	def get_collection(self, entity, shadow=False):
+	def get_collection(self, entity, shadow=False, route=None):
 		if len(entity.hierarchy) > 0:
 			collection_name = entity.hierarchy[0].__name__
 		else:
 			collection_name = entity.__name__
+		
+		db = self.db
+		route = route or self.get_route()
+		if route:
+			db_name, prefix = route
+			if db_name:
+				db = self.client[db_name]
+			if prefix:
+				collection_name = prefix + collection_name
 			
 		# We use getattr here instead of __getitem__ to
 		# make it easier to inject mock collections objects
 		# for testing
 		if shadow:
-			return getattr(self.db, collection_name+'.vermongo')
+			return getattr(db, collection_name+'.vermongo')
 		else:
-			return getattr(self.db, collection_name)
+			return getattr(db, collection_name)
 			
 			
 	def get_type_name(self, entity):
@@ -250,6 +574,94 @@ class MongoDBStorage(Storage):
 			return {'_type':{'$regex':'^%s' % re.escape(type_name)}}
 			
 		
+	def get_expiry_filter(self, entity):
+		if entity.expires_after:
+			field, seconds = entity.expires_after
+			cutoff = datetime.utcnow() - timedelta(seconds=seconds)
+			return {field:{'$not':{'$lte':cutoff}}}
+			
+			
+	def _merge_filters(self, filter, other):
+		if not other:
+			return filter
+		if not filter:
+			return other
+		if set(filter).intersection(other):
+			return {'$and':[filter, other]}
+		filter.update(other)
+		return filter
+			
+		
+	def check_query(self, entity, filter=None, sort=None, limit=0):
+		if not self.query_guard or self.can_use_index(entity, filter, sort):
+			return limit
+		message = 'No index can be used to filter by %s and sort by %s.' % (
+			', '.join(sorted([k for k in filter or {} if not k.startswith('$')])) or 'nothing',
+			', '.join(sort or ()) or 'nothing')
+		if self.query_guard == 'reject':
+			raise errors.UnindexedQueryError(message)
+		self.logger.warning('%s query: %s' % (entity.__name__, message))
+		if self.query_guard == 'cap':
+			return min(limit, self.query_guard_limit) if limit else self.query_guard_limit
+		return limit
+		
+		
+	def can_use_index(self, entity, filter, sort):
+		"""Guess whether Mongo can answer a query from an index instead of a collection scan."""
+		filter = self.get_and_conditions(filter if filter else {})
+		if '$text' in filter:
+			# Text searches always use the text index
+			return True
+		fields = set([k for k in filter if not k.startswith('$')])
+		equal = set([k for k in fields if not is_operator(filter[k])])
+		sort = [(x[1:], 1 if x[0] == '+' else -1) for x in sort or ()]
+		if not fields and not sort:
+			return True
+		
+		for keys in self.get_indexes(entity):
+			if not sort:
+				if keys[0][0] in fields:
+					return True
+				continue
+			sort_fields = [k for k,_ in sort]
+			remaining = list(keys)
+			while remaining and remaining[0][0] in equal and remaining[0][0] not in sort_fields:
+				remaining.pop(0)
+			prefix = remaining[:len(sort)]
+			if not all([isinstance(d, (int, float)) for _,d in prefix]):
+				continue
+			if prefix != sort and prefix != [(k, -d) for k,d in sort]:
+				continue
+			if not fields or len(remaining) < len(keys) or sort_fields[0] in fields:
+				return True
+		return False
+		
+		
+	def get_and_conditions(self, filter):
+		"""Merge the conditions combined with `$and`, like the rule filters, into one filter."""
+		if '$and' not in filter:
+			return filter
+		merged = dict([(k, v) for k, v in filter.items() if k != '$and'])
+		for sub_filter in filter['$and']:
+			for k, v in self.get_and_conditions(sub_filter).items():
+				if k in merged and not k.startswith('$'):
+					# Several conditions on one field only use it as a range
+					merged[k] = {'$and':[merged[k], v]}
+				else:
+					merged[k] = v
+		return merged
+		
+		
+	def get_indexes(self, entity):
+		"""Get the keys of the indexes on an entity's collection."""
+		collection = self.get_collection(entity)
+		indexes, fetched = self.indexes.get(collection.full_name, (None, 0))
+		if indexes is None or time.time() - fetched > self.index_refresh:
+			indexes = [v['key'] for v in collection.index_information().values()]
+			self.indexes[collection.full_name] = (indexes, time.time())
+		return indexes
+		
+		
 	def check_filter(self, filter, allowed_fields, context):
 		allowed_fields = set(allowed_fields)
 		return self._check_filter(filter, allowed_fields, context)
@@ -308,6 +720,22 @@ class MongoDBStorage(Storage):
 		except:
 			return str(id)
 			
+	def _convert_ids(self, filter):
+		"""Turn the ids in the `_id` conditions of a filter into ObjectIds."""
+		value = filter.get('_id')
+		if isinstance(value, basestring):
+			filter['_id'] = self._objectid(value)
+		elif isinstance(value, dict):
+			for op, v in value.items():
+				if isinstance(v, basestring):
+					value[op] = self._objectid(v)
+				elif isinstance(v, (list, tuple)):
+					value[op] = [self._objectid(x) if isinstance(x, basestring) else x for x in v]
+		for op in ('$and', '$or'):
+			for sub_filter in filter.get(op, ()):
+				self._convert_ids(sub_filter)
+				
+				
 	def _from_objectid(self, id):
 		if isinstance(id, ObjectId):
 			return str(id)
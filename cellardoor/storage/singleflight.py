@@ -0,0 +1,135 @@
+import sys
+import threading
+from copy import deepcopy
+from . import WrappedStorage, freeze
+
+
+
+class Flight(object):
+	
+	def __init__(self):
+		self.done = threading.Event()
+		self.followers = 0
+		self.result = None
+		self.error = None
+
+
+
+class SingleFlightStorage(WrappedStorage):
+	"""
+	Makes identical reads that run at the same time share one call to the
+	wrapped storage. The first caller runs the read and the others wait for
+	its result. When a read was shared every caller gets its own copy of the
+	result, so they can change it without affecting each other.
+	
+	Reads are identical when they're for the same entity, arguments and route.
+	A write to an entity makes later reads of it start a new call instead of
+	joining one that may have started before the write, or while it ran.
+	"""
+	
+	def __init__(self, storage):
+		super(SingleFlightStorage, self).__init__(storage)
+		self.lock = threading.Lock()
+		self.flights = {}
+		self.generations = {}
+	
+	
+	def get(self, entity, *args, **kwargs):
+		return self.share('get', entity, args, kwargs)
+	
+	
+	def get_by_ids(self, entity, ids, *args, **kwargs):
+		return self.share('get_by_ids', entity, (ids,) + args, kwargs)
+	
+	
+	def get_by_id(self, entity, id, *args, **kwargs):
+		return self.share('get_by_id', entity, (id,) + args, kwargs)
+	
+	
+	def distinct(self, entity, field, *args, **kwargs):
+		return self.share('distinct', entity, (field,) + args, kwargs)
+	
+	
+	def create(self, entity, fields, *args, **kwargs):
+		return self.write('create', entity, fields, *args, **kwargs)
+	
+	
+	def create_many(self, entity, items, *args, **kwargs):
+		return self.write('create_many', entity, items, *args, **kwargs)
+	
+	
+	def update(self, entity, id, fields, *args, **kwargs):
+		return self.write('update', entity, id, fields, *args, **kwargs)
+	
+	
+	def update_many(self, entity, filter, fields):
+		return self.write('update_many', entity, filter, fields)
+	
+	
+	def delete(self, entity, id, *args, **kwargs):
+		return self.write('delete', entity, id, *args, **kwargs)
+	
+	
+	def increment(self, entity, id, field, amount=1):
+		return self.write('increment', entity, id, field, amount)
+	
+	
+	def repair_counter(self, entity, counter_field, linked_entity, link_field):
+		return self.write('repair_counter', entity, counter_field, linked_entity, link_field)
+	
+	
+	def write(self, method, entity, *args, **kwargs):
+		self.changed(entity)
+		try:
+			return getattr(self.storage, method)(entity, *args, **kwargs)
+		finally:
+			# Reads that started while the write ran may not have seen it
+			self.changed(entity)
+	
+	
+	def changed(self, entity):
+		with self.lock:
+			for e in entity.hierarchy + [entity] + entity.children:
+				self.generations[e] = self.generations.get(e, 0) + 1
+	
+	
+	def share(self, method, entity, args, kwargs):
+		try:
+			key = (method, entity, self.storage.get_route(), freeze(args), freeze(kwargs))
+		except TypeError:
+			# Something in the arguments can't be compared, so don't share the read
+			return getattr(self.storage, method)(entity, *args, **kwargs)
+		
+		with self.lock:
+			key += (self.generations.get(entity, 0),)
+			flight = self.flights.get(key)
+			if flight is None:
+				flight = self.flights[key] = Flight()
+				leader = True
+			else:
+				flight.followers += 1
+				leader = False
+		
+		if not leader:
+			flight.done.wait()
+			if flight.error:
+				raise flight.error[0], flight.error[1], flight.error[2]
+			return deepcopy(flight.result)
+		
+		try:
+			result = getattr(self.storage, method)(entity, *args, **kwargs)
+			if hasattr(result, 'next'):
+				# Iterators can only be read once
+				result = list(result)
+			flight.result = result
+		except Exception:
+			flight.error = sys.exc_info()
+		finally:
+			with self.lock:
+				del self.flights[key]
+				shared = flight.followers > 0
+			flight.done.set()
+		
+		if flight.error:
+			raise flight.error[0], flight.error[1], flight.error[2]
+		return deepcopy(result) if shared else result
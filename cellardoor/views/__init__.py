@@ -11,6 +11,9 @@ class View(object):
 		
 		
 	def serialize(self, req, obj):
+		if req.env.get('cellardoor.batch'):
+			# The results of batched operations are serialized together
+			return None, obj
 		content_type, serializer = self.get_serializer(req)
 		return content_type, serializer.serialize(obj)
 		
@@ -2,7 +2,14 @@ import functools
 import falcon
 import logging
 import inspect
+import re
+import urllib
+from hashlib import md5
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from falcon.routing import DefaultRouter
 from ..api.methods import LIST, CREATE, GET, REPLACE, UPDATE, DELETE, get_http_methods
+from ..api.interface import etag_matches
 from ..serializers import JSONSerializer, MsgPackSerializer
 from ..views import View
 from ..views.minimal import MinimalView
@@ -11,6 +18,16 @@ from .. import errors
 __all__ = ['add_to_falcon']
 
 
+find_variant_pattern = re.compile(r'\.[0-9a-f]{6}"$')
+
+
+def variant_etag(etag, variant):
+	"""Give the ETag of an item sent in another than the default content type its own suffix."""
+	if not etag or not variant:
+		return etag
+	return '%s.%s"' % (etag[:-1], md5(variant).hexdigest()[:6])
+	
+	
 class Resource(object):
 	"""
 	A resource exposes an interface through falcon
@@ -38,6 +55,9 @@ class Resource(object):
 		if interface_methods:
 			app.add_route('/%s' % self.interface.plural_name, ListEndpoint(self, interface_methods))
 			
+		if LIST in methods:
+			app.add_route('/%s/_distinct/{field}' % self.interface.plural_name, DistinctEndpoint(self))
+			
 		if individual_methods:
 			app.add_route('/%s/{id}' % self.interface.plural_name, IndividualEndpoint(self, individual_methods))
 		
@@ -48,9 +68,21 @@ class Resource(object):
 			
 	
 	def list(self, req, resp):
+		if req.get_param('ids'):
+			return self.get_many(req, resp)
 		kwargs = self.get_kwargs(req)
 		items = self.interface.list(**kwargs)
 		self.send_list(req, resp, items)
+		self.check_body_etag(req, resp)
+		
+		
+	def get_many(self, req, resp):
+		if GET not in self.interface.rules.enabled_methods:
+			raise falcon.HTTPBadRequest('Bad Request', 'Fetching items by ID is not enabled.')
+		ids = [x for x in req.get_param_as_list('ids', required=True) if x]
+		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embed')
+		items = self.interface.get_many(ids, **kwargs)
+		self.send_list(req, resp, items)
 		
 		
 	def count(self, req, resp):
@@ -61,36 +93,49 @@ class Resource(object):
 		resp.set_header('X-Count', str(result))
 		
 		
+	def distinct(self, req, resp, field):
+		kwargs = self.get_kwargs(req, 'filter', 'context')
+		values = self.interface.distinct(field, **kwargs)
+		self.send_list(req, resp, values)
+		
+		
 	def create(self, req, resp):
 		fields = self.get_fields_from_request(req)
-		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embedded')
+		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embed')
 		item = self.interface.create(fields, **kwargs)
 		resp.status = falcon.HTTP_201
 		self.send_one(req, resp, item)
 		
 	
 	def get(self, req, resp, id):
-		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embedded')
-		item = self.interface.get(id, **kwargs)
+		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embed')
+		variant = self.get_variant(req)
+		try:
+			item, etag = self.interface.get_with_etag(id, 
+				if_none_match=self.get_variant_etags(req, variant), **kwargs)
+		except errors.NotModifiedError, e:
+			e.etag = variant_etag(e.etag, variant)
+			raise
+		resp.etag = variant_etag(etag, variant)
 		self.send_one(req, resp, item)
 		
 		
 	def update(self, req, resp, id):
 		fields = self.get_fields_from_request(req)
-		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embedded')
-		item = self.interface.update(id, fields, **kwargs)
+		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embed')
+		item = self.interface.update(id, fields, if_match=self.get_etags(req, 'If-Match'), **kwargs)
 		self.send_one(req, resp, item)
 		
 		
 	def replace(self, req, resp, id):
 		fields = self.get_fields_from_request(req)
-		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embedded')
-		item = self.interface.replace(id, fields, **kwargs)
+		kwargs = self.get_kwargs(req, 'show_hidden', 'context', 'embed')
+		item = self.interface.replace(id, fields, if_match=self.get_etags(req, 'If-Match'), **kwargs)
 		self.send_one(req, resp, item)
 		
 		
 	def delete(self, req, resp, id):
-		self.interface.delete(id, context=self.get_context(req))
+		self.interface.delete(id, if_match=self.get_etags(req, 'If-Match'), context=self.get_context(req))
 		
 		
 	def get_link_or_reference(self, req, resp, id, link_name):
@@ -111,6 +156,43 @@ class Resource(object):
 			resp.set_header('X-Count', str(result))
 		
 		
+	def get_etags(self, req, header):
+		value = req.get_header(header)
+		if not value:
+			return None
+		etags = [x.strip() for x in value.split(',') if x.strip()]
+		if header == 'If-Match':
+			# Writes only care about the item, not which content type the client got
+			etags = [find_variant_pattern.sub('"', x) for x in etags]
+		return etags
+		
+		
+	def get_variant(self, req):
+		"""Get the content type an item is sent in, or None if it's the default one."""
+		content_type, _ = View.choose(req, self.views)
+		return None if content_type == self.views[0][0] else content_type
+		
+		
+	def get_variant_etags(self, req, variant):
+		"""Get the If-None-Match ETags for the item's `variant` content type, without its suffix."""
+		etags = self.get_etags(req, 'If-None-Match')
+		if not etags or not variant:
+			return etags
+		suffix = variant_etag('""', variant)[1:]
+		return [x if x == '*' else x[:-len(suffix)] + '"' for x in etags if x == '*' or x.endswith(suffix)]
+		
+		
+	def check_body_etag(self, req, resp):
+		"""Set an ETag from a hash of the body and send 304 if the client has it already"""
+		if not isinstance(resp.body, basestring):
+			# Batched operations aren't serialized yet
+			return
+		resp.etag = '"%s"' % md5(resp.body).hexdigest()
+		if etag_matches(resp.etag, self.get_etags(req, 'If-None-Match')):
+			resp.status = falcon.HTTP_304
+			resp.body = None
+		
+		
 	def send_one(self, req, resp, item):
 		resp.content_type, resp.body = self.serialize_one(req, item)
 		
@@ -159,7 +241,7 @@ class Resource(object):
 	def get_kwargs(self, req, *include):
 		"""Parse out the filter, sort, etc., parameters from a request"""
 		params = (
-			('embedded', self.params_serializer.unserialize_string, None),
+			('embed', self.params_serializer.unserialize_string, None),
 			('filter', self.params_serializer.unserialize_string, None),
 			('sort', self.params_serializer.unserialize_string, None),
 			('offset', int, 0),
@@ -203,11 +285,128 @@ class Resource(object):
 		identity = req.env.get('cellardoor.identity')
 		if identity:
 			context['identity'] = identity
+		identity_map = req.env.get('cellardoor.identity_map')
+		if identity_map is not None:
+			context['identity_map'] = identity_map
 		return context
 		
 			
 			
 			
+class BatchResource(Resource):
+	"""
+	Runs a list of operations posted to `/_batch` through the other resources 
+	and returns all their results in one response. Each operation is a dict 
+	with a `method`, a `path` and optionally `params`, `headers` and a `body`. The result 
+	of each operation is a dict with its `status`, `headers` and `body`.
+	"""
+	
+	read_methods = ('GET', 'HEAD')
+	
+	def __init__(self, app, views, workers=0, max_operations=50):
+		self.app = app
+		self.interface = None
+		self.views = views
+		self.logger = logging.getLogger(__name__)
+		self.max_operations = max_operations
+		self.pool = ThreadPool(workers) if workers else None
+		
+		
+	def run(self, req, resp):
+		operations = self.get_fields_from_request(req)
+		if not isinstance(operations, list) or not all([isinstance(x, dict) for x in operations]):
+			raise falcon.HTTPBadRequest('Bad Request', 'A batch must be a list of operations.')
+		if len(operations) > self.max_operations:
+			raise falcon.HTTPBadRequest('Bad Request', 'No more than %d operations can be run at once.' % self.max_operations)
+		
+		identity_map = {}
+		run = lambda operation: self.run_operation(req, operation, identity_map)
+		results = []
+		reads = []
+		for operation in operations:
+			if str(operation.get('method', 'GET')).upper() in self.read_methods:
+				reads.append(operation)
+				continue
+			results.extend(self.run_reads(run, reads))
+			reads = []
+			results.append(run(operation))
+		results.extend(self.run_reads(run, reads))
+		
+		self.send_list(req, resp, results)
+		
+		
+	def run_reads(self, run, operations):
+		"""Run operations that don't change anything, in parallel if there is a pool"""
+		if self.pool and len(operations) > 1:
+			return self.pool.map(run, operations)
+		return map(run, operations)
+		
+		
+	def run_operation(self, req, operation, identity_map):
+		method = str(operation.get('method', 'GET')).upper()
+		path, _, query_string = str(operation.get('path', '')).partition('?')
+		
+		endpoint, _, params = self.app.router.find(path)
+		if endpoint is None:
+			return self.get_error_result(falcon.HTTPNotFound())
+		responder = getattr(endpoint, 'on_%s' % method.lower(), None)
+		if responder is None:
+			allowed = [x[3:].upper() for x in dir(endpoint) if x.startswith('on_')]
+			return self.get_error_result(falcon.HTTPMethodNotAllowed(allowed))
+		
+		env = dict([(k, v) for k, v in req.env.items() if not k.startswith('HTTP_IF_')])
+		for k, v in (operation.get('headers') or {}).items():
+			env['HTTP_%s' % str(k).upper().replace('-', '_')] = str(v)
+		env.update({
+			'REQUEST_METHOD': method,
+			'PATH_INFO': path,
+			'QUERY_STRING': self.get_query_string(query_string, operation.get('params')),
+			'CONTENT_TYPE': self.params_serializer.mimetype,
+			'cellardoor.batch': True,
+			'cellardoor.identity_map': identity_map
+		})
+		body = self.params_serializer.serialize(operation['body']) if 'body' in operation else ''
+		env['CONTENT_LENGTH'] = str(len(body))
+		env['wsgi.input'] = StringIO(body)
+		
+		op_req = falcon.Request(env)
+		op_resp = falcon.Response()
+		try:
+			try:
+				responder(op_req, op_resp, **params)
+			except Exception, e:
+				self.app.handle_error(e, op_req, op_resp, params)
+		except falcon.HTTPError, e:
+			return self.get_error_result(e)
+		except Exception:
+			self.logger.exception('Failed to run a batched operation.')
+			return self.get_error_result(falcon.HTTPInternalServerError('Internal Server Error', None))
+		
+		# Falcon only exposes the headers of a response as they're sent
+		headers = dict([(k, v) for k, v in op_resp._headers.items() if k != 'content-type'])
+		return {'status':int(op_resp.status.split()[0]), 'headers':headers, 'body':op_resp.body}
+		
+		
+	def get_query_string(self, query_string, params):
+		if not params:
+			return query_string
+		encoded = []
+		for k, v in params.items():
+			if not isinstance(v, basestring):
+				v = self.params_serializer.serialize(v)
+			encoded.append((k, v.encode('utf-8') if isinstance(v, unicode) else v))
+		return '&'.join([x for x in (query_string, urllib.urlencode(encoded)) if x])
+		
+		
+	def get_error_result(self, error):
+		body = {}
+		if error.title:
+			body['title'] = error.title
+		if error.description:
+			body['description'] = error.description
+		return {'status':int(error.status.split()[0]), 'headers':error.headers or {}, 'body':body}
+		
+		
 class Endpoint(object):
 	
 	def __init__(self, resource, methods):
@@ -257,6 +456,26 @@ class IndividualEndpoint(Endpoint):
 		return self.resource.delete(req, resp, id)
 		
 		
+class DistinctEndpoint(object):
+	
+	def __init__(self, resource):
+		self.resource = resource
+		
+		
+	def on_get(self, req, resp, field):
+		return self.resource.distinct(req, resp, field)
+		
+		
+class BatchEndpoint(object):
+	
+	def __init__(self, resource):
+		self.resource = resource
+		
+		
+	def on_post(self, req, resp):
+		return self.resource.run(req, resp)
+		
+		
 class ReferenceEndpoint(object):
 	
 	def __init__(self, resource, link_name):
@@ -273,6 +492,15 @@ class ReferenceEndpoint(object):
 		
 		
 		
+def not_modified_handler(exc, req, resp, params):
+	resp.status = falcon.HTTP_304
+	resp.etag = exc.etag
+	
+	
+def precondition_failed_handler(exc, req, resp, params):
+	raise falcon.HTTPPreconditionFailed('Precondition Failed', 'The item has changed.')
+	
+	
 def not_found_handler(exc, req, resp, params):
 	raise falcon.HTTPNotFound()
 
@@ -295,6 +523,10 @@ def disabled_field_error(exc, req, resp, params):
 	raise falcon.HTTPUnauthorized('Unauthorized', exc.message)
 	
 	
+def unindexed_query_error(exc, req, resp, params):
+	raise falcon.HTTPBadRequest('Bad Request', exc.message)
+	
+	
 def duplicate_field_error(views, exc, req, resp, params):
 	error = {}
 	error[exc.message] = 'A duplicate value already exists.'
@@ -305,11 +537,13 @@ def duplicate_field_error(views, exc, req, resp, params):
 		
 class FalconApp(object):
 	
-	def __init__(self, api, falcon_app=None, views=(MinimalView,)):
+	def __init__(self, api, falcon_app=None, views=(MinimalView,), batch_workers=0, max_batch_operations=50):
 		if falcon_app is None:
 			falcon_app = falcon.API()
 		self.falcon_app = falcon_app
 		self.api = api
+		self.router = DefaultRouter()
+		self.error_handlers = []
 		
 		views_by_type = []
 		
@@ -319,19 +553,45 @@ class FalconApp(object):
 			for mimetype, _ in v.serializers:
 				views_by_type.append((mimetype, v))
 				
-		falcon_app.add_error_handler(errors.NotFoundError, not_found_handler)
-		falcon_app.add_error_handler(errors.NotAuthenticatedError, not_authenticated_handler)
-		falcon_app.add_error_handler(errors.NotAuthorizedError, not_authorized_handler)
+		self.add_error_handler(errors.NotModifiedError, not_modified_handler)
+		self.add_error_handler(errors.PreconditionFailedError, precondition_failed_handler)
+		self.add_error_handler(errors.NotFoundError, not_found_handler)
+		self.add_error_handler(errors.NotAuthenticatedError, not_authenticated_handler)
+		self.add_error_handler(errors.NotAuthorizedError, not_authorized_handler)
 		validation_error_handler_with_views = functools.partial(validation_error_handler, views_by_type)
-		falcon_app.add_error_handler(errors.CompoundValidationError, validation_error_handler_with_views)
-		falcon_app.add_error_handler(errors.DisabledFieldError, disabled_field_error)
+		self.add_error_handler(errors.CompoundValidationError, validation_error_handler_with_views)
+		self.add_error_handler(errors.DisabledFieldError, disabled_field_error)
+		self.add_error_handler(errors.UnindexedQueryError, unindexed_query_error)
 		duplicate_field_error_with_views = functools.partial(duplicate_field_error, views_by_type)
-		falcon_app.add_error_handler(errors.DuplicateError, duplicate_field_error_with_views)
+		self.add_error_handler(errors.DuplicateError, duplicate_field_error_with_views)
 		
 		for interface in api.interfaces.values():
 			resource = Resource(interface, views_by_type)
-			resource.add_to_falcon(falcon_app)
-			
-			
+			resource.add_to_falcon(self)
+		
+		batch_resource = BatchResource(self, views_by_type, 
+			workers=batch_workers, max_operations=max_batch_operations)
+		falcon_app.add_route('/_batch', BatchEndpoint(batch_resource))
+		
+		
+	def add_route(self, uri_template, endpoint):
+		"""Add a route to falcon and to the routes batched operations are matched against"""
+		self.falcon_app.add_route(uri_template, endpoint)
+		self.router.add_route(uri_template, {}, endpoint)
+		
+		
+	def add_error_handler(self, exception, handler):
+		self.falcon_app.add_error_handler(exception, handler)
+		self.error_handlers.insert(0, (exception, handler))
+		
+		
+	def handle_error(self, e, req, resp, params):
+		"""Handle an error the way falcon would, for a batched operation"""
+		for exception, handler in self.error_handlers:
+			if isinstance(e, exception):
+				return handler(e, req, resp, params)
+		raise
+		
+		
 	def __call__(self, *args, **kwargs):
 		return self.falcon_app(*args, **kwargs)
\ No newline at end of file
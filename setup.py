@@ -30,6 +30,9 @@ setup(
     url='http://github.com/cooper-software/cellardoor',
     license='MIT',
     packages=find_packages(exclude=['tests']),
+    entry_points={
+        'console_scripts': ['cellardoor = cellardoor.cli:main']
+    },
     install_requires=[
         'falcon',
         'pymongo',
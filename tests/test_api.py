@@ -4,6 +4,7 @@ from cellardoor import errors
 from cellardoor.api import API, StandardOptionsMixin, InterfaceProxy, FilterProxy, LinkProxy
 from cellardoor.api.methods import ALL
 from cellardoor.storage import Storage
+from cellardoor.storage.changes import ChangeFeed
 from cellardoor.model import Model, Entity
 
 storage = Storage()
@@ -61,6 +62,8 @@ def get_fake_interface():
 	interface.hooks.listeners.keys = Mock(return_value=[])
 	interface.hooks.listeners.items = Mock(return_value=[])
 	interface.entity.get_link = lambda x: True
+	interface.default_sort = ()
+	interface.get_linked_interface.return_value.default_sort = ()
 	return interface
 		
 		
@@ -79,6 +82,30 @@ class TestAPI(unittest.TestCase):
 		self.assertEquals(interface_proxy._interface, api.interfaces['foo'])
 		self.assertEquals(interface_proxy._api_options, api._options)
 		
+	def test_proxies_are_cached(self):
+		"""The same proxy is returned each time and setting an option leaves it alone"""
+		api = API(None)
+		api.interfaces['foo'] = get_fake_interface()
+		proxy = api.foo
+		self.assertTrue(api.foo is proxy)
+		configured = proxy.show_hidden(True).fields(['a'])
+		self.assertFalse(configured is proxy)
+		self.assertEquals(configured._options, {'show_hidden':True, 'fields':['a']})
+		self.assertEquals(proxy._options, {})
+		self.assertEquals(api.foo.identity('bob')._options, {'context':{'identity':'bob'}})
+		self.assertEquals(api.foo._options, {})
+		
+		
+	def test_proxies_see_api_options(self):
+		api = API(None)
+		api.interfaces['foo'] = get_fake_interface()
+		api.interfaces['foo'].get = Mock()
+		api.foo
+		api.bypass_authorization(True)
+		api.foo.get('1')
+		api.interfaces['foo'].get.assert_called_once_with('1', bypass_authorization=True)
+		
+		
 	def test_getitem(self):
 		api = API(None)
 		api.__getattr__ = Mock()
@@ -86,6 +113,37 @@ class TestAPI(unittest.TestCase):
 		api.__getattr__.assert_called_once_with('foo')
 		
 		
+	def test_change_feed(self):
+		"""Changes from the change feed clear the cached distinct values"""
+		storage = Storage()
+		storage.distinct = Mock(return_value=['a'])
+		feed = ChangeFeed(storage)
+		model = Model(storage=storage)
+		api = API(model, change_feed=feed)
+		
+		class Bar(model.Entity):
+			pass
+			
+		class Bars(api.Interface):
+			entity = Bar
+			method_authorization = {
+				ALL: None
+			}
+			cache_distinct = True
+			
+		bars = api.interfaces['bars']
+		bars.distinct('_id')
+		feed.publish('Foo', '1', 'update')
+		bars.distinct('_id')
+		self.assertEquals(storage.distinct.call_count, 1)
+		feed.publish('Bar', '1', 'update', ('tenant', None))
+		bars.distinct('_id')
+		self.assertEquals(storage.distinct.call_count, 1)
+		feed.publish('Bar', '1', 'update', None)
+		bars.distinct('_id')
+		self.assertEquals(storage.distinct.call_count, 2)
+		
+		
 class TestInterfaceProxy(unittest.TestCase):
 	
 	def test_options(self):
@@ -155,6 +213,17 @@ class TestInterfaceProxy(unittest.TestCase):
 			interface_proxy.get({'foo':'bar'})
 			
 			
+	def test_get_many(self):
+		interface = get_fake_interface()
+		interface.get_many = Mock(return_value=[1, None])
+		interface_proxy = InterfaceProxy(interface)
+		interface_proxy.show_hidden(True)
+		
+		result = interface_proxy.get_many(['1', '2'])
+		self.assertEquals(result, [1, None])
+		interface.get_many.assert_called_once_with(['1', '2'], show_hidden=True)
+		
+		
 	def test_find(self):
 		interface = get_fake_interface()
 		interface_proxy = InterfaceProxy(interface)
@@ -205,12 +274,56 @@ class TestFilterProxy(unittest.TestCase):
 		
 	def test_iter(self):
 		interface = get_fake_interface()
-		interface.list = Mock(return_value=[1,2,3])
+		interface.list = Mock(side_effect=[[{'_id':'1'}, {'_id':'2'}], []])
 		filter_proxy = FilterProxy(interface, {}, {'foo':'bar'})
 		filter_proxy.show_hidden(True)
 		result = list(iter(filter_proxy))
-		self.assertEquals(result, [1,2,3])
-		interface.list.assert_called_once_with(filter={'foo':'bar'}, show_hidden=True)
+		self.assertEquals(result, [{'_id':'1'}, {'_id':'2'}])
+		self.assertEquals(interface.list.call_args_list, [
+			((), {'filter':{'foo':'bar'}, 'show_hidden':True, 'sort':('+_id',), 'limit':100}),
+			((), {'filter':{'foo':'bar', '_id':{'$gt':'2'}}, 'show_hidden':True, 'sort':('+_id',), 'limit':100}),
+		])
+		
+		
+	def test_iter_pages(self):
+		"""Iterating fetches a page at a time, following on from the last id"""
+		interface = get_fake_interface()
+		interface.list = Mock(side_effect=[[{'_id':'1'}, {'_id':'2'}], [{'_id':'3'}], []])
+		filter_proxy = FilterProxy(interface, {}, {'_id':{'$ne':'0'}}).page_size(2)
+		iterator = iter(filter_proxy)
+		self.assertEquals(next(iterator), {'_id':'1'})
+		self.assertEquals(interface.list.call_count, 1)
+		self.assertEquals(list(iterator), [{'_id':'2'}, {'_id':'3'}])
+		self.assertEquals(interface.list.call_args_list[1], ((), {
+			'filter':{'$and':[{'_id':{'$ne':'0'}}, {'_id':{'$gt':'2'}}]}, 
+			'sort':('+_id',), 'limit':2}))
+		self.assertEquals(interface.list.call_count, 3)
+		
+		
+	def test_iter_sorted(self):
+		"""Sorted iteration pages by offset and stops at the limit"""
+		interface = get_fake_interface()
+		interface.list = Mock(side_effect=[[1, 2], [3]])
+		filter_proxy = FilterProxy(interface, {}, {}).sort(('-foo',)).offset(5).limit(3).page_size(2)
+		self.assertEquals(filter_proxy.list(), [1, 2, 3])
+		self.assertEquals(interface.list.call_args_list, [
+			((), {'filter':{}, 'sort':('-foo',), 'offset':5, 'limit':2}),
+			((), {'filter':{}, 'sort':('-foo',), 'offset':7, 'limit':1}),
+		])
+		
+		
+	def test_iter_default_sort(self):
+		"""Iterating an interface with a default sort pages by offset in that order"""
+		interface = get_fake_interface()
+		interface.default_sort = ('+name',)
+		interface.list = Mock(side_effect=[[{'_id':'2'}, {'_id':'1'}], [{'_id':'3'}], []])
+		filter_proxy = FilterProxy(interface, {}, {}).page_size(2)
+		self.assertEquals(filter_proxy.list(), [{'_id':'2'}, {'_id':'1'}, {'_id':'3'}])
+		self.assertEquals(interface.list.call_args_list, [
+			((), {'filter':{}, 'limit':2}),
+			((), {'filter':{}, 'offset':2, 'limit':2}),
+			((), {'filter':{}, 'offset':3, 'limit':2}),
+		])
 		
 		
 	def test_count(self):
@@ -233,30 +346,46 @@ class TestFilterProxy(unittest.TestCase):
 		
 	def test_contains(self):
 		interface = get_fake_interface()
-		interface.list = Mock(return_value=[])
+		interface.list = Mock(return_value=0)
 		filter_proxy = FilterProxy(interface, {}, {'foo':'bar'})
 		filter_proxy.show_hidden(True)
 		
 		result = '123' in filter_proxy
 		self.assertEquals(result, False)
-		interface.list.assert_called_once_with(filter={'_id':'123', 'foo':'bar'}, limit=1, show_hidden=True)
+		interface.list.assert_called_once_with(filter={'_id':'123', 'foo':'bar'}, count=True, show_hidden=True)
 		
-		interface.list = Mock(return_value=[1])
+		interface.list = Mock(return_value=1)
 		result = '123' in filter_proxy
 		self.assertEquals(result, True)
 		
-		interface.list = Mock(return_value=[1])
+		interface.list = Mock(return_value=1)
 		result = {'_id':'123'} in filter_proxy
 		self.assertEquals(result, True)
-		interface.list.assert_called_once_with(filter={'_id':'123', 'foo':'bar'}, limit=1, show_hidden=True)
+		interface.list.assert_called_once_with(filter={'_id':'123', 'foo':'bar'}, count=True, show_hidden=True)
 		
 		
 class TestLinkProxy(unittest.TestCase):
 	
 	def test_list(self):
 		interface = get_fake_interface()
-		interface.link = Mock(return_value=[1,2,3])
+		interface.link = Mock(side_effect=[[{'_id':'1'}, {'_id':'2'}], []])
 		link_proxy = LinkProxy(interface, {}, 'related_things', 'an_id')
 		result = link_proxy.list()
-		self.assertEquals(result, [1,2,3])
-		interface.link.assert_called_once_with('an_id', 'related_things', filter={})
\ No newline at end of file
+		self.assertEquals(result, [{'_id':'1'}, {'_id':'2'}])
+		self.assertEquals(interface.link.call_args_list, [
+			(('an_id', 'related_things'), {'filter':{}, 'sort':('+_id',), 'limit':100}),
+			(('an_id', 'related_things'), {'filter':{'_id':{'$gt':'2'}}, 'sort':('+_id',), 'limit':100}),
+		])
+		
+		
+	def test_list_default_sort(self):
+		"""Links to an interface with a default sort are paged by offset"""
+		interface = get_fake_interface()
+		interface.get_linked_interface.return_value.default_sort = ('-name',)
+		interface.link = Mock(side_effect=[[{'_id':'2'}, {'_id':'1'}], []])
+		link_proxy = LinkProxy(interface, {}, 'related_things', 'an_id')
+		self.assertEquals(link_proxy.list(), [{'_id':'2'}, {'_id':'1'}])
+		self.assertEquals(interface.link.call_args_list, [
+			(('an_id', 'related_things'), {'filter':{}, 'limit':100}),
+			(('an_id', 'related_things'), {'filter':{}, 'offset':2, 'limit':100}),
+		])
@@ -377,6 +377,90 @@ class TestAuthorization(unittest.TestCase):
 		self.assertEquals(expr_one, expr_two)
 		
 		
+	def test_compile(self):
+		"""Compiled expressions give the same results as the expressions"""
+		item = ObjectProxy('item')
+		identity = ObjectProxy('identity')
+		rules = [
+			(item.owner == identity.id) | (identity.role == 'admin'),
+			(item.size > 3) & item.owner.exists(),
+			identity.role.in_(['admin', 'editor']),
+			identity.match(lambda x: x.get('role') == 'admin'),
+			identity.exists(),
+			item.size <= 3
+		]
+		contexts = [
+			{},
+			{'identity':{'id':'1', 'role':'user', 'groups':['a']}},
+			{'identity':{'id':'1', 'role':'admin', 'groups':[]}, 'item':{'owner':'2', 'size':5}},
+			{'identity':{'id':'1', 'role':'user', 'groups':['a']}, 'item':{'owner':'1', 'size':1, 'group':'a'}},
+		]
+		for rule in rules:
+			fn = rule.compile()
+			for context in contexts:
+				self.assertEquals(bool(fn(context)), bool(rule(context)))
+		
+		
+	def test_compile_link(self):
+		"""Compiled link proxies get the linked item through the api"""
+		api = Mock()
+		api.get_interface_for_entity.return_value.link.return_value = {'baz':'x'}
+		rule = (ItemProxy(Foo).bar.baz == 'x').compile()
+		self.assertTrue(rule({'api':api, 'item':{'_id':'1', 'bar':'2'}}))
+		api.get_interface_for_entity.return_value.link.assert_called_once_with('1', 'bar',
+			bypass_authorization=True, show_hidden=True)
+		
+		
+	def test_to_filter(self):
+		"""Rules that compare item fields with values become storage filters"""
+		item = ObjectProxy('item')
+		identity = ObjectProxy('identity')
+		context = {'identity':{'id':'123', 'role':'user', 'groups':['a', 'b']}}
+		
+		self.assertEquals((item.owner == identity.id).to_filter(context), {'owner':'123'})
+		self.assertEquals((identity.id == item.owner).to_filter(context), {'owner':'123'})
+		self.assertEquals((item.size > 3).to_filter(context), {'size':{'$gt':3}})
+		self.assertEquals((identity.id < item.size).to_filter(context), {'size':{'$gt':'123'}})
+		self.assertEquals((item.size != None).to_filter(context), {'size':{'$ne':None}})
+		self.assertEquals(item.group.in_(identity.groups).to_filter(context), {'group':{'$in':['a', 'b']}})
+		self.assertEquals(identity.id.in_(item.members).to_filter(context), {'members':'123'})
+		self.assertEquals(item.owner.to_filter(context), {'owner':{'$exists':True}})
+		self.assertEquals(item.to_filter(context), True)
+		
+		
+	def test_to_filter_combined(self):
+		"""And and or expressions combine their filters, skipping parts that don't depend on the item"""
+		item = ObjectProxy('item')
+		identity = ObjectProxy('identity')
+		admin = {'identity':{'id':'123', 'role':'admin'}}
+		user = {'identity':{'id':'123', 'role':'user'}}
+		
+		rule = (identity.role == 'admin') | (item.owner == identity.id)
+		self.assertEquals(rule.to_filter(admin), True)
+		self.assertEquals(rule.to_filter(user), {'owner':'123'})
+		
+		rule = (identity.role == 'admin') & (item.owner == identity.id)
+		self.assertEquals(rule.to_filter(admin), {'owner':'123'})
+		self.assertEquals(rule.to_filter(user), False)
+		
+		rule = (item.owner == identity.id) | (item.public == True)
+		self.assertEquals(rule.to_filter(user), {'$or':[{'owner':'123'}, {'public':True}]})
+		
+		
+	def test_to_filter_fail(self):
+		"""Rules that can't be run by storage raise an error"""
+		item = ObjectProxy('item')
+		identity = ObjectProxy('identity')
+		item_proxy = ItemProxy(Foo)
+		with self.assertRaises(FilterCompilationError):
+			item.match(lambda x: True).to_filter({})
+		with self.assertRaises(FilterCompilationError):
+			(item.a == item.b).to_filter({})
+		with self.assertRaises(FilterCompilationError):
+			(item_proxy.bar.baz == 'x').to_filter({})
+		self.assertEquals((item_proxy.bar == 'x').to_filter({}), {'bar':'x'})
+		
+		
 	def test_item_proxy_is_object_proxy(self):
 		"""An ItemProxy should be a kind of ObjectProxy"""
 		foo = ItemProxy(None, None)
@@ -410,6 +494,26 @@ class TestAuthorization(unittest.TestCase):
 		self.assertIsInstance(link, ItemProxy)
 		
 		
+	def test_link_proxy_prefetch(self):
+		"""Link proxies can resolve the links of a list of items at once and use them"""
+		interface = Mock()
+		interface.entity = Foo
+		interface.get_linked_interface.return_value.resolve_links.return_value = [{'_id':'1', 'name':'a'}, None]
+		api = Mock()
+		api.get_interface_for_entity.return_value = interface
+		proxy = ItemProxy(Foo).bar
+		items = [{'_id':'x', 'bar':'1'}, {'_id':'y'}]
+		prefetched = proxy.prefetch(items, {'api':api})
+		api.get_interface_for_entity.assert_called_once_with(Foo)
+		interface.get_linked_interface.assert_called_once_with('bar')
+		interface.get_linked_interface.return_value.resolve_links.assert_called_once_with(
+			items, 'bar', Foo.bar, {'bypass_authorization':True, 'show_hidden':True})
+		self.assertEquals(prefetched, {'x':{'_id':'1', 'name':'a'}, 'y':None})
+		context = {'item':{'_id':'x', 'bar':'1'}, '_prefetched':{proxy.prefetch_key:prefetched}}
+		self.assertEquals(proxy.get(context), {'_id':'1', 'name':'a'})
+		self.assertIs((proxy.name == 'a').link_proxies()[0], proxy)
+		
+		
 	def test_link_proxy_get(self):
 		"""Returns the result of the proxy interface's link"""
 		proxy = Mock()
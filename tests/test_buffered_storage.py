@@ -0,0 +1,133 @@
+import gc
+import unittest
+import weakref
+from mock import Mock
+from cellardoor.model import Model, Text
+from cellardoor.storage import Storage
+from cellardoor.storage.buffered import BufferedStorage
+from cellardoor import errors
+
+
+model = Model(storage=Storage())
+
+
+class Event(model.Entity):
+	write_behind = True
+	name = Text()
+	
+	
+class Person(model.Entity):
+	name = Text()
+	
+	
+class DeadLetter(model.Entity):
+	pass
+	
+	
+def get_inner_storage():
+	inner = Storage()
+	inner.create = Mock(return_value='abc')
+	inner.create_many = Mock()
+	inner.new_id = Mock(side_effect=['1', '2', '3', '4'])
+	return inner
+
+
+
+class TestBufferedStorage(unittest.TestCase):
+	
+	def test_passes_through(self):
+		"""Entities that don't opt in are written immediately"""
+		inner = get_inner_storage()
+		storage = BufferedStorage(inner, max_delay=60)
+		result = storage.create(Person, {'name':'bob'})
+		self.assertEquals(result, 'abc')
+		inner.create.assert_called_once_with(Person, {'name':'bob'})
+		storage.close()
+		
+		
+	def test_returns_id_immediately(self):
+		"""Buffered creates get an ID before anything is written"""
+		inner = get_inner_storage()
+		storage = BufferedStorage(inner, max_delay=60)
+		result = storage.create(Event, {'name':'click'})
+		self.assertEquals(result, '1')
+		self.assertFalse(inner.create.called)
+		self.assertFalse(inner.create_many.called)
+		storage.close()
+		inner.create_many.assert_called_once_with(Event, [{'_id':'1', 'name':'click'}])
+		
+		
+	def test_flush_when_full(self):
+		"""The buffer is written as soon as it reaches max_size"""
+		inner = get_inner_storage()
+		storage = BufferedStorage(inner, max_size=2, max_delay=60)
+		storage.create(Event, {'name':'a'})
+		self.assertFalse(inner.create_many.called)
+		storage.create(Event, {'name':'b'})
+		inner.create_many.assert_called_once_with(Event, [{'_id':'1', 'name':'a'}, {'_id':'2', 'name':'b'}])
+		storage.close()
+		
+		
+	def test_keeps_routes(self):
+		"""Buffered items are written back to the route they were created on"""
+		inner = get_inner_storage()
+		inner.get_route = Mock(side_effect=['a', 'b'])
+		routes = []
+		inner.route = Mock(side_effect=lambda route: routes.append(route) or Storage().route(route))
+		inner.create_many = Mock(side_effect=lambda entity, items: routes.append(items[0]['name']))
+		storage = BufferedStorage(inner, max_delay=60)
+		storage.create(Event, {'name':'x'})
+		storage.create(Event, {'name':'y'})
+		storage.close()
+		self.assertEquals(sorted([routes[0:2], routes[2:4]]), [['a', 'x'], ['b', 'y']])
+		
+		
+	def test_flush_on_timer(self):
+		"""The buffer is written after max_delay seconds"""
+		inner = get_inner_storage()
+		storage = BufferedStorage(inner, max_delay=0.01)
+		storage.create(Event, {'name':'a'})
+		storage.flusher.join(0.5)
+		storage.stopped.set()
+		storage.flusher.join()
+		inner.create_many.assert_called_once_with(Event, [{'_id':'1', 'name':'a'}])
+		
+		
+	def test_failures(self):
+		"""Failed writes are passed to the error callback and the dead letter entity"""
+		inner = get_inner_storage()
+		inner.create_many = Mock(side_effect=[
+			errors.BulkCreateError([({'_id':'2', 'name':'b'}, 'duplicate key')]),
+			None
+		])
+		on_error = Mock()
+		storage = BufferedStorage(inner, max_delay=60, on_error=on_error, dead_letter=DeadLetter)
+		storage.create(Event, {'name':'a'})
+		storage.create(Event, {'name':'b'})
+		storage.close()
+		on_error.assert_called_once_with(Event, [({'_id':'2', 'name':'b'}, 'duplicate key')])
+		inner.create_many.assert_called_with(DeadLetter, [
+			{'entity':'Event', 'document':{'_id':'2', 'name':'b'}, 'error':'duplicate key'}
+		])
+		
+		
+	def test_closed(self):
+		"""Creates after closing are refused instead of being lost"""
+		inner = get_inner_storage()
+		storage = BufferedStorage(inner, max_delay=60)
+		storage.close()
+		with self.assertRaises(errors.StorageClosedError):
+			storage.create(Event, {'name':'a'})
+		self.assertFalse(inner.create.called)
+		self.assertFalse(inner.create_many.called)
+		storage.create(Person, {'name':'b'})
+		inner.create.assert_called_once_with(Person, {'name':'b'})
+		
+		
+	def test_collectable(self):
+		"""Closing at exit doesn't keep storages alive"""
+		storage = BufferedStorage(get_inner_storage())
+		storage_ref = weakref.ref(storage)
+		del storage
+		gc.collect()
+		self.assertIsNone(storage_ref())
@@ -0,0 +1,214 @@
+import os
+import json
+import msgpack
+import tempfile
+import unittest
+from StringIO import StringIO
+from contextlib import contextmanager
+from datetime import datetime
+from mock import Mock
+from cellardoor.model import Model, Text, DateTime, Link, InverseLink
+from cellardoor.api import API
+from cellardoor.api.methods import ALL
+from cellardoor.api.bulk import export_items, import_items
+from cellardoor import cli
+from cellardoor.cli import load_api
+from cellardoor.storage import Storage
+from cellardoor import errors
+
+
+storage = Storage()
+model = Model(storage=storage)
+api = API(model)
+
+
+class Notebook(model.Entity):
+	title = Text()
+	notes = InverseLink('Note', 'notebook', counter=True)
+	
+	
+class Note(model.Entity):
+	versioned = True
+	text = Text(required=True)
+	when = DateTime()
+	notebook = Link('Notebook', embedded_fields=('title',), denormalize=True)
+	
+	
+class Memo(Note):
+	pass
+	
+	
+class Notes(api.Interface):
+	entity = Note
+	method_authorization = {
+		ALL: None
+	}
+	
+	
+class Notebooks(api.Interface):
+	entity = Notebook
+	method_authorization = {
+		ALL: None
+	}
+	
+	
+	
+class TestExport(unittest.TestCase):
+	
+	def test_export_json(self):
+		"""Items are written as newline-delimited JSON"""
+		storage.iterate = Mock(return_value=iter([
+			{'_id':'1', 'text':'a', 'when':datetime(2014, 1, 1)},
+			{'_id':'2', 'text':'b'}
+		]))
+		stream = StringIO()
+		count = export_items(api.interfaces['notes'], stream)
+		self.assertEquals(count, 2)
+		storage.iterate.assert_called_once_with(Note, filter=None, batch_size=1000)
+		lines = stream.getvalue().splitlines()
+		self.assertEquals(map(json.loads, lines), [
+			{'_id':'1', 'text':'a', 'when':'2014-01-01T00:00:00'},
+			{'_id':'2', 'text':'b'}
+		])
+		
+		
+	def test_export_versions(self):
+		"""Version history is written after the current items"""
+		storage.iterate = Mock(side_effect=[
+			iter([{'_id':'1', 'text':'b', '_version':2}]),
+			iter([{'_id':'1', 'text':'a', '_version':1}])
+		])
+		stream = StringIO()
+		count = export_items(api.interfaces['notes'], stream, format='msgpack', versions=True)
+		self.assertEquals(count, 2)
+		storage.iterate.assert_called_with(Note, filter=None, batch_size=1000, versions=True)
+		records = list(msgpack.Unpacker(StringIO(stream.getvalue())))
+		self.assertEquals(records, [
+			{'_id':'1', 'text':'b', '_version':2},
+			{'_id':'1', 'text':'a', '_version':1, '_history':True}
+		])
+		
+		
+		
+class TestImport(unittest.TestCase):
+	
+	def get_stream(self, records):
+		return StringIO(''.join([json.dumps(r) + '\n' for r in records]))
+		
+		
+	def test_import(self):
+		"""Records are validated and written in batches, keeping IDs"""
+		storage.create_many = Mock()
+		stream = self.get_stream([
+			{'_id':'1', 'text':'a', 'when':'2014-01-01T00:00:00', '_version':3},
+			{'_id':'2', 'text':'b', '_type':'Note.Memo', '_version':1},
+			{'_id':'1', 'text':'z', '_version':2, '_history':True},
+		])
+		count = import_items(api.interfaces['notes'], stream, batch_size=10)
+		self.assertEquals(count, 3)
+		calls = dict([((c[0][0], c[1]['versions']), c[0][1]) for c in storage.create_many.call_args_list])
+		self.assertEquals(calls[(Note, False)], [{'_id':'1', 'text':'a', 'when':datetime(2014, 1, 1), '_version':3}])
+		self.assertEquals(calls[(Memo, False)], [{'_id':'2', 'text':'b', '_version':1}])
+		self.assertEquals(calls[(Note, True)], [{'_id':'1', 'text':'z', '_version':2}])
+		
+		
+	def test_import_counters_and_snapshots(self):
+		"""Counters and copies of linked items are kept when exported items are imported"""
+		notebook = {'_id':'1', 'title':'a', 'notes_count':1}
+		note = {'_id':'2', 'text':'b', '_version':1, 'notebook':'1', '_snapshots':{'1':{'_id':'1', 'title':'a'}}}
+		storage.get_by_id = Mock(return_value=notebook)
+		storage.create_many = Mock()
+		try:
+			for interface, item in ((api.interfaces['notebooks'], notebook), (api.interfaces['notes'], note)):
+				stream = StringIO()
+				storage.iterate = Mock(return_value=iter([dict(item)]))
+				export_items(interface, stream)
+				import_items(interface, StringIO(stream.getvalue()))
+				self.assertEquals(storage.create_many.call_args[0][1], [item])
+		finally:
+			del storage.get_by_id
+		
+		
+	def test_import_invalid(self):
+		"""An invalid record stops the import"""
+		storage.create_many = Mock()
+		stream = self.get_stream([{'_id':'1'}])
+		with self.assertRaises(errors.CompoundValidationError) as cm:
+			import_items(api.interfaces['notes'], stream)
+		self.assertEquals(cm.exception.errors, {'record 1': {'text':'This field is required.'}})
+		self.assertFalse(storage.create_many.called)
+		
+		
+	def test_import_checkpoint(self):
+		"""An interrupted import resumes after the last batch written"""
+		records = [{'_id':str(i), 'text':'t%d' % i} for i in range(5)]
+		checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+		storage.create_many = Mock(side_effect=[None, Exception('boom')])
+		with self.assertRaises(Exception):
+			import_items(api.interfaces['notes'], self.get_stream(records), batch_size=2, checkpoint=checkpoint)
+		self.assertEquals(open(checkpoint).read(), '2')
+		
+		storage.create_many = Mock()
+		count = import_items(api.interfaces['notes'], self.get_stream(records), batch_size=2, checkpoint=checkpoint)
+		self.assertEquals(count, 3)
+		written = [x['_id'] for c in storage.create_many.call_args_list for x in c[0][1]]
+		self.assertEquals(written, ['2', '3', '4'])
+		self.assertFalse(os.path.exists(checkpoint))
+		
+		
+	def test_import_partial_batch(self):
+		"""A partly written batch moves the checkpoint up to the first failure"""
+		records = [{'_id':str(i), 'text':'t%d' % i} for i in range(5)]
+		checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+		failure = errors.BulkCreateError([(records[3], 'boom')], indexes=[3])
+		storage.create_many = Mock(side_effect=failure)
+		with self.assertRaises(errors.BulkCreateError):
+			import_items(api.interfaces['notes'], self.get_stream(records), batch_size=5, checkpoint=checkpoint)
+		self.assertEquals(open(checkpoint).read(), '3')
+		
+		storage.create_many = Mock()
+		count = import_items(api.interfaces['notes'], self.get_stream(records), batch_size=5, checkpoint=checkpoint)
+		self.assertEquals(count, 2)
+		written = [x['_id'] for c in storage.create_many.call_args_list for x in c[0][1]]
+		self.assertEquals(written, ['3', '4'])
+		self.assertFalse(os.path.exists(checkpoint))
+		
+		
+	def test_import_resume_existing(self):
+		"""A resumed import counts items that were already written as done"""
+		records = [{'_id':str(i), 'text':'t%d' % i} for i in range(4)]
+		checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+		with open(checkpoint, 'w') as f:
+			f.write('1')
+		existing = errors.BulkCreateError([(records[1], 'duplicate key')], indexes=[0], existing=set([0]))
+		storage.create_many = Mock(side_effect=[existing])
+		count = import_items(api.interfaces['notes'], self.get_stream(records), batch_size=5, checkpoint=checkpoint)
+		self.assertEquals(count, 3)
+		self.assertFalse(os.path.exists(checkpoint))
+		
+		storage.create_many = Mock(side_effect=[existing])
+		with self.assertRaises(errors.BulkCreateError):
+			import_items(api.interfaces['notes'], self.get_stream(records), batch_size=5)
+			
+			
+			
+class TestCommands(unittest.TestCase):
+	
+	def test_route(self):
+		"""Commands run on the storage route given with --route"""
+		routes = []
+		@contextmanager
+		def route(value):
+			routes.append(value)
+			yield
+			routes.pop()
+		storage.route = route
+		storage.iterate = Mock(side_effect=lambda *args, **kwargs: iter([{'_id':'1', 'text':'a', 'route':list(routes)}]))
+		cli.load_api = Mock(return_value=api)
+		output = os.path.join(tempfile.mkdtemp(), 'notes.ndjson')
+		try:
+			cli.main(['export', 'app:api', 'notes', '-o', output, '--route', 'tenant:'])
+		finally:
+			del storage.route
+			cli.load_api = load_api
+		self.assertEquals(json.loads(open(output).read())['route'], [['tenant', None]])
@@ -0,0 +1,63 @@
+import unittest
+from mock import Mock
+from cellardoor.storage import Storage
+from cellardoor.storage.changes import ChangeFeed
+
+
+class TestChangeFeed(unittest.TestCase):
+	
+	def test_publishes_changes(self):
+		"""Changes from the storage reach caches and listeners"""
+		storage = Storage()
+		
+		def tail_changes(stopped):
+			yield 'Foo', '1', 'update', None
+			yield 'Bar', None, 'update', ('tenant', None)
+			stopped.set()
+		
+		storage.tail_changes = tail_changes
+		cache = Mock()
+		listener = Mock()
+		feed = ChangeFeed(storage)
+		feed.register(cache)
+		feed.hooks.after_change(listener)
+		feed.start()
+		feed.thread.join(1)
+		
+		self.assertEquals(cache.invalidate.call_args_list, 
+			[(('Foo', '1', None),), (('Bar', None, ('tenant', None)),)])
+		self.assertEquals(listener.call_args_list, 
+			[(('Foo', '1', 'update', None),), (('Bar', None, 'update', ('tenant', None)),)])
+	
+	
+	def test_bad_cache(self):
+		"""A failing cache doesn't stop the others from being invalidated"""
+		bad_cache = Mock()
+		bad_cache.invalidate.side_effect = Exception()
+		good_cache = Mock()
+		feed = ChangeFeed(Storage())
+		feed.register(bad_cache)
+		feed.register(good_cache)
+		feed.publish('Foo', '1', 'delete')
+		good_cache.invalidate.assert_called_once_with('Foo', '1', None)
+	
+	
+	def test_reconnects(self):
+		"""The feed keeps following after the storage fails"""
+		storage = Storage()
+		calls = []
+		
+		def tail_changes(stopped):
+			calls.append(1)
+			if len(calls) == 1:
+				raise Exception('connection lost')
+			yield 'Foo', '1', 'create', None
+			stopped.set()
+		
+		storage.tail_changes = tail_changes
+		listener = Mock()
+		feed = ChangeFeed(storage)
+		feed.hooks.after_change(listener)
+		feed.start()
+		feed.thread.join(3)
+		listener.assert_called_once_with('Foo', '1', 'create', None)
@@ -1,6 +1,8 @@
+import threading
 import unittest
+from contextlib import contextmanager
 from mock import Mock
-from cellardoor.events import EventManager
+from cellardoor.events import EventManager, WorkerPool
 
 
 class TestEventManager(unittest.TestCase):
@@ -42,4 +44,140 @@ class TestEventManager(unittest.TestCase):
 		events.fire_after_foo(321)
 		after_foo.assert_called_once_with(321)
 		self.assertFalse(before_foo.called)
-		self.assertFalse(before_bar.called)
\ No newline at end of file
+		self.assertFalse(before_bar.called)
+		
+		
+	def test_background(self):
+		"""Background listeners run on the pool and fire doesn't wait for them"""
+		release = threading.Event()
+		calls = []
+		
+		def slow(x):
+			release.wait(1)
+			calls.append(x)
+			
+		events = EventManager('foo')
+		events.pool = WorkerPool(workers=1)
+		events.after_foo(slow, background=True)
+		events.fire_after_foo(1)
+		self.assertEquals(calls, [])
+		release.set()
+		events.pool.drain()
+		self.assertEquals(calls, [1])
+		events.pool.shutdown()
+		
+		
+	def test_background_before(self):
+		"""Before listeners can't run in the background"""
+		events = EventManager('foo')
+		with self.assertRaises(ValueError):
+			events.before_foo(Mock(), background=True)
+			
+			
+	def test_background_error(self):
+		"""A failing background listener is logged and the others still run"""
+		events = EventManager('foo')
+		events.pool = WorkerPool(workers=1)
+		events.pool.logger = Mock()
+		bad = Mock(side_effect=Exception())
+		bad.__name__ = 'bad'
+		good = Mock()
+		events.after_foo(bad, background=True)
+		events.after_foo(good, background=True)
+		events.fire_after_foo(123)
+		events.pool.drain()
+		good.assert_called_once_with(123)
+		self.assertTrue(events.pool.logger.exception.called)
+		events.pool.shutdown()
+		
+		
+	def test_background_copied(self):
+		"""Listeners copied from another manager stay in the background"""
+		listener = Mock()
+		parent = EventManager('foo')
+		parent.after_foo(listener, background=True)
+		child = EventManager('foo')
+		child.pool = Mock()
+		child.update_from(parent)
+		child.fire_after_foo(1)
+		child.pool.submit.assert_called_once_with(listener, 1)
+		self.assertFalse(listener.called)
+		
+		
+	def test_background_route(self):
+		"""Background listeners use the storage route the event was fired with"""
+		routes = []
+		@contextmanager
+		def route(r):
+			routes.append(r)
+			yield
+		listener = Mock()
+		events = EventManager('foo')
+		events.storage = Mock(get_route=Mock(return_value='tenant'), route=route)
+		events.pool = Mock()
+		events.after_foo(listener, background=True)
+		events.fire_after_foo(1)
+		fn, arg = events.pool.submit.call_args[0]
+		self.assertFalse(listener.called)
+		fn(arg)
+		listener.assert_called_once_with(1)
+		self.assertEquals(routes, ['tenant'])
+		
+		
+	def test_background_copies_arguments(self):
+		"""Background listeners get their own copy of the arguments"""
+		release = threading.Event()
+		calls = []
+		
+		def slow(item, context):
+			release.wait(1)
+			calls.append((item, context['identity']))
+			
+		events = EventManager('foo')
+		events.pool = WorkerPool(workers=1)
+		events.after_foo(slow, background=True)
+		item = {'_id':'1', 'tags':['a']}
+		identity = {'name':'bob'}
+		events.fire_after_foo(item, {'identity':identity})
+		item['tags'].append('b')
+		identity['name'] = 'alice'
+		release.set()
+		events.pool.drain()
+		self.assertEquals(calls, [({'_id':'1', 'tags':['a']}, {'name':'bob'})])
+		events.pool.shutdown()
+		
+		
+class TestWorkerPool(unittest.TestCase):
+	
+	def test_backpressure(self):
+		"""Submitting blocks while the queue is full"""
+		release = threading.Event()
+		pool = WorkerPool(workers=1, max_queued=1)
+		pool.submit(release.wait, 1)
+		pool.submit(Mock())
+		submitted = threading.Event()
+		
+		def submit():
+			pool.submit(Mock())
+			submitted.set()
+			
+		thread = threading.Thread(target=submit)
+		thread.start()
+		self.assertFalse(submitted.wait(0.1))
+		release.set()
+		self.assertTrue(submitted.wait(1))
+		thread.join()
+		pool.shutdown()
+		
+		
+	def test_shutdown(self):
+		"""Shutting down finishes what was submitted and stops the workers"""
+		pool = WorkerPool(workers=2)
+		fns = [Mock() for i in range(10)]
+		for fn in fns:
+			pool.submit(fn)
+		threads = list(pool.threads)
+		pool.shutdown()
+		self.assertTrue(all([fn.called for fn in fns]))
+		self.assertFalse(any([t.is_alive() for t in threads]))
+		self.assertEquals(pool.threads, [])
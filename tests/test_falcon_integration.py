@@ -28,6 +28,20 @@ class Bar(model.Entity):
 	
 class Baz(model.Entity):
 	pass
+	
+	
+class Avatar(model.Entity):
+	url = Text()
+	
+	
+class Author(model.Entity):
+	name = Text()
+	avatar = Link('Avatar', embeddable=True, embed_by_default=False)
+	
+	
+class Article(model.Entity):
+	title = Text()
+	author = Link('Author', embeddable=True, embed_by_default=False)
 
 	
 class Foos(api.Interface):
@@ -52,6 +66,27 @@ class Bazes(api.Interface):
 	}
 
 
+class Avatars(api.Interface):
+	entity = Avatar
+	method_authorization = {
+		ALL: None
+	}
+	
+	
+class Authors(api.Interface):
+	entity = Author
+	method_authorization = {
+		ALL: None
+	}
+	
+	
+class Articles(api.Interface):
+	entity = Article
+	method_authorization = {
+		ALL: None
+	}
+
+
 class TestResource(TestBase):
 	
 	def setUp(self):
@@ -125,7 +160,7 @@ class TestResource(TestBase):
 		created_foo = json.loads(''.join(result))
 		self.assertEquals(created_foo, foo)
 		self.assertEquals(self.srmock.status, '201 Created')
-		api.interfaces['foos'].create.assert_called_with({'name':'foo'}, show_hidden=False, embedded=None, context={})
+		api.interfaces['foos'].create.assert_called_with({'name':'foo'}, show_hidden=False, embed=None, context={})
 		
 		
 	def test_create_msgpack(self):
@@ -143,15 +178,15 @@ class TestResource(TestBase):
 		created_foo = msgpack.unpackb(''.join(result))
 		self.assertEquals(created_foo, foo)
 		self.assertEquals(self.srmock.status, '201 Created')
-		api.interfaces['foos'].create.assert_called_with({'name':'foo'}, show_hidden=False, embedded=None, context={})
+		api.interfaces['foos'].create.assert_called_with({'name':'foo'}, show_hidden=False, embed=None, context={})
 		
 		
 	def test_not_found(self):
 		"""If a collection raises NotFoundError, a 404 status is returned"""
-		api.interfaces['foos'].get = Mock(side_effect=errors.NotFoundError())
+		api.interfaces['foos'].get_with_etag = Mock(side_effect=errors.NotFoundError())
 		self.simulate_request('/foos/123', method='GET')
 		self.assertEquals(self.srmock.status, '404 Not Found')
-		api.interfaces['foos'].get.assert_called_with('123', show_hidden=False, embedded=None, context={})
+		api.interfaces['foos'].get_with_etag.assert_called_with('123', if_none_match=None, show_hidden=False, embed=None, context={})
 		
 		
 	def test_method_not_allowed(self):
@@ -162,14 +197,14 @@ class TestResource(TestBase):
 		
 	def test_forbidden(self):
 		"""If authorization fails a 403 status is returned"""
-		api.interfaces['foos'].get = Mock(side_effect=errors.NotAuthorizedError)
+		api.interfaces['foos'].get_with_etag = Mock(side_effect=errors.NotAuthorizedError)
 		self.simulate_request('/foos/123', method='GET')
 		self.assertEquals(self.srmock.status, '403 Forbidden')
 		
 		
 	def test_unauthenticated(self):
 		"""If a method is enabled but requires authentication, a 401 status is returned"""
-		api.interfaces['foos'].get = Mock(side_effect=errors.NotAuthenticatedError)
+		api.interfaces['foos'].get_with_etag = Mock(side_effect=errors.NotAuthenticatedError)
 		self.simulate_request('/foos/123', method='GET')
 		self.assertEquals(self.srmock.status, '401 Unauthorized')
 		
@@ -188,6 +223,13 @@ class TestResource(TestBase):
 		self.assertEquals(self.srmock.status, '400 Bad Request')
 		
 		
+	def test_unindexed_query(self):
+		"""If a list request can't use an index, a 400 status is returned"""
+		api.interfaces['foos'].list = Mock(side_effect=errors.UnindexedQueryError('No index'))
+		self.simulate_request('/foos')
+		self.assertEquals(self.srmock.status, '400 Bad Request')
+		
+		
 	def test_list(self):
 		"""Will return a list of items structured by the view"""
 		foos = [{'name':'foo'}, {'name':'bar'}]
@@ -210,17 +252,82 @@ class TestResource(TestBase):
 		result = json.loads(''.join(data))
 		self.assertEquals(self.srmock.status, '200 OK')
 		self.assertEquals(result, foos)
-		api.interfaces['foos'].list.assert_called_with(sort=['+name'], filter={'foo':23}, offset=7, limit=10, show_hidden=True, embedded=None, context={})
+		api.interfaces['foos'].list.assert_called_with(sort=['+name'], filter={'foo':23}, offset=7, limit=10, show_hidden=True, embed=None, context={})
 		
 		
 	def test_get(self):
 		"""A GET with a path to /collection/{id} calls colleciton.get"""
-		api.interfaces['foos'].get = Mock(return_value={'_id':'123', 'name':'foo'})
+		api.interfaces['foos'].get_with_etag = Mock(return_value=({'_id':'123', 'name':'foo'}, '"abc"'))
 		data = self.simulate_request('/foos/123', method='GET', headers={'accept':'application/json'})
 		result = json.loads(''.join(data))
 		self.assertEquals(self.srmock.status, '200 OK')
 		self.assertEquals(result, {'name':'foo', '_id':'123'})
-		api.interfaces['foos'].get.assert_called_with('123', show_hidden=False, embedded=None, context={})
+		api.interfaces['foos'].get_with_etag.assert_called_with('123', if_none_match=None, show_hidden=False, embed=None, context={})
+		
+		
+	def test_get_etag(self):
+		"""A GET sends the item's ETag and passes If-None-Match on"""
+		api.interfaces['foos'].get_with_etag = Mock(return_value=({'_id':'123'}, '"abc"'))
+		self.simulate_request('/foos/123', headers={'if-none-match':'"abc", "def"'})
+		self.assertEquals(self.srmock.headers_dict['etag'], '"abc"')
+		api.interfaces['foos'].get_with_etag.assert_called_with('123', if_none_match=['"abc"', '"def"'], show_hidden=False, embed=None, context={})
+		
+		
+	def test_get_not_modified(self):
+		"""If the item hasn't changed a 304 status is returned without a body"""
+		api.interfaces['foos'].get_with_etag = Mock(side_effect=errors.NotModifiedError('"abc"'))
+		result = self.simulate_request('/foos/123', headers={'if-none-match':'"abc"'})
+		self.assertEquals(self.srmock.status, '304 Not Modified')
+		self.assertEquals(self.srmock.headers_dict['etag'], '"abc"')
+		self.assertEquals(''.join(result), '')
+		
+		
+	def test_get_etag_variant(self):
+		"""Items sent in another than the default content type get their own ETag"""
+		api.interfaces['foos'].get_with_etag = Mock(return_value=({'_id':'123'}, '"abc"'))
+		api.interfaces['foos'].delete = Mock()
+		self.simulate_request('/foos/123', headers={'accept':'application/x-msgpack'})
+		etag = self.srmock.headers_dict['etag']
+		self.assertNotEquals(etag, '"abc"')
+		self.simulate_request('/foos/123', headers={'accept':'application/x-msgpack', 'if-none-match':'"abc", %s' % etag})
+		self.assertEquals(api.interfaces['foos'].get_with_etag.call_args[1]['if_none_match'], ['"abc"'])
+		self.simulate_request('/foos/123', headers={'accept':'application/json', 'if-none-match':etag})
+		self.assertEquals(api.interfaces['foos'].get_with_etag.call_args[1]['if_none_match'], [etag])
+		self.simulate_request('/foos/123', method='DELETE', headers={'if-match':etag})
+		api.interfaces['foos'].delete.assert_called_with('123', if_match=['"abc"'], context={})
+		
+		
+	def test_list_etag(self):
+		"""Lists get an ETag from their body and a 304 status if it hasn't changed"""
+		api.interfaces['foos'].list = Mock(return_value=[{'_id':'123'}])
+		self.simulate_request('/foos', headers={'accept':'application/json'})
+		self.assertEquals(self.srmock.status, '200 OK')
+		etag = self.srmock.headers_dict['etag']
+		result = self.simulate_request('/foos', headers={'accept':'application/json', 'if-none-match':etag})
+		self.assertEquals(self.srmock.status, '304 Not Modified')
+		self.assertEquals(''.join(result), '')
+		
+		
+	def test_if_match(self):
+		"""If-Match is passed on to writes and a failed precondition is a 412"""
+		api.interfaces['foos'].update = Mock(side_effect=errors.PreconditionFailedError())
+		api.interfaces['foos'].delete = Mock()
+		self.simulate_request('/foos/123', method='PATCH', body=json.dumps({'name':'bar'}),
+			headers={'content-type':'application/json', 'if-match':'"3"'})
+		self.assertEquals(self.srmock.status, '412 Precondition Failed')
+		self.assertEquals(api.interfaces['foos'].update.call_args[1]['if_match'], ['"3"'])
+		self.simulate_request('/foos/123', method='DELETE', headers={'if-match':'"a", "b"'})
+		api.interfaces['foos'].delete.assert_called_with('123', if_match=['"a"', '"b"'], context={})
+		
+		
+	def test_get_many(self):
+		"""A GET to /collection with an ids parameter calls collection.get_many"""
+		api.interfaces['foos'].get_many = Mock(return_value=[{'_id':'1', 'name':'foo'}, None])
+		data = self.simulate_request('/foos', method='GET', headers={'accept':'application/json'}, query_string='ids=1,2')
+		result = json.loads(''.join(data))
+		self.assertEquals(self.srmock.status, '200 OK')
+		self.assertEquals(result, [{'_id':'1', 'name':'foo'}, None])
+		api.interfaces['foos'].get_many.assert_called_with(['1', '2'], show_hidden=False, embed=None, context={})
 		
 		
 	def test_update_fail_validation(self):
@@ -257,7 +364,7 @@ class TestResource(TestBase):
 		result = json.loads(''.join(data))
 		self.assertEquals(self.srmock.status, '200 OK')
 		self.assertEquals(result, {'name':'bar', '_id':'123'})
-		api.interfaces['foos'].update.assert_called_with('123', {'name':'bar'}, show_hidden=False, embedded=None, context={})
+		api.interfaces['foos'].update.assert_called_with('123', {'name':'bar'}, if_match=None, show_hidden=False, embed=None, context={})
 		
 		
 	def test_replace(self):
@@ -275,7 +382,7 @@ class TestResource(TestBase):
 		result = json.loads(''.join(data))
 		self.assertEquals(self.srmock.status, '200 OK')
 		self.assertEquals(result, {'name':'bar', '_id':'123'})
-		api.interfaces['foos'].replace.assert_called_with('123', {'name':'bar'}, show_hidden=False, embedded=None, context={})
+		api.interfaces['foos'].replace.assert_called_with('123', {'name':'bar'}, if_match=None, show_hidden=False, embed=None, context={})
 		
 		
 	def test_delete(self):
@@ -283,7 +390,7 @@ class TestResource(TestBase):
 		api.interfaces['foos'].delete = Mock()
 		self.simulate_request('/foos/123', method='DELETE')
 		self.assertEquals(self.srmock.status, '200 OK')
-		api.interfaces['foos'].delete.assert_called_with('123', context={})
+		api.interfaces['foos'].delete.assert_called_with('123', if_match=None, context={})
 		
 		
 	def test_get_single_link(self):
@@ -293,7 +400,31 @@ class TestResource(TestBase):
 		result = json.loads(''.join(data))
 		self.assertEquals(self.srmock.status, '200 OK')
 		self.assertEquals(result, {'_id':'123'})
-		api.interfaces['foos'].link.assert_called_with('123', 'bar', filter=None, sort=None, offset=0, limit=0, show_hidden=False, embedded=None, context={})
+		api.interfaces['foos'].link.assert_called_with('123', 'bar', filter=None, sort=None, offset=0, limit=0, show_hidden=False, embed=None, context={})
+		
+		
+	def test_get_nested_embed(self):
+		"""The embed parameter embeds links several levels deep"""
+		storage = model.storage
+		items = {
+			'1': {'_id':'1', 'title':'foo', 'author':'2'},
+			'2': {'_id':'2', 'name':'bob', 'avatar':'3'},
+			'3': {'_id':'3', 'url':'bob.png'}
+		}
+		storage.get_by_id = Mock(side_effect=lambda entity, id: dict(items[id]))
+		storage.get_by_ids = Mock(side_effect=lambda entity, ids, **kwargs: [dict(items[x]) for x in ids])
+		try:
+			data = self.simulate_request('/articles/1', method='GET', 
+				query_string='embed=%s' % urllib.quote(json.dumps(['author.avatar'])), headers={'accept':'application/json'})
+			self.assertEquals(self.srmock.status, '200 OK')
+			self.assertEquals(json.loads(''.join(data)), {
+				'_id':'1', 
+				'title':'foo', 
+				'author':{'_id':'2', 'name':'bob', 'avatar':{'_id':'3', 'url':'bob.png'}}
+			})
+		finally:
+			del storage.get_by_id
+			del storage.get_by_ids
 		
 		
 	def test_get_multiple_link(self):
@@ -314,7 +445,22 @@ class TestResource(TestBase):
 		result = json.loads(''.join(data))
 		self.assertEquals(self.srmock.status, '200 OK')
 		self.assertEquals(result, {'_id':'123'})
-		api.interfaces['foos'].link.assert_called_with('123', 'bazes', sort=['+name'], filter={'foo':23}, offset=7, limit=10, show_hidden=True, embedded=None, context={})
+		api.interfaces['foos'].link.assert_called_with('123', 'bazes', sort=['+name'], filter={'foo':23}, offset=7, limit=10, show_hidden=True, embed=None, context={})
+		
+		
+	def test_distinct(self):
+		"""A GET to /collection/_distinct/field calls collection.distinct"""
+		api.interfaces['foos'].distinct = Mock(return_value=['a', 'b'])
+		data = self.simulate_request(
+			'/foos/_distinct/name',
+			method='GET',
+			headers={'accept':'application/json'},
+			query_string=urllib.urlencode({'filter':json.dumps({'foo':23})})
+		)
+		result = json.loads(''.join(data))
+		self.assertEquals(self.srmock.status, '200 OK')
+		self.assertEquals(result, ['a', 'b'])
+		api.interfaces['foos'].distinct.assert_called_with('name', filter={'foo':23}, context={})
 		
 		
 	def test_pass_identity(self):
@@ -322,14 +468,14 @@ class TestResource(TestBase):
 		environ = create_environ('/foos')
 		environ['cellardoor.identity'] = 'foo'
 		self.api(environ, lambda *args, **kwargs: [])
-		api.interfaces['foos'].list.assert_called_with(sort=None, filter=None, offset=0, limit=0, show_hidden=False, embedded=None, context={'identity': 'foo'})
+		api.interfaces['foos'].list.assert_called_with(sort=None, filter=None, offset=0, limit=0, show_hidden=False, embed=None, context={'identity': 'foo'})
 		
 		
 	def test_show_hidden(self):
 		"""If show_hidden is set in the request, show_hidden=True in the collection call"""
 		api.interfaces['foos'].list = Mock(return_value=None)
 		api.interfaces['foos'].create = Mock(return_value=None)
-		api.interfaces['foos'].get = Mock(return_value=None)
+		api.interfaces['foos'].get_with_etag = Mock(return_value=(None, None))
 		
 		self.simulate_request('/foos', query_string='show_hidden=1')
 		self.assertEquals(self.srmock.status, '200 OK')
@@ -338,9 +484,9 @@ class TestResource(TestBase):
 		self.simulate_request('/foos/123', query_string='show_hidden=1')
 		self.assertEquals(self.srmock.status, '200 OK')
 		
-		api.interfaces['foos'].list.assert_called_with(sort=None, filter=None, offset=0, limit=0, show_hidden=True, embedded=None, context={})
-		api.interfaces['foos'].create.assert_called_with({}, show_hidden=True, embedded=None, context={})
-		api.interfaces['foos'].get.assert_called_with('123', show_hidden=True, embedded=None, context={})
+		api.interfaces['foos'].list.assert_called_with(sort=None, filter=None, offset=0, limit=0, show_hidden=True, embed=None, context={})
+		api.interfaces['foos'].create.assert_called_with({}, show_hidden=True, embed=None, context={})
+		api.interfaces['foos'].get_with_etag.assert_called_with('123', if_none_match=None, show_hidden=True, embed=None, context={})
 		
 		
 	def test_count(self):
@@ -348,12 +494,81 @@ class TestResource(TestBase):
 		api.interfaces['foos'].list = Mock(return_value=52)
 		self.simulate_request('/foos', method='HEAD')
 		self.assertEquals(self.srmock.headers_dict['x-count'], '52')
-		api.interfaces['foos'].list.assert_called_with(sort=None, filter=None, offset=0, limit=0, show_hidden=False, embedded=None, context={}, count=True)
+		api.interfaces['foos'].list.assert_called_with(sort=None, filter=None, offset=0, limit=0, show_hidden=False, embed=None, context={}, count=True)
 		
 		
 	def test_count_link(self):
 		api.interfaces['foos'].link = Mock(return_value=52)
 		self.simulate_request('/foos/123/bazes', method='HEAD')
 		self.assertEquals(self.srmock.headers_dict['x-count'], '52')
-		api.interfaces['foos'].link.assert_called_with('123', 'bazes', sort=None, filter=None, offset=0, limit=0, show_hidden=False, embedded=None, context={}, count=True)
-		
\ No newline at end of file
+		api.interfaces['foos'].link.assert_called_with('123', 'bazes', sort=None, filter=None, offset=0, limit=0, show_hidden=False, embed=None, context={}, count=True)
+				
+		
+	def batch(self, operations, **kwargs):
+		environ = create_environ('/_batch', method='POST', body=json.dumps(operations),
+			headers={'accept':'application/json', 'content-type':'application/json'})
+		environ.update(kwargs)
+		return json.loads(''.join(self.api(environ, self.srmock)))
+		
+		
+	def test_batch(self):
+		"""Several operations can be run with one request"""
+		api.interfaces['foos'].get_with_etag = Mock(return_value=({'_id':'123', 'name':'foo'}, '"abc"'))
+		api.interfaces['foos'].list = Mock(return_value=[])
+		api.interfaces['foos'].create = Mock(return_value={'_id':'1', 'name':'bar'})
+		api.interfaces['bazes'].list = Mock(return_value=7)
+		result = self.batch([
+			{'method':'GET', 'path':'/foos/123'},
+			{'method':'GET', 'path':'/foos', 'params':{'filter':{'name':'foo'}, 'limit':5}},
+			{'method':'POST', 'path':'/foos', 'body':{'name':'bar'}},
+			{'method':'HEAD', 'path':'/bazes'}
+		])
+		self.assertEquals(self.srmock.status, '200 OK')
+		self.assertEquals(result, [
+			{'status':200, 'headers':{'etag':'"abc"'}, 'body':{'_id':'123', 'name':'foo'}},
+			{'status':200, 'headers':{}, 'body':[]},
+			{'status':201, 'headers':{}, 'body':{'_id':'1', 'name':'bar'}},
+			{'status':200, 'headers':{'x-count':'7'}, 'body':None}
+		])
+		self.assertEquals(api.interfaces['foos'].list.call_args[1]['filter'], {'name':'foo'})
+		self.assertEquals(api.interfaces['foos'].list.call_args[1]['limit'], 5)
+		api.interfaces['foos'].create.assert_called_with({'name':'bar'}, show_hidden=False, embed=None, context={'identity_map':{}})
+		
+		
+	def test_batch_errors(self):
+		"""A failed operation in a batch doesn't stop the others"""
+		api.interfaces['foos'].get_with_etag = Mock(side_effect=errors.NotAuthorizedError())
+		api.interfaces['foos'].create = Mock(side_effect=errors.CompoundValidationError({'name':'This field is required.'}))
+		api.interfaces['bars'].list = Mock(return_value=[])
+		result = self.batch([
+			{'method':'GET', 'path':'/foos/123'},
+			{'method':'POST', 'path':'/foos', 'body':{}},
+			{'method':'GET', 'path':'/nothing'},
+			{'method':'PUT', 'path':'/bars/123'},
+			{'method':'GET', 'path':'/bars'}
+		])
+		self.assertEquals(self.srmock.status, '200 OK')
+		self.assertEquals([x['status'] for x in result], [403, 400, 404, 405, 200])
+		self.assertEquals(result[1]['body'], {'name':'This field is required.'})
+		
+		
+	def test_batch_identity(self):
+		"""Batched operations share the identity of the batch request and an identity map"""
+		api.interfaces['foos'].get_with_etag = Mock(return_value=({}, None))
+		self.batch([{'path':'/foos/1'}, {'path':'/foos/2'}], **{'cellardoor.identity':'foo'})
+		contexts = [x[1]['context'] for x in api.interfaces['foos'].get_with_etag.call_args_list]
+		self.assertEquals(contexts, [{'identity':'foo', 'identity_map':{}}] * 2)
+		self.assertTrue(contexts[0]['identity_map'] is contexts[1]['identity_map'])
+		
+		
+	def test_batch_not_a_list(self):
+		self.batch({'path':'/foos'})
+		self.assertEquals(self.srmock.status, '400 Bad Request')
+		
+		
+	def test_batch_parallel(self):
+		"""Reads can be run by a pool of threads"""
+		FalconApp(api, falcon_app=self.api, batch_workers=2)
+		api.interfaces['foos'].get_with_etag = Mock(side_effect=lambda id, **kwargs: ({'_id':id}, None))
+		result = self.batch([{'path':'/foos/%d' % i} for i in range(5)])
+		self.assertEquals([x['body'] for x in result], [{'_id':str(i)} for i in range(5)])
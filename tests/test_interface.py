@@ -1,12 +1,14 @@
+import sys
+import threading
 import unittest
 from copy import deepcopy
-from mock import Mock
+from mock import Mock, MagicMock
 from cellardoor.model import Model, Entity, Link, InverseLink, Text, ListOf, Integer, Float, Enum
 from cellardoor.api import API
 from cellardoor.api.methods import ALL, LIST, GET, CREATE
 from cellardoor.storage import Storage
 from cellardoor import errors
-from cellardoor.authorization import ObjectProxy
+from cellardoor.authorization import ObjectProxy, ItemProxy, FilterCompilationError
 
 identity = ObjectProxy('identity')
 item = ObjectProxy('item')
@@ -61,6 +63,33 @@ class Shell(model.Entity):
 	
 class LittorinaLittorea(Littorina):
 	shell = Link('Shell', embeddable=True)
+	tag = Text(hidden=True)
+	
+	
+class Author(model.Entity):
+	name = Text()
+	articles = InverseLink('Article', 'author', counter=True)
+	
+	
+class Article(model.Entity):
+	title = Text()
+	author = Link(Author)
+	
+	
+class Review(model.Entity):
+	author = Link(Author, embeddable=True, embedded_fields=('name',), denormalize=True)
+	shells = ListOf(Link(Shell, embeddable=True, embedded_fields=('color',), denormalize=True))
+	
+	
+class Draft(model.Entity):
+	versioned = True
+	title = Text()
+	author = Link(Author, embeddable=True, embed_by_default=False)
+	notes = InverseLink('Note', 'draft', counter=True)
+	
+	
+class Note(model.Entity):
+	draft = Link(Draft)
 	
 
 class Foos(api.Interface):
@@ -128,6 +157,82 @@ class Shells(api.Interface):
 		ALL: None
 	}
 
+	
+	
+class Authors(api.Interface):
+	entity = Author
+	method_authorization = {
+		ALL: None
+	}
+	
+	
+class Articles(api.Interface):
+	entity = Article
+	method_authorization = {
+		ALL: None
+	}
+	
+	
+class Reviews(api.Interface):
+	entity = Review
+	method_authorization = {
+		ALL: None
+	}
+	
+	
+class Drafts(api.Interface):
+	entity = Draft
+	method_authorization = {
+		ALL: None
+	}
+
+
+class DistinctBars(api.Interface):
+	entity = Bar
+	plural_name = 'distinct_bars'
+	enabled_filters = ('name',)
+	method_authorization = {
+		LIST: item.number == 1
+	}
+	
+	
+class NamedBars(api.Interface):
+	entity = Bar
+	plural_name = 'named_bars'
+	enabled_filters = ('number',)
+	method_authorization = {
+		LIST: item.name == identity.name
+	}
+	
+	
+class LinkedBars(api.Interface):
+	entity = Bar
+	plural_name = 'linked_bars'
+	method_authorization = {
+		LIST: ItemProxy(Bar).foo.stuff == 'x'
+	}
+	
+	
+class LinkedBazes(api.Interface):
+	entity = Baz
+	plural_name = 'linked_bazes'
+	method_authorization = {
+		(LIST, GET): ItemProxy(Baz).foo.stuff == 'x'
+	}
+	
+	
+class CachedBazes(api.Interface):
+	entity = Baz
+	plural_name = 'cached_bazes'
+	enabled_filters = ('name',)
+	method_authorization = {
+		ALL: None
+	}
+	cache_distinct = True
+
+
+model.defer = Mock()
+
 
 class InterfaceTest(unittest.TestCase):
 	
@@ -185,6 +290,37 @@ class InterfaceTest(unittest.TestCase):
 		self.assertEquals(fetched_foo, foo)
 		
 		
+	def test_get_many(self):
+		"""
+		Can get several items at once in the requested order
+		"""
+		storage.get_by_ids = CopyingMock(return_value=[{'_id':'2', 'stuff':'b'}, {'_id':'1', 'stuff':'a'}])
+		foos = api.interfaces['foos']
+		result = foos.get_many(['1', '3', '2'])
+		storage.get_by_ids.assert_called_once_with(Foo, ['1', '3', '2'])
+		self.assertEquals(result, [{'_id':'1', 'stuff':'a'}, None, {'_id':'2', 'stuff':'b'}])
+		
+		
+	def test_get_many_authorization(self):
+		"""
+		Item rules are checked against every fetched item
+		"""
+		hiddens = api.interfaces['hiddens']
+		hiddens.storage.get_by_ids = Mock(return_value=[{'_id':'1', 'foo':23}, {'_id':'2', 'foo':700}])
+		with self.assertRaises(errors.NotAuthorizedError):
+			hiddens.get_many(['1', '2'])
+			
+			
+	def test_get_many_max_limit(self):
+		"""
+		Can't fetch more items at once than max_limit
+		"""
+		storage.get_by_ids = Mock(return_value=[])
+		with self.assertRaises(errors.CompoundValidationError):
+			api.interfaces['bazes'].get_many([str(x) for x in range(21)])
+		self.assertFalse(storage.get_by_ids.called)
+		
+		
 	def test_get_nonexistent(self):
 		"""
 		Trying to fetch a nonexistent item raises an error.
@@ -206,6 +342,43 @@ class InterfaceTest(unittest.TestCase):
 		self.assertEquals(updated_foo, foo)
 		
 		
+	def test_threaded_validation(self):
+		"""
+		Creates and updates running in several threads at once each check required fields their own way
+		"""
+		storage.create = Mock(return_value='123')
+		storage.update = Mock(return_value={'_id':'123', 'optional_stuff':'x'})
+		foos = api.interfaces['foos']
+		problems = []
+		
+		def create():
+			for i in range(200):
+				try:
+					foos.create({'optional_stuff':'x'})
+					problems.append('created without a required field')
+				except errors.CompoundValidationError:
+					pass
+					
+		def update():
+			for i in range(200):
+				try:
+					foos.update('123', {'optional_stuff':'x'})
+				except errors.CompoundValidationError:
+					problems.append('required field enforced on update')
+		
+		check_interval = sys.getcheckinterval()
+		sys.setcheckinterval(1)
+		try:
+			threads = [threading.Thread(target=fn) for fn in (create, update) * 4]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+		finally:
+			sys.setcheckinterval(check_interval)
+		self.assertEquals(problems, [])
+		
+		
 	def test_update_nonexistent(self):
 		"""
 		Trying to update a nonexistent item raises an error.
@@ -256,6 +429,217 @@ class InterfaceTest(unittest.TestCase):
 		storage.delete.assert_called_once_with(Foo, 123)
 		
 		
+	def test_counter_create(self):
+		"""
+		Creating an item increments the counter on the item it links to
+		"""
+		storage.get_by_id = Mock(return_value={'_id':'1'})
+		storage.create = Mock(return_value='2')
+		storage.increment = Mock()
+		api.interfaces['articles'].create({'title':'Hi', 'author':'1'})
+		storage.increment.assert_called_once_with(Author, '1', 'articles_count', 1)
+		
+		
+	def test_counter_update(self):
+		"""
+		Changing a link moves the count from the old target to the new one
+		"""
+		storage.get_by_id = Mock(return_value={'_id':'2', 'title':'Hi', 'author':'1'})
+		storage.update = Mock(return_value={'_id':'2', 'title':'Hi', 'author':'3'})
+		storage.increment = Mock()
+		api.interfaces['articles'].update('2', {'author':'3'})
+		self.assertEquals(storage.increment.call_count, 2)
+		storage.increment.assert_any_call(Author, '3', 'articles_count', 1)
+		storage.increment.assert_any_call(Author, '1', 'articles_count', -1)
+		
+		
+	def test_counter_update_unrelated(self):
+		"""
+		Updating fields other than the link doesn't read or change counters
+		"""
+		storage.get_by_id = Mock()
+		storage.update = Mock(return_value={'_id':'2', 'title':'Bye', 'author':'1'})
+		storage.increment = Mock()
+		api.interfaces['articles'].update('2', {'title':'Bye'})
+		self.assertFalse(storage.get_by_id.called)
+		self.assertFalse(storage.increment.called)
+		
+		
+	def test_counter_delete(self):
+		"""
+		Deleting an item decrements the counter on the item it linked to
+		"""
+		storage.get_by_id = Mock(return_value={'_id':'2', 'title':'Hi', 'author':'1'})
+		storage.delete = Mock()
+		storage.increment = Mock()
+		api.interfaces['articles'].delete('2')
+		storage.increment.assert_called_once_with(Author, '1', 'articles_count', -1)
+		
+		
+	def test_counter_replace_preserved(self):
+		"""
+		Replacing an item keeps its stored counters
+		"""
+		storage.get_by_id = Mock(return_value={'_id':'1', 'name':'Bob', 'articles_count':4})
+		storage.update = Mock(return_value={'_id':'1', 'name':'Rob', 'articles_count':4})
+		api.interfaces['authors'].replace('1', {'name':'Rob'})
+		storage.update.assert_called_once_with(Author, '1', {'name':'Rob', 'articles_count':4}, replace=True)
+		
+		
+	def test_denormalized_create(self):
+		"""
+		Creating an item stores copies of the embedded fields of its denormalized links
+		"""
+		storage.get_by_id = Mock(return_value={'_id':'1'})
+		storage.get_by_ids = Mock(return_value=[{'_id':'1', 'name':'Bob', 'articles_count':3}])
+		storage.create = CopyingMock(return_value='5')
+		review = api.interfaces['reviews'].create({'author':'1'})
+		storage.get_by_ids.assert_called_once_with(Author, ['1'])
+		fields = storage.create.call_args[0][1]
+		self.assertEquals(fields['_snapshots'], {'author':{'1':{'_id':'1', 'name':'Bob'}}})
+		self.assertEquals(review['author'], {'_id':'1', 'name':'Bob'})
+		self.assertFalse('_snapshots' in review)
+		
+		
+	def test_denormalized_partial_update(self):
+		"""
+		A partial update only replaces the copies for the links it changes
+		"""
+		storage.get_by_id = Mock(return_value={'_id':'1'})
+		storage.get_by_ids = Mock(return_value=[{'_id':'1', 'name':'Bob'}])
+		storage.update = CopyingMock(return_value={'_id':'5', 'author':'1'})
+		api.interfaces['reviews'].update('5', {'author':'1'})
+		storage.update.assert_called_once_with(Review, '5', 
+			{'author':'1', '_snapshots.author':{'1':{'_id':'1', 'name':'Bob'}}}, replace=False)
+		
+		
+	def test_denormalized_embed(self):
+		"""
+		Denormalized links are embedded from the stored copies without a lookup
+		"""
+		storage.get = Mock(return_value=[{
+			'_id':'5', 'author':'1', 'shells':['2', '3'],
+			'_snapshots':{
+				'author':{'1':{'_id':'1', 'name':'Bob'}},
+				'shells':{'2':{'_id':'2', 'color':'Brown'}, '3':{'_id':'3', 'color':'Gray'}}
+			}
+		}])
+		storage.get_by_id = Mock()
+		storage.get_by_ids = Mock()
+		reviews = api.interfaces['reviews'].list()
+		self.assertEquals(reviews, [{
+			'_id':'5', 
+			'author':{'_id':'1', 'name':'Bob'}, 
+			'shells':[{'_id':'2', 'color':'Brown'}, {'_id':'3', 'color':'Gray'}]
+		}])
+		self.assertFalse(storage.get_by_id.called)
+		self.assertFalse(storage.get_by_ids.called)
+		
+		
+	def test_denormalized_embed_missing_copy(self):
+		"""
+		Falls back to a lookup when a stored copy is missing
+		"""
+		storage.get = Mock(return_value=[{
+			'_id':'5', 'shells':['2', '3'],
+			'_snapshots':{'shells':{'2':{'_id':'2', 'color':'Brown'}}}
+		}])
+		storage.get_by_ids = Mock(return_value=[{'_id':'2', 'color':'Brown'}, {'_id':'3', 'color':'Gray'}])
+		reviews = api.interfaces['reviews'].list()
+		self.assertEquals(storage.get_by_ids.call_count, 1)
+		self.assertEquals(reviews[0]['shells'], [{'_id':'2', 'color':'Brown'}, {'_id':'3', 'color':'Gray'}])
+		
+		
+	def test_denormalized_propagation(self):
+		"""
+		Updating a linked item refreshes the copies stored on the items linking to it
+		"""
+		model.defer.reset_mock()
+		storage.update = Mock(return_value={'_id':'1', 'name':'Rob'})
+		api.interfaces['authors'].update('1', {'name':'Rob'})
+		model.defer.assert_called_once_with(model.propagate_snapshots, Author, '1', None)
+		
+		storage.get_by_id = Mock(return_value={'_id':'1', 'name':'Rob', 'articles_count':2})
+		storage.update_many = Mock()
+		model.propagate_snapshots(Author, '1')
+		storage.update_many.assert_called_once_with(Review, {'author':'1'}, 
+			{'_snapshots.author.1':{'_id':'1', 'name':'Rob'}})
+		
+		
+	def test_denormalized_delete(self):
+		"""
+		Deleting a linked item clears the copies stored on the items linking to it
+		"""
+		model.defer.reset_mock()
+		storage.get_by_id = Mock(return_value={'_id':'1', 'name':'Rob'})
+		storage.delete = Mock(return_value=None)
+		api.interfaces['authors'].delete('1')
+		model.defer.assert_called_once_with(model.propagate_snapshots, Author, '1', None)
+		
+		storage.get_by_id = Mock(return_value=None)
+		storage.update_many = Mock()
+		model.propagate_snapshots(Author, '1')
+		storage.update_many.assert_called_once_with(Review, {'author':'1'}, {'_snapshots.author.1':None})
+		
+		storage.get_by_id.reset_mock()
+		storage.get = Mock(return_value=[{
+			'_id':'5', 'author':'1', '_snapshots':{'author':{'1':None}}
+		}])
+		reviews = api.interfaces['reviews'].list()
+		storage.get_by_id.assert_called_once_with(Author, '1')
+		self.assertEquals(reviews, [{'_id':'5', 'author':'1'}])
+		
+		
+	def test_query_guard(self):
+		"""
+		The storage can check and limit list queries
+		"""
+		storage.check_query = Mock(return_value=5)
+		try:
+			storage.check_filter = Mock(return_value=None)
+			storage.get = Mock(return_value=[])
+			api.interfaces['foos'].list(filter={'stuff':'x'}, sort=('+stuff',), limit=10)
+			storage.check_query.assert_called_once_with(Foo, filter={'stuff':'x'}, sort=('+stuff',), limit=10)
+			storage.get.assert_called_once_with(Foo, filter={'stuff':'x'}, sort=('+stuff',), offset=0, limit=5, count=False)
+			storage.check_query.reset_mock()
+			api.interfaces['foos'].list(bypass_authorization=True)
+			self.assertFalse(storage.check_query.called)
+		finally:
+			del storage.check_query
+		
+		
+	def test_query_guard_links(self):
+		"""The query guard checks inverse link queries with their link filter"""
+		storage.check_query = Mock(side_effect=lambda entity, filter=None, sort=None, limit=0: limit)
+		try:
+			storage.get = Mock(return_value=[])
+			storage.get_by_id = Mock(return_value={'_id':'1', 'stuff':'a'})
+			api.interfaces['foos'].link('1', 'bars', sort=('-name',))
+			storage.check_query.assert_called_once_with(Bar, filter={'foo':'1'}, sort=('-name',), limit=0)
+			storage.check_query.reset_mock()
+			api.interfaces['bars'].resolve_links([{'_id':'1'}, {'_id':'2'}], 'bars', Foo.bars, {'sort':('-name',)})
+			storage.check_query.assert_called_once_with(Bar, filter={'foo':{'$in':['1', '2']}}, sort=('-name',), limit=0)
+		finally:
+			del storage.check_query
+		
+		
+	def test_routed(self):
+		"""
+		Storage calls are routed by the request context when one is given
+		"""
+		storage.routed = MagicMock()
+		try:
+			storage.get = Mock(return_value=[])
+			api.interfaces['foos'].list(context={'tenant':'a'})
+			storage.routed.assert_called_once_with({'tenant':'a'})
+			self.assertTrue(storage.routed.return_value.__enter__.called)
+			storage.routed.reset_mock()
+			api.interfaces['foos'].list()
+			self.assertFalse(storage.routed.called)
+		finally:
+			del storage.routed
+		
+		
 	def test_single_link_validation_fail(self):
 		"""
 		Fails validation if setting a link to a non-existent ID.
@@ -438,6 +822,226 @@ class InterfaceTest(unittest.TestCase):
 		self.assertEquals(result, [{'_id': '1', '_type':'Littorina.LittorinaLittorea', 'shell':{'_id':'2', 'color': 'Really brown'}}])
 		
 		
+	def test_etag_versioned(self):
+		"""The ETag of a versioned item comes from its version and is checked before it's prepared"""
+		storage.get_by_id = Mock(return_value={'_id':'1', '_version':3, 'title':'foo'})
+		drafts = api.interfaces['drafts']
+		item, etag = drafts.get_with_etag('1')
+		self.assertEquals(item, {'_id':'1', '_version':3, 'title':'foo'})
+		self.assertTrue(etag.startswith('"3-'))
+		self.assertNotEquals(drafts.get_with_etag('1', fields=('title',))[1], etag)
+		drafts.post = Mock()
+		try:
+			with self.assertRaises(errors.NotModifiedError) as cm:
+				drafts.get_with_etag('1', if_none_match=['"x"', 'W/' + etag])
+			self.assertEquals(cm.exception.etag, etag)
+			self.assertFalse(drafts.post.called)
+		finally:
+			del drafts.post
+		
+		
+	def test_etag_versioned_counters(self):
+		"""Counters and copies of linked items are part of a versioned item's ETag"""
+		drafts = api.interfaces['drafts']
+		storage.get_by_id = Mock(return_value={'_id':'1', '_version':3, 'notes_count':1})
+		_, etag = drafts.get_with_etag('1')
+		storage.get_by_id = Mock(return_value={'_id':'1', '_version':3, 'notes_count':2})
+		self.assertNotEquals(drafts.get_with_etag('1')[1], etag)
+		storage.get_by_id = Mock(return_value={'_id':'1', '_version':3, 'notes_count':1, 
+			'_snapshots':{'author':{'2':{'name':'bob'}}}})
+		self.assertNotEquals(drafts.get_with_etag('1')[1], etag)
+		
+		
+	def test_etag_embedded(self):
+		"""Items with embedded links get an ETag from their content"""
+		storage.get_by_id = Mock(side_effect=lambda entity, id: 
+			{'_id':'1', '_version':3, 'author':'2'} if entity is Draft else {'_id':'2', 'name':'bob'})
+		drafts = api.interfaces['drafts']
+		item, etag = drafts.get_with_etag('1', embed=('author',))
+		self.assertEquals(item, {'_id':'1', '_version':3, 'author':{'_id':'2', 'name':'bob'}})
+		self.assertFalse(etag.startswith('"3-'))
+		with self.assertRaises(errors.NotModifiedError):
+			drafts.get_with_etag('1', embed=('author',), if_none_match=[etag])
+		
+		
+	def test_etag_content(self):
+		"""Unversioned items get an ETag from a hash of their content"""
+		storage.get_by_id = Mock(return_value={'_id':'1', 'stuff':'a'})
+		foos = api.interfaces['foos']
+		_, etag = foos.get_with_etag('1')
+		self.assertEquals(foos.get_with_etag('1')[1], etag)
+		storage.get_by_id = Mock(return_value={'_id':'1', 'stuff':'b'})
+		self.assertNotEquals(foos.get_with_etag('1')[1], etag)
+		with self.assertRaises(errors.NotModifiedError):
+			foos.get_with_etag('1', if_none_match=['*'])
+		
+		
+	def test_if_match_versioned(self):
+		"""If-Match on a versioned entity becomes a version check in storage without reading the item"""
+		drafts = api.interfaces['drafts']
+		storage.get_by_id = Mock(side_effect=lambda entity, id: {'_id':id, '_version':3, 'title':'foo'})
+		storage.update = Mock(return_value={'_id':'1', '_version':4, 'title':'bar'})
+		_, etag = drafts.get_with_etag('1')
+		storage.get_by_id.reset_mock()
+		drafts.update('1', {'title':'bar'}, if_match=[etag])
+		self.assertFalse(storage.get_by_id.called)
+		storage.update.assert_called_once_with(Draft, '1', {'title':'bar'}, replace=False, match={'_version':3})
+		storage.update.reset_mock()
+		_, fields_etag = drafts.get_with_etag('1', fields=('title',))
+		storage.get_by_id.reset_mock()
+		with self.assertRaises(errors.PreconditionFailedError):
+			drafts.update('2', {'title':'bar'}, if_match=[etag])
+		with self.assertRaises(errors.PreconditionFailedError):
+			drafts.update('1', {'title':'bar'}, if_match=[fields_etag])
+		self.assertFalse(storage.get_by_id.called)
+		with self.assertRaises(errors.PreconditionFailedError):
+			drafts.update('1', {'title':'bar'}, if_match=['"3-abc"'])
+		self.assertFalse(storage.update.called)
+		
+		
+	def test_if_match_content(self):
+		"""If-Match on an unversioned entity compares the ETag and writes only if nothing changed"""
+		stored = {'_id':'1', 'stuff':'a'}
+		storage.get_by_id = Mock(return_value=stored)
+		storage.update = Mock(return_value={'_id':'1', 'stuff':'b'})
+		storage.delete = Mock()
+		foos = api.interfaces['foos']
+		_, etag = foos.get_with_etag('1')
+		foos.update('1', {'stuff':'b'}, if_match=[etag])
+		storage.update.assert_called_once_with(Foo, '1', {'stuff':'b'}, replace=False, match=stored)
+		with self.assertRaises(errors.PreconditionFailedError):
+			foos.update('1', {'stuff':'b'}, if_match=['"nope"'])
+		with self.assertRaises(errors.PreconditionFailedError):
+			foos.delete('1', if_match=['"nope"'])
+		self.assertFalse(storage.delete.called)
+		foos.delete('1', if_match=[etag])
+		storage.delete.assert_called_once_with(Foo, '1', match=stored)
+		
+		
+	def test_identity_map(self):
+		"""Items are only fetched once for contexts sharing an identity map"""
+		storage.get_by_id = Mock(return_value={'_id':'1', 'stuff':'a'})
+		storage.update = Mock(return_value={'_id':'1', 'stuff':'b'})
+		foos = api.interfaces['foos']
+		context = {'identity_map':{}}
+		self.assertEquals(foos.get('1', context=context), {'_id':'1', 'stuff':'a'})
+		self.assertEquals(foos.get('1', context=context), {'_id':'1', 'stuff':'a'})
+		self.assertEquals(storage.get_by_id.call_count, 1)
+		foos.update('1', {'stuff':'b'}, context=context)
+		foos.get('1', context=context)
+		self.assertEquals(storage.get_by_id.call_count, 2)
+		
+		
+	def test_embed_batched(self):
+		"""The linked items of all the items in a list are loaded together"""
+		storage.get = Mock(return_value=[
+			{'_id':'1', 'embedded_foo':'10'},
+			{'_id':'2', 'embedded_foo':'20'},
+			{'_id':'3', 'embedded_foo':'10'},
+			{'_id':'4'}])
+		storage.get_by_ids = Mock(return_value=[{'_id':'10', 'stuff':'a'}, {'_id':'20', 'stuff':'b'}])
+		result = api.interfaces['bars'].list()
+		self.assertEquals(storage.get_by_ids.call_count, 1)
+		self.assertEquals(sorted(storage.get_by_ids.call_args[0][1]), ['10', '20'])
+		self.assertEquals(result, [
+			{'_id':'1', 'embedded_foo':{'_id':'10', 'stuff':'a'}},
+			{'_id':'2', 'embedded_foo':{'_id':'20', 'stuff':'b'}},
+			{'_id':'3', 'embedded_foo':{'_id':'10', 'stuff':'a'}},
+			{'_id':'4'}])
+		
+		
+	def test_embed_batched_list(self):
+		"""The items of a list of links are loaded together for all the items in a list"""
+		storage.get = Mock(return_value=[
+			{'_id':'1', 'embedded_bazes':['10', '20']},
+			{'_id':'2', 'embedded_bazes':['20', '30']}])
+		storage.get_by_ids = Mock(return_value=[
+			{'_id':'30', 'name':'c'}, {'_id':'20', 'name':'b'}, {'_id':'10', 'name':'a'}])
+		result = api.interfaces['foos'].list()
+		self.assertEquals(storage.get_by_ids.call_count, 1)
+		self.assertEquals(result, [
+			{'_id':'1', 'embedded_bazes':[{'_id':'20', 'name':'b'}, {'_id':'10', 'name':'a'}]},
+			{'_id':'2', 'embedded_bazes':[{'_id':'30', 'name':'c'}, {'_id':'20', 'name':'b'}]}])
+		
+		
+	def test_embed_batched_inverse(self):
+		"""The items of an inverse link are loaded together for all the items in a list"""
+		bazes = [{'_id':'1', 'name':'a'}, {'_id':'2', 'name':'b'}]
+		foos = [{'_id':'10', 'stuff':'x', 'bazes':['1', '2']}]
+		storage.get = Mock(side_effect=[bazes, foos])
+		result = api.interfaces['bazes'].list(embed=('embedded_foo',))
+		self.assertEquals(storage.get.call_args_list[1], 
+			((Foo,), {'filter':{'bazes':{'$in':['1', '2']}}, 'sort':()}))
+		self.assertEquals(result, [
+			{'_id':'1', 'name':'a', 'embedded_foo':{'_id':'10', 'stuff':'x', 'bazes':['1', '2']}},
+			{'_id':'2', 'name':'b', 'embedded_foo':{'_id':'10', 'stuff':'x', 'bazes':['1', '2']}}])
+		
+		
+	def test_resolve_links_limit(self):
+		"""Batched inverse links are capped and paged per source when a source has more"""
+		bars = api.interfaces['bars']
+		storage.get = Mock(side_effect=[
+			[{'_id':'10', 'foo':'1'}, {'_id':'11', 'foo':'1'}],
+			[{'_id':'10', 'foo':'1'}],
+			[]])
+		result = bars.resolve_links([{'_id':'1'}, {'_id':'2'}], 'bars', Foo.bars, {'limit':1})
+		self.assertEquals(storage.get.call_args_list[0][1]['limit'], 2)
+		self.assertEquals([x[1]['limit'] for x in storage.get.call_args_list[1:]], [1, 1])
+		self.assertEquals(result, [[{'_id':'10', 'foo':'1'}], []])
+		
+		storage.get = Mock(return_value=[{'_id':'10', 'foo':'1'}, {'_id':'11', 'foo':'2'}])
+		self.assertEquals(bars.resolve_links([{'_id':'1'}, {'_id':'2'}], 'bars', Foo.bars, {'limit':2}), 
+			[[{'_id':'10', 'foo':'1'}], [{'_id':'11', 'foo':'2'}]])
+		self.assertEquals(storage.get.call_count, 1)
+		
+		
+	def test_resolve_links_list_limit(self):
+		"""Lists of links longer than the limit are loaded per source"""
+		storage.get_by_ids = Mock(side_effect=[[{'_id':'10', 'name':'a'}], [{'_id':'30', 'name':'c'}]])
+		result = api.interfaces['bazes'].resolve_links(
+			[{'_id':'1', 'bazes':['10', '20']}, {'_id':'2', 'bazes':['30']}], 'bazes', Foo.bazes, {'limit':1})
+		self.assertEquals([x[1]['limit'] for x in storage.get_by_ids.call_args_list], [1, 1])
+		self.assertEquals(result, [[{'_id':'10', 'name':'a'}], [{'_id':'30', 'name':'c'}]])
+		
+		
+	def test_resolve_links_count(self):
+		"""Counts of batched links are made per source"""
+		storage.get = Mock(side_effect=[3, 5])
+		result = api.interfaces['bars'].resolve_links([{'_id':'1'}, {'_id':'2'}], 'bars', Foo.bars, {'count':True})
+		self.assertEquals(result, [3, 5])
+		self.assertEquals([x[1]['filter'] for x in storage.get.call_args_list], [{'foo':'1'}, {'foo':'2'}])
+		
+		
+	def test_embed_nested(self):
+		"""Dotted embed paths embed links of linked items"""
+		storage.get_by_id = Mock(side_effect=[
+			{'_id':'1', 'embedded_foo':'10'},
+			{'_id':'10', 'stuff':'a', 'embedded_foos':['20']}])
+		storage.get_by_ids = Mock(return_value=[{'_id':'20', 'stuff':'b', 'optional_stuff':'c'}])
+		result = api.interfaces['bars'].get('1', embed=('embedded_foo.embedded_foos',))
+		self.assertEquals(storage.get_by_id.call_args_list, [((Bar, '1'),), ((Foo, '10'),)])
+		storage.get_by_ids.assert_called_once_with(Foo, ['20'], sort=(), filter=None, limit=0, offset=0, count=False)
+		self.assertEquals(result, {'_id':'1', 'embedded_foo':
+			{'_id':'10', 'stuff':'a', 'embedded_foos':[{'_id':'20', 'stuff':'b'}]}})
+		
+		
+	def test_embed_too_deep(self):
+		"""Embed paths deeper than the interface allows are refused"""
+		with self.assertRaises(errors.DisabledFieldError):
+			api.interfaces['bars'].list(embed=('embedded_foo.embedded_foos.embedded_foos.embedded_foos',))
+		
+		
+	def test_hidden_polymorphic(self):
+		"""Hidden fields of a descendant are removed from its items"""
+		storage.get = Mock(return_value=[
+			{'_id': '1', '_type':'Littorina.LittorinaLittorea', 'size':2.0, 'tag':'x'},
+			{'_id': '2', '_type':'Littorina', 'size':1.0}])
+		result = api.interfaces['littorinas'].list(embed=())
+		self.assertEquals(result, [
+			{'_id': '1', '_type':'Littorina.LittorinaLittorea', 'size':2.0},
+			{'_id': '2', '_type':'Littorina', 'size':1.0}])
+		
+		
 	def test_sort_fail(self):
 		"""
 		Trying to sort by a sort-disabled field raises an error.
@@ -446,6 +1050,15 @@ class InterfaceTest(unittest.TestCase):
 			api.interfaces['foos'].list(sort=('+optional_stuff',))
 		
 		
+	def test_sort_by_id(self):
+		"""
+		Items can always be sorted by id.
+		"""
+		storage.get = Mock(return_value=[])
+		api.interfaces['foos'].list(sort=('+_id',))
+		storage.get.assert_called_once_with(Foo, sort=('+_id',), filter=None, limit=0, offset=0, count=False)
+		
+		
 	def test_sort_default(self):
 		"""
 		If no sort is set, the default is used.
@@ -537,6 +1150,68 @@ class InterfaceTest(unittest.TestCase):
 		storage.check_filter.assert_called_once_with({'name':'zoomy'}, set(['name', '_type', '_id']),  {'item': [], 'identity': {'foo': 'bar'}})
 		
 		
+	def test_options_leave_arguments_alone(self):
+		"""The context and filter passed to a method are not changed"""
+		storage.check_filter = Mock(side_effect=lambda filter, *args: filter.update({'changed':True}))
+		storage.get = Mock(return_value=[])
+		context = {'identity':{'foo':'bar'}}
+		filter = {'name':'zoomy'}
+		api.interfaces['hiddens'].list(filter=filter, context=context)
+		self.assertEquals(context, {'identity':{'foo':'bar'}})
+		self.assertEquals(filter, {'name':'zoomy'})
+		
+		
+	def test_options_can_show_hidden(self):
+		"""Hidden field authorization is only checked when it is needed"""
+		factory = api.interfaces['hiddens'].options_factory
+		factory.can_show_hidden = Mock(return_value=True)
+		try:
+			options = factory.create({'context':{'identity':{}}})
+			self.assertFalse(factory.can_show_hidden.called)
+			self.assertTrue(options.can_show_hidden)
+			self.assertTrue(options['can_show_hidden'])
+			self.assertEquals(factory.can_show_hidden.call_count, 1)
+			self.assertTrue(factory.create({'bypass_authorization':True}).can_show_hidden)
+			self.assertEquals(factory.can_show_hidden.call_count, 1)
+		finally:
+			del factory.can_show_hidden
+		
+		
+	def test_options_cached(self):
+		"""Derived options are computed once per embed list and identity"""
+		factory = api.interfaces['hiddens'].options_factory
+		rule = factory.hidden_field_authorization
+		factory.hidden_field_authorization = Mock(side_effect=rule, uses=rule.uses)
+		try:
+			for i in range(2):
+				self.assertTrue(factory.create({'context':{'identity':{'foo':'bar', 'roles':['a']}}}).can_show_hidden)
+				self.assertFalse(factory.create({'context':{'identity':{'foo':'baz'}}}).can_show_hidden)
+			self.assertEquals(factory.hidden_field_authorization.call_count, 2)
+			first = factory.create({'embed':['a.b', 'c']})
+			second = factory.create({'embed':['c', 'a.b']})
+			self.assertEquals(first.embed, set(['a', 'c']))
+			self.assertEquals(first.nested_embed, {'a':['b']})
+			self.assertIs(first.embed, second.embed)
+		finally:
+			factory.hidden_field_authorization = rule
+			factory.hidden_cache.clear()
+		
+		
+	def test_options_cache_cleared(self):
+		"""Derived options are returned even if the cache is cleared as they're stored"""
+		class ClearedDict(dict):
+			def __setitem__(self, key, value):
+				pass
+		factory = api.interfaces['hiddens'].options_factory
+		embed_cache, hidden_cache = factory.embed_cache, factory.hidden_cache
+		factory.embed_cache, factory.hidden_cache = ClearedDict(), ClearedDict()
+		try:
+			self.assertEquals(factory.split_embed(['a.b', 'c']), (frozenset(['a', 'c']), {'a':['b']}))
+			self.assertTrue(factory.can_show_hidden({'identity':{'foo':'bar', 'roles':['a']}}))
+		finally:
+			factory.embed_cache, factory.hidden_cache = embed_cache, hidden_cache
+		
+		
 	def test_hidden_sort_fail(self):
 		"""Can't sort by a hidden field without authorization."""
 		with self.assertRaises(errors.DisabledFieldError) as cm:
@@ -717,6 +1392,17 @@ class InterfaceTest(unittest.TestCase):
 		storage.get_by_ids.assert_called_once_with(Foo, ['1','2','3'], sort=(), filter=None, limit=0, offset=0, count=False)
 		
 		
+	def test_embed_fields_leave_defaults_alone(self):
+		"""Asking for an embeddable field doesn't change what is embedded by default"""
+		storage.get = Mock(return_value=[{'_id':'123', 'embedded_foos':['1','2','3']}])
+		storage.get_by_ids = Mock(return_value=[])
+		api.interfaces['foos'].list(fields=['embedded_foos'])
+		self.assertEquals(Foo.embed_by_default, set(['embedded_bazes']))
+		storage.get_by_ids.reset_mock()
+		api.interfaces['foos'].list()
+		self.assertFalse(storage.get_by_ids.called)
+		
+		
 	def test_embeddable_fields(self):
 		"""Only fields in an entity's embedded_fields list are included"""
 		storage.get = Mock(return_value=[{'_id':'123', 'embedded_foos':['1','2','3']}])
@@ -767,6 +1453,146 @@ class InterfaceTest(unittest.TestCase):
 		self.assertEquals(result, [{'_id':'123', 'stuff':'foo'}])
 		
 		
+	def test_distinct(self):
+		"""Can get the distinct values of a filterable field"""
+		storage.check_filter = Mock(return_value=None)
+		storage.distinct = Mock(return_value=['a', 'b'])
+		result = api.interfaces['foos'].distinct('stuff', filter={'stuff':{'$ne':'c'}})
+		self.assertEquals(result, ['a', 'b'])
+		storage.distinct.assert_called_once_with(Foo, 'stuff', filter={'stuff':{'$ne':'c'}})
+		
+		
+	def test_distinct_disabled_field(self):
+		"""Can't get the distinct values of a field that can't be filtered by"""
+		storage.distinct = Mock(return_value=[])
+		with self.assertRaises(errors.DisabledFieldError):
+			api.interfaces['foos'].distinct('optional_stuff')
+		with self.assertRaises(errors.DisabledFieldError):
+			api.interfaces['hiddens'].distinct('name', context={'identity':{}})
+		self.assertFalse(storage.distinct.called)
+		
+		
+	def test_distinct_item_filter(self):
+		"""Item rules that can be turned into a filter are added to the distinct query"""
+		distinct_bars = api.interfaces['distinct_bars']
+		storage.distinct = Mock(return_value=['a'])
+		storage.get = Mock()
+		self.assertEquals(distinct_bars.distinct('name', filter={'name':{'$ne':'b'}}), ['a'])
+		storage.distinct.assert_called_once_with(Bar, 'name', filter={'$and':[{'name':{'$ne':'b'}}, {'number':1}]})
+		self.assertFalse(storage.get.called)
+		
+		
+	def test_distinct_item_rules(self):
+		"""Item rules that can't be turned into a filter are checked against every item when getting distinct values"""
+		distinct_bars = api.interfaces['distinct_bars']
+		distinct_bars.rules.get_item_filter = Mock(side_effect=FilterCompilationError)
+		try:
+			storage.get = Mock(return_value=[{'name':'a', 'number':1}, {'name':'a', 'number':1}, {'number':1}])
+			self.assertEquals(distinct_bars.distinct('name'), ['a'])
+			storage.get = Mock(return_value=[{'name':'a', 'number':1}, {'name':'b', 'number':2}])
+			with self.assertRaises(errors.NotAuthorizedError):
+				distinct_bars.distinct('name')
+		finally:
+			del distinct_bars.rules.get_item_filter
+		
+		
+	def test_list_item_filter(self):
+		"""Item rules that can be turned into a filter are added to the list query"""
+		storage.check_filter = Mock(return_value=None)
+		storage.get = Mock(return_value=[{'_id':'1', 'name':'jim'}])
+		named_bars = api.interfaces['named_bars']
+		result = named_bars.list(filter={'number':1}, context={'identity':{'name':'bob'}})
+		storage.get.assert_called_once_with(Bar, filter={'$and':[{'number':1}, {'name':'bob'}]}, 
+			sort=(), offset=0, limit=0, count=False)
+		self.assertEquals(result, [{'_id':'1', 'name':'jim'}])
+		
+		storage.get = Mock(return_value=3)
+		named_bars.list(count=True, context={'identity':{'name':'bob'}})
+		storage.get.assert_called_once_with(Bar, filter={'name':'bob'}, 
+			sort=(), offset=0, limit=0, count=True)
+		
+		with self.assertRaises(errors.NotAuthenticatedError):
+			named_bars.list()
+		
+		
+	def test_list_prefetch_links(self):
+		"""Items linked from item rules are loaded once for the whole list"""
+		linked_bars = api.interfaces['linked_bars']
+		storage.get = Mock(return_value=[{'_id':'1', 'foo':'a'}, {'_id':'2', 'foo':'b'}, {'_id':'3', 'foo':'a'}])
+		storage.get_by_ids = Mock(return_value=[{'_id':'a', 'stuff':'x'}, {'_id':'b', 'stuff':'x'}])
+		self.assertEquals(len(linked_bars.list(context={'api':api})), 3)
+		self.assertEquals(storage.get_by_ids.call_count, 1)
+		entity, ids = storage.get_by_ids.call_args[0]
+		self.assertEquals((entity, sorted(ids)), (Foo, ['a', 'b']))
+		
+		storage.get_by_ids = Mock(return_value=[{'_id':'a', 'stuff':'x'}, {'_id':'b', 'stuff':'y'}])
+		with self.assertRaises(errors.NotAuthorizedError):
+			linked_bars.list(context={'api':api})
+		
+		
+	def test_list_prefetch_inverse_links(self):
+		"""Rules on inverse links allow the same items when listing as when getting them"""
+		linked_bazes = api.interfaces['linked_bazes']
+		def get(entity, **kwargs):
+			if entity is Foo:
+				return [{'_id':'f', 'stuff':'x', 'bazes':['1', '2']}]
+			return [{'_id':'1', 'name':'a'}, {'_id':'2', 'name':'b'}]
+		storage.get = Mock(side_effect=get)
+		storage.get_by_id = Mock(return_value={'_id':'1', 'name':'a'})
+		self.assertEquals(linked_bazes.get('1', context={'api':api})['name'], 'a')
+		self.assertEquals(len(linked_bazes.list(context={'api':api})), 2)
+		self.assertEquals(storage.get.call_count, 3)
+		entity, kwargs = storage.get.call_args[0][0], storage.get.call_args[1]
+		self.assertEquals((entity, kwargs['filter']), (Foo, {'bazes':{'$in':['1', '2']}}))
+		
+		
+	def test_distinct_cache(self):
+		"""Distinct values can be cached until an item is written"""
+		cached_bazes = api.interfaces['cached_bazes']
+		storage.distinct = Mock(return_value=['a'])
+		self.assertEquals(cached_bazes.distinct('name'), ['a'])
+		self.assertEquals(cached_bazes.distinct('name'), ['a'])
+		self.assertEquals(storage.distinct.call_count, 1)
+		cached_bazes.distinct('name', filter={'name':'a'})
+		self.assertEquals(storage.distinct.call_count, 2)
+		
+		storage.create = Mock(return_value='123')
+		cached_bazes.create({'name':'b'})
+		cached_bazes.distinct('name')
+		self.assertEquals(storage.distinct.call_count, 3)
+		
+		
+	def test_distinct_cache_routes(self):
+		"""Distinct values are cached separately for each storage route"""
+		cached_bazes = api.interfaces['cached_bazes']
+		cached_bazes.distinct_cache.clear()
+		try:
+			storage.get_route = Mock(return_value=('tenant_a', None))
+			storage.distinct = Mock(return_value=['a'])
+			self.assertEquals(cached_bazes.distinct('name'), ['a'])
+			storage.get_route = Mock(return_value=('tenant_b', None))
+			storage.distinct = Mock(return_value=['b'])
+			self.assertEquals(cached_bazes.distinct('name'), ['b'])
+			self.assertEquals(cached_bazes.distinct('name'), ['b'])
+			self.assertEquals(storage.distinct.call_count, 1)
+			storage.get_route = Mock(return_value=('tenant_a', None))
+			self.assertEquals(cached_bazes.distinct('name'), ['a'])
+		finally:
+			del storage.get_route
+			
+			
+	def test_distinct_cache_size(self):
+		"""The distinct cache is emptied rather than growing forever"""
+		cached_bazes = api.interfaces['cached_bazes']
+		storage.distinct = Mock(return_value=['a'])
+		try:
+			for i in range(1100):
+				cached_bazes.distinct('name', filter={'name':str(i)})
+			self.assertTrue(len(cached_bazes.distinct_cache) <= 1001)
+		finally:
+			cached_bazes.distinct_cache.clear()
+			
+			
 	def test_count(self):
 		"""Can get a count instead of a list of items"""
 		storage.get = Mock(return_value=42)
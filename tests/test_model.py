@@ -2,6 +2,7 @@
 Unit tests for data fields
 """
 import unittest
+from mock import Mock
 from cellardoor.model import *
 from cellardoor.storage import Storage
 
@@ -380,6 +381,78 @@ class TestModel(unittest.TestCase):
         Bar.get_link('foos')
         
         
+    def test_expiry_field(self):
+        """
+        An entity's expiry field must be a DateTime field
+        """
+        model = Model(storage=Storage())
+        
+        class Foo(model.Entity):
+            created = DateTime()
+            expires_after = ('created', 60)
+            
+        class Bar(Foo):
+            pass
+            
+        self.assertEquals(Bar.expires_after, ('created', 60))
+        
+        with self.assertRaises(InvalidModelException):
+            class Baz(model.Entity):
+                name = Text()
+                expires_after = ('name', 60)
+                
+        with self.assertRaises(InvalidModelException):
+            class Qux(model.Entity):
+                expires_after = ('created', 60)
+        
+        
+    def test_counters(self):
+        """
+        Counted inverse links register their counter field on the linked entity
+        """
+        storage = Storage()
+        storage.repair_counter = Mock()
+        model = Model(storage=storage)
+        
+        class Person(model.Entity):
+            posts = InverseLink('Post', 'author', counter=True)
+            comments = InverseLink('Comment', 'authors', counter='num_comments')
+            
+        class Editor(Person):
+            pass
+            
+        class Post(model.Entity):
+            author = Link(Person)
+            
+        class Comment(model.Entity):
+            authors = ListOf(Link(Person))
+            
+        model.freeze()
+        
+        self.assertEquals(Editor.counter_fields, set(['posts_count', 'num_comments']))
+        self.assertEquals(Post.counters, [('author', Person, 'posts_count')])
+        self.assertEquals(Comment.counters, [('authors', Person, 'num_comments')])
+        
+        model.repair_counters()
+        self.assertEquals(storage.repair_counter.call_count, 2)
+        storage.repair_counter.assert_any_call(Person, 'posts_count', Post, 'author')
+        storage.repair_counter.assert_any_call(Person, 'num_comments', Comment, 'authors')
+        
+        
+    def test_denormalize_needs_embedded_fields(self):
+        """
+        A denormalized link must say which fields to copy
+        """
+        model = Model(storage=Storage())
+        
+        class Foo(model.Entity):
+            name = Text()
+            
+        with self.assertRaises(InvalidModelException):
+            class Bar(model.Entity):
+                foo = Link(Foo, denormalize=True)
+        
+        
     def test_fail_add_to_frozen(self):
         """
         Can't add an entity to a frozen model
@@ -1,9 +1,11 @@
 import unittest
 from mock import Mock
 from datetime import datetime
+from bson.son import SON
 from cellardoor.model import *
 from cellardoor.storage.mongodb import MongoDBStorage
 from cellardoor import errors
+from cellardoor.authorization import ObjectProxy
 
 
 storage = MongoDBStorage('test')
@@ -35,6 +37,24 @@ class Human(Primate):
 	
 class Scotsman(Human):
 	pass
+	
+	
+class Session(model.Entity):
+	created = DateTime()
+	expires_after = ('created', 60)
+	
+	
+class Writer(model.Entity):
+	name = Text()
+	books = InverseLink('Book', 'writers', counter=True)
+	
+	
+class Book(model.Entity):
+	writers = ListOf(Link(Writer))
+	
+	
+class Garden(model.Entity):
+	plants = ListOf(Compound(name=Text(), height=TypeOf(int)))
 
 
 model.freeze()
@@ -244,6 +264,28 @@ class TestMongoDBStorage(unittest.TestCase):
 		self.assertEquals([r['_id'] for r in results], subset_of_ids)
 		
 		
+	def test_get_by_ids_item_filter(self):
+		"""
+		An id rule pushed down from authorization still limits the linked items that can be fetched.
+		"""
+		ids = [storage.create(Foo, {'b':i}) for i in range(3)]
+		rule = ObjectProxy('item')._id.in_(ObjectProxy('identity').allowed)
+		item_filter = rule.to_filter({'identity':{'allowed':ids[:1]}})
+		results = storage.get_by_ids(Foo, ids, filter=item_filter)
+		self.assertEquals([r['_id'] for r in results], ids[:1])
+		
+		
+	def test_get_combined_id_filter(self):
+		"""
+		Ids are matched inside combined filters.
+		"""
+		ids = [storage.create(Foo, {'b':i}) for i in range(3)]
+		results = storage.get(Foo, filter={'$and':[{'b':{'$gte':0}}, {'_id':ids[1]}]})
+		self.assertEquals([r['_id'] for r in results], ids[1:2])
+		results = storage.get(Foo, filter={'$or':[{'_id':{'$in':ids[:1]}}, {'b':2}]}, sort=('+b',))
+		self.assertEquals([r['_id'] for r in results], [ids[0], ids[2]])
+		
+		
 	def test_check_filter(self):
 		"""
 		Raises an error if there are disallowed fields in the filter.
@@ -303,6 +345,29 @@ class TestMongoDBStorage(unittest.TestCase):
 		self.assertEquals(len(results), 0)
 		
 		
+	def test_get_after_id(self):
+		"""
+		Items can be paged through by filtering on ids greater than the last one seen
+		"""
+		ids = sorted([storage.create(Foo, {'a':'cat', 'b':i}) for i in range(3)])
+		results = storage.get(Foo, filter={'_id':{'$gt':ids[0]}}, sort=('+_id',))
+		self.assertEquals([x['_id'] for x in results], ids[1:])
+		results = storage.get_by_ids(Foo, ids[:2], filter={'_id':{'$gt':ids[0]}}, sort=('+_id',))
+		self.assertEquals([x['_id'] for x in results], ids[1:2])
+		
+		
+	def test_create_many_existing(self):
+		"""
+		Bulk inserts report which items failed because their id is already taken.
+		"""
+		foo_id = storage.create(Foo, {'a':'cat', 'b':1})
+		with self.assertRaises(errors.BulkCreateError) as cm:
+			storage.create_many(Foo, [{'_id':foo_id, 'b':1}, {'b':2}])
+		self.assertEquals(cm.exception.indexes, [0])
+		self.assertEquals(cm.exception.existing, set([0]))
+		self.assertEquals(storage.get(Foo, count=True), 2)
+		
+		
 	def test_create_versioned(self):
 		"""
 		When created, a versioned entity will have version information.
@@ -342,6 +407,69 @@ class TestMongoDBStorage(unittest.TestCase):
 		self.assertEquals(bar['_version'], 3)
 		
 		
+	def test_update_versioned_match(self):
+		"""A versioned update can take its version from a match and fails the precondition on a mismatch"""
+		bar_id = storage.create(Bar, {'a':'car', 'b':123})
+		bar = storage.update(Bar, bar_id, {'a':'bike'}, match={'_version':1})
+		self.assertEquals(bar, {'_id':bar_id, '_version':2, 'a':'bike', 'b':123})
+		self.assertEquals(storage.get_by_id(Bar, bar_id), bar)
+		self.assertRaises(errors.PreconditionFailedError, storage.update, Bar, bar_id, {'a':'car'}, match={'_version':1})
+		self.assertEquals(storage.update(Bar, storage.new_id(), {'a':'car'}, match={'_version':1}), None)
+		
+		
+	def test_update_unversioned_match(self):
+		"""An unversioned update with a match only changes an item that still has the matched values"""
+		foo_id = storage.create(Foo, {'a':'car', 'b':123})
+		foo = storage.get_by_id(Foo, foo_id)
+		storage.update(Foo, foo_id, {'b':124})
+		self.assertRaises(errors.PreconditionFailedError, storage.update, Foo, foo_id, {'a':'bike'}, match=foo)
+		foo = storage.update(Foo, foo_id, {'a':'bike'}, match=storage.get_by_id(Foo, foo_id))
+		self.assertEquals(foo, {'_id':foo_id, 'a':'bike', 'b':124})
+		
+		
+	def test_update_match_missing_field(self):
+		"""Fields a whole item used as a match doesn't have must still be missing"""
+		foo_id = storage.create(Foo, {'a':'car'})
+		foo = storage.get_by_id(Foo, foo_id)
+		storage.update(Foo, foo_id, {'b':123})
+		self.assertRaises(errors.PreconditionFailedError, storage.update, Foo, foo_id, {'a':'bike'}, match=foo)
+		self.assertEquals(storage.get_by_id(Foo, foo_id), {'_id':foo_id, 'a':'car', 'b':123})
+		
+		
+	def test_update_match_list_of_subdocuments(self):
+		"""Lists of subdocuments are matched item by item, whatever order their keys are stored in"""
+		garden_id = storage.create(Garden, {'plants':[]})
+		storage.get_collection(Garden).update({'_id':storage._objectid(garden_id)}, 
+			{'$set':{'plants':[SON([('name', 'fern'), ('height', 3)])]}})
+		match = {'_id':garden_id, 'plants':[SON([('height', 3), ('name', 'fern')])]}
+		storage.update(Garden, garden_id, {'plants':[{'name':'fern', 'height':4}]}, match=match)
+		self.assertEquals(storage.get_by_id(Garden, garden_id)['plants'], [{'name':'fern', 'height':4}])
+		self.assertRaises(errors.PreconditionFailedError, storage.update, Garden, garden_id, {'plants':[]}, match=match)
+		
+		
+	def test_update_versioned_history(self):
+		"""The previous version is kept and a failed conditional update leaves no history behind"""
+		bar_id = storage.create(Bar, {'a':'car'})
+		storage.update(Bar, bar_id, {'a':'bike'}, match={'_version':1})
+		self.assertRaises(errors.PreconditionFailedError, storage.update, Bar, bar_id, {'a':'car'}, match={'_version':1, 'a':'car'})
+		self.assertRaises(errors.PreconditionFailedError, storage.update, Bar, bar_id, {'a':'car'}, match={'_version':2, 'a':'car'})
+		versions = storage.get(Bar, versions=True)
+		self.assertEquals([(x['_version'], x['a']) for x in versions], [(1, 'car')])
+		storage.update(Bar, bar_id, {'a':'car'}, match={'_version':2})
+		
+		
+	def test_delete_match(self):
+		"""A delete with a match fails the precondition if the item has changed"""
+		foo_id = storage.create(Foo, {'a':'car', 'b':123})
+		self.assertRaises(errors.PreconditionFailedError, storage.delete, Foo, foo_id, match={'a':'bike'})
+		storage.delete(Foo, foo_id, match={'a':'car', 'b':123})
+		self.assertEquals(storage.get_by_id(Foo, foo_id), None)
+		bar_id = storage.create(Bar, {'a':'car'})
+		self.assertRaises(errors.PreconditionFailedError, storage.delete, Bar, bar_id, match={'_version':2})
+		storage.delete(Bar, bar_id, match={'_version':1})
+		self.assertEquals(storage.get_by_id(Bar, bar_id), None)
+		
+		
 	def test_versioned_get(self):
 		"""
 		Can get a list of past versions of documents
@@ -467,4 +595,151 @@ class TestMongoDBStorage(unittest.TestCase):
 			doc['_id'] = storage.create(Foo, doc)
 		
 		result = storage.get(Foo, count=True)
-		self.assertEquals(result, 3)
\ No newline at end of file
+		self.assertEquals(result, 3)
+		
+		
+	def test_expired_hidden(self):
+		"""Expired items are hidden before they are removed"""
+		fresh_id = storage.create(Session, {'created':datetime.utcnow()})
+		stale_id = storage.create(Session, {'created':datetime(2000, 1, 1)})
+		undated_id = storage.create(Session, {})
+		results = storage.get(Session, sort=('+_id',))
+		self.assertEquals([x['_id'] for x in results], [fresh_id, undated_id])
+		self.assertEquals(storage.get_by_id(Session, stale_id), None)
+		self.assertNotEquals(storage.get_by_id(Session, fresh_id), None)
+		results = storage.get(Session, filter={'created':{'$lt':datetime.utcnow()}})
+		self.assertEquals([x['_id'] for x in results], [fresh_id])
+		
+		
+	def test_ttl_index(self):
+		"""A TTL index is created for entities that expire"""
+		indexes = storage.get_collection(Session).index_information()
+		ttl = [v for v in indexes.values() if v['key'] == [('created', 1)]]
+		self.assertEquals(ttl[0]['expireAfterSeconds'], 60)
+		
+		
+	def test_increment(self):
+		"""Can atomically increment a field"""
+		id = storage.create(Writer, {'name':'Bob'})
+		storage.increment(Writer, id, 'books_count', 2)
+		storage.increment(Writer, id, 'books_count', -1)
+		self.assertEquals(storage.get_by_id(Writer, id)['books_count'], 1)
+		
+		
+	def test_repair_counter(self):
+		"""Counters can be recomputed from the linked items"""
+		bob = storage.create(Writer, {'name':'Bob'})
+		jim = storage.create(Writer, {'name':'Jim'})
+		sue = storage.create(Writer, {'name':'Sue'})
+		storage.create(Book, {'writers':[bob, jim]})
+		storage.create(Book, {'writers':[bob]})
+		storage.increment(Writer, sue, 'books_count', 5)
+		model.repair_counters()
+		counts = dict((x['name'], x['books_count']) for x in storage.get(Writer))
+		self.assertEquals(counts, {'Bob':2, 'Jim':1, 'Sue':0})
+		
+		
+	def test_update_many(self):
+		"""Can set fields on every item matching a filter"""
+		a = storage.create(Foo, {'a':'x', 'b':1})
+		b = storage.create(Foo, {'a':'x', 'b':2})
+		c = storage.create(Foo, {'a':'y', 'b':3})
+		storage.update_many(Foo, {'a':'x'}, {'b':4})
+		results = dict((x['_id'], x['b']) for x in storage.get(Foo))
+		self.assertEquals(results, {a:4, b:4, c:3})
+		
+		
+	def test_routing(self):
+		"""A router keeps each tenant's items in its own collections"""
+		st = MongoDBStorage('test', router=lambda context: (None, context['tenant'] + '_'))
+		st.setup(model)
+		try:
+			with st.routed({'tenant':'a'}):
+				id = st.create(Foo, {'a':'x'})
+				self.assertEquals(st.get_by_id(Foo, id)['a'], 'x')
+			with st.routed({'tenant':'b'}):
+				self.assertEquals(st.get_by_id(Foo, id), None)
+			self.assertEquals(st.get_by_id(Foo, id), None)
+			self.assertEquals(st.db['a_Foo'].count(), 1)
+			indexes = st.db['a_Baz'].index_information()
+			self.assertTrue([v for v in indexes.values() if v['key'] == [('foo', 1)] and v['unique']])
+		finally:
+			for c in st.db.collection_names():
+				if c.startswith('a_') or c.startswith('b_'):
+					st.db[c].drop()
+		
+		
+	def test_change_feed(self):
+		"""Writes are recorded in the change feed and can be followed"""
+		import threading
+		st = MongoDBStorage('test', change_feed='test_changes')
+		st.setup(model)
+		try:
+			stopped = threading.Event()
+			changes = st.tail_changes(stopped)
+			id = st.create(Foo, {'a':'x'})
+			st.update(Foo, id, {'a':'y'})
+			st.delete(Foo, id)
+			self.assertEquals([next(changes) for i in range(3)], 
+				[('Foo', id, 'create', None), ('Foo', id, 'update', None), ('Foo', id, 'delete', None)])
+			stopped.set()
+		finally:
+			st.db['test_changes'].drop()
+		
+		
+	def test_change_feed_resume(self):
+		"""Following the feed starts after the changes already in it and keeps routes"""
+		import threading
+		st = MongoDBStorage('test', change_feed='test_changes')
+		st.setup(model)
+		try:
+			st.create(Foo, {'a':'before'})
+			stopped = threading.Event()
+			changes = st.tail_changes(stopped)
+			with st.route(('test_tenant', None)):
+				id = st.create(Foo, {'a':'after'})
+			self.assertEquals(next(changes), ('Foo', id, 'create', ('test_tenant', None)))
+			stopped.set()
+		finally:
+			st.db['test_changes'].drop()
+			st.client.drop_database('test_tenant')
+			
+			
+	def test_query_guard(self):
+		"""Queries that can't use an index are rejected, capped or logged"""
+		st = self.get_new_storage()
+		st.get_indexes = Mock(return_value=[[('_id', 1)], [('a', 1), ('b', -1)]])
+		self.assertEquals(st.check_query(Foo, {'b':1}, ('+b',), 10), 10)
+		
+		st.query_guard = 'reject'
+		self.assertEquals(st.check_query(Foo, {'a':'x'}, ('-b',), 10), 10)
+		self.assertEquals(st.check_query(Foo, {'a':'x'}, ('+b',), 10), 10)
+		self.assertEquals(st.check_query(Foo, None, ('-_id',), 10), 10)
+		self.assertEquals(st.check_query(Foo, {'a':{'$gt':'x'}}, None, 10), 10)
+		with self.assertRaises(errors.UnindexedQueryError):
+			st.check_query(Foo, {'b':1}, None, 10)
+		with self.assertRaises(errors.UnindexedQueryError):
+			st.check_query(Foo, {'a':'x'}, ('+a', '+b'), 10)
+		with self.assertRaises(errors.UnindexedQueryError):
+			st.check_query(Foo, {'b':1}, ('+_id',), 10)
+		self.assertEquals(st.check_query(Foo, {'$and':[{'a':'x'}, {'c':1}]}, ('-b',), 10), 10)
+		with self.assertRaises(errors.UnindexedQueryError):
+			st.check_query(Foo, {'$or':[{'a':'x'}, {'c':1}]}, ('-b',), 10)
+			
+		st.query_guard = 'cap'
+		st.query_guard_limit = 5
+		self.assertEquals(st.check_query(Foo, {'b':1}, None, 10), 5)
+		self.assertEquals(st.check_query(Foo, {'b':1}, None, 0), 5)
+		
+		st.query_guard = 'warn'
+		self.assertEquals(st.check_query(Foo, {'b':1}, None, 10), 10)
+		
+		
+	def test_index_refresh(self):
+		"""The list of indexes is cached until it is due for a refresh"""
+		st = self.get_new_storage()
+		st.get_indexes(Baz)
+		storage.get_collection(Baz).ensure_index('foo2')
+		self.assertFalse([('foo2', 1)] in st.get_indexes(Baz))
+		st.index_refresh = 0
+		self.assertTrue([('foo2', 1)] in st.get_indexes(Baz))
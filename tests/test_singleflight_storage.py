@@ -0,0 +1,136 @@
+import unittest
+import threading
+from mock import Mock
+from cellardoor.model import Model, Text
+from cellardoor.storage import Storage, freeze
+from cellardoor.storage.singleflight import SingleFlightStorage
+
+
+model = Model(storage=Storage())
+
+
+class Post(model.Entity):
+	title = Text()
+	
+	
+	
+def get_slow_storage(result):
+	"""A storage whose reads block until `release` is set"""
+	inner = Storage()
+	inner.started = threading.Event()
+	inner.release = threading.Event()
+	
+	def get_by_id(entity, id):
+		inner.started.set()
+		inner.release.wait(5)
+		if isinstance(result, Exception):
+			raise result
+		return result
+		
+	inner.get_by_id = Mock(side_effect=get_by_id)
+	return inner
+	
+	
+def read_in_threads(storage, count):
+	results = [None] * count
+	def read(i):
+		try:
+			results[i] = storage.get_by_id(Post, '1')
+		except Exception, e:
+			results[i] = e
+	threads = [threading.Thread(target=read, args=(i,)) for i in range(count)]
+	threads[0].start()
+	storage.storage.started.wait(5)
+	for t in threads[1:]:
+		t.start()
+	return threads, results
+	
+	
+	
+class TestSingleFlightStorage(unittest.TestCase):
+	
+	def test_concurrent_reads_share_a_call(self):
+		"""Identical reads running at the same time make one call and get their own copies"""
+		inner = get_slow_storage({'_id':'1', 'title':'foo'})
+		storage = SingleFlightStorage(inner)
+		threads, results = read_in_threads(storage, 5)
+		while sum([x.followers for x in storage.flights.values()]) < 4:
+			threading.Event().wait(0.01)
+		inner.release.set()
+		for t in threads:
+			t.join(5)
+		self.assertEquals(inner.get_by_id.call_count, 1)
+		self.assertEquals(results, [{'_id':'1', 'title':'foo'}] * 5)
+		self.assertEquals(len(set([id(x) for x in results])), 5)
+		
+		
+	def test_errors_are_shared(self):
+		"""Callers waiting on a read that fails get the same error"""
+		inner = get_slow_storage(ValueError('down'))
+		storage = SingleFlightStorage(inner)
+		threads, results = read_in_threads(storage, 3)
+		while sum([x.followers for x in storage.flights.values()]) < 2:
+			threading.Event().wait(0.01)
+		inner.release.set()
+		for t in threads:
+			t.join(5)
+		self.assertEquals(inner.get_by_id.call_count, 1)
+		self.assertTrue(all([isinstance(x, ValueError) for x in results]))
+		
+		
+	def test_sequential_reads(self):
+		"""Reads that don't overlap each make their own call"""
+		inner = Storage()
+		inner.get = Mock(return_value=iter([{'_id':'1'}]))
+		storage = SingleFlightStorage(inner)
+		self.assertEquals(storage.get(Post, filter={'title':'foo'}), [{'_id':'1'}])
+		storage.get(Post, filter={'title':'foo'})
+		self.assertEquals(inner.get.call_count, 2)
+		
+		
+	def test_write_starts_new_flight(self):
+		"""A read started after a write doesn't join one started before it"""
+		inner = get_slow_storage({'_id':'1'})
+		inner.update = Mock()
+		storage = SingleFlightStorage(inner)
+		threads, results = read_in_threads(storage, 1)
+		storage.update(Post, '1', {'title':'bar'})
+		inner.release.set()
+		storage.get_by_id(Post, '1')
+		threads[0].join(5)
+		self.assertEquals(inner.get_by_id.call_count, 2)
+		
+		
+	def test_read_during_write(self):
+		"""A read started after a write doesn't join one started while it ran"""
+		inner = get_slow_storage({'_id':'1'})
+		storage = SingleFlightStorage(inner)
+		during = []
+		def update(*args):
+			during.extend(read_in_threads(storage, 1)[0])
+		inner.update = Mock(side_effect=update)
+		storage.update(Post, '1', {'title':'bar'})
+		threads, results = read_in_threads(storage, 1)
+		while inner.get_by_id.call_count < 2 and not sum([x.followers for x in storage.flights.values()]):
+			threading.Event().wait(0.01)
+		inner.release.set()
+		for t in during + threads:
+			t.join(5)
+		self.assertEquals(inner.get_by_id.call_count, 2)
+		
+		
+	def test_unhashable_arguments(self):
+		"""Reads with arguments that can't be compared go straight through"""
+		inner = Storage()
+		inner.get = Mock(return_value=[])
+		storage = SingleFlightStorage(inner)
+		storage.get(Post, filter={'title':bytearray('x')})
+		inner.get.assert_called_once_with(Post, filter={'title':bytearray('x')})
+		
+		
+	def test_freeze(self):
+		"""Flight keys don't depend on the order of a filter's keys or a set's items"""
+		self.assertEquals(freeze({'a':1, 'b':[{'c':2, 'd':3}]}), freeze({'b':[{'d':3, 'c':2}], 'a':1}))
+		self.assertEquals(freeze(set(['a', 'b'])), freeze(set(['b', 'a'])))
+		self.assertNotEquals(freeze(['a', 'b']), freeze(['b', 'a']))
+		self.assertRaises(TypeError, freeze, {'a':bytearray('x')})